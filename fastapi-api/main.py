@@ -1,13 +1,30 @@
+import asyncio
+import base64
+import binascii
+import functools
+import hashlib
+import itertools
 import json
+import logging
+import mimetypes
 import os
-from typing import List, Optional, Dict, Any
-
-import psycopg2
-import psycopg2.extras
-from psycopg2 import pool
-from fastapi import Depends, FastAPI, HTTPException, Query
+import re
+import stat
+import time
+from collections import OrderedDict
+from datetime import datetime
+from email.utils import formatdate
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import asyncpg
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, AliasChoices, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -27,6 +44,20 @@ class Settings(BaseSettings):
         validation_alias=AliasChoices("POSTGRES_PASSWORD", "DB_PASSWORD"),
     )
 
+    # Pool asyncpg: por defecto se dimensiona a partir de max_connections del servidor
+    # (menos las reservadas), repartido entre réplicas de la API. DB_POOL_MIN/DB_POOL_MAX
+    # fuerzan valores fijos si se definen.
+    db_pool_min: Optional[int] = Field(default=None, validation_alias=AliasChoices("DB_POOL_MIN"))
+    db_pool_max: Optional[int] = Field(default=None, validation_alias=AliasChoices("DB_POOL_MAX"))
+    pool_percent: float = Field(default=0.5, validation_alias=AliasChoices("DB_POOL_PERCENT", "POOL_PERCENT"))
+    replicas: int = Field(default=1, validation_alias=AliasChoices("REPLICAS", "API_REPLICAS"))
+
+    # TTL (segundos) de la caché en proceso de /stats/queue. 0 la desactiva.
+    stats_cache_ttl: float = Field(default=2.0, validation_alias=AliasChoices("STATS_CACHE_TTL"))
+
+    # Caché compartida entre réplicas/workers (Redis o Valkey). Sin REDIS_URL queda desactivada.
+    redis_url: Optional[str] = Field(default=None, validation_alias=AliasChoices("REDIS_URL", "VALKEY_URL"))
+
     media_root: str = Field(default="/app/media_downloads", validation_alias=AliasChoices("MEDIA_ROOT", "TG_MEDIA_DIR"))
 
     # CORS: acepta "*", CSV ("https://a.com,https://b.com") o JSON ("[\"https://a.com\", ...]")
@@ -56,6 +87,74 @@ def parse_cors_allow_origins(value: str) -> List[str]:
     return origins or ["*"]
 
 
+def compute_pool_size(max_connections: int, reserved: int, pool_percent: float, replicas: int) -> int:
+    """Tamaño máximo de pool por réplica a partir de la configuración del servidor."""
+    usable = max(0, max_connections - reserved)
+    return max(4, int(usable * pool_percent / max(1, replicas)))
+
+
+_PLACEHOLDER_RE = re.compile(r"%s")
+
+
+def _pg(sql: str) -> str:
+    """Convierte placeholders estilo psycopg2 (%s) a los posicionales de asyncpg ($1, $2, ...)."""
+    counter = itertools.count(1)
+    return _PLACEHOLDER_RE.sub(lambda _m: f"${next(counter)}", sql)
+
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode()
+
+
+# Rango de los tipos enteros de PostgreSQL que pueden llevar las claves de un cursor
+_CURSOR_INT_BOUNDS = {"int": 2 ** 31, "bigint": 2 ** 63}
+
+
+def _cursor_value_ok(value: Any, kind: str) -> bool:
+    if kind == "text":
+        return isinstance(value, str) and "\x00" not in value
+    bound = _CURSOR_INT_BOUNDS[kind]
+    return isinstance(value, int) and not isinstance(value, bool) and -bound <= value < bound
+
+
+def _decode_cursor(cursor: str, key_types: Tuple[str, ...]) -> list:
+    """Decodifica un cursor de paginación keyset [marca, *claves]; 400 si no es válido.
+
+    key_types es el tipo SQL de cada clave ("int", "bigint" o "text"): un cursor manipulado
+    se rechaza aquí en vez de fallar en la consulta con un 500.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    if not isinstance(values, list) or len(values) != 1 + len(key_types):
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    ts = values[0]
+    if ts is not None:
+        try:
+            datetime.fromisoformat(ts)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="cursor inválido")
+    if not all(_cursor_value_ok(v, kind) for v, kind in zip(values[1:], key_types)):
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    return values
+
+
+def _rows_response(rows: List[Dict[str, Any]], limit: int, keys: Tuple[str, ...]) -> ORJSONResponse:
+    """Serializa una página con orjson sin revalidar las filas (ya tienen la forma del response_model)."""
+    # cursor_ts (marca sin truncar) no va en el cuerpo; la de la última fila alimenta X-Next-Cursor.
+    # Puede ser NULL (created_at/updated_at admiten NULL): el cursor lleva entonces None y las
+    # consultas lo tratan como "dentro del bloque de NULL" (ORDER BY ... DESC los pone primero)
+    # en vez de como "sin cursor", así que la paginación siempre avanza.
+    ts = None
+    for r in rows:
+        ts = r.pop("cursor_ts", None)
+    headers = {}
+    if rows and len(rows) >= limit:
+        headers["X-Next-Cursor"] = _encode_cursor([ts.isoformat() if ts else None] + [rows[-1][k] for k in keys])
+    return ORJSONResponse(rows, headers=headers)
+
+
 class QueueStats(BaseModel):
     status: str
     total: int
@@ -109,6 +208,12 @@ class ChatSettingsUpdate(BaseModel):
     media_download_enabled: bool
 
 
+class ChatSettingsBulkItem(BaseModel):
+    chat_id: int
+    account: str
+    media_download_enabled: bool
+
+
 class MessageWithLog(BaseModel):
     msg_id: int
     chat_id: int
@@ -124,57 +229,141 @@ class MessageWithLog(BaseModel):
     log: List[Dict[str, Any]] = []
 
 
-settings = Settings()
-app = FastAPI(title="Telegram Monitor API", version="0.1.0")
+logger = logging.getLogger("uvicorn.error")
 
-_cors_origins = parse_cors_allow_origins(settings.cors_allow_origins)
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=_cors_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-_pool = None
+router = APIRouter()
+_pool: Optional[asyncpg.Pool] = None
+_redis: Optional[aioredis.Redis] = None
 
 
-def get_pool():
-    global _pool
+def get_pool() -> asyncpg.Pool:
     if _pool is None:
-        if settings.db_password == "":
-            raise RuntimeError(
-                "Falta configurar POSTGRES_PASSWORD/DB_PASSWORD (no hay valor por defecto por seguridad)."
-            )
-        _pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
-            host=settings.db_host,
-            port=settings.db_port,
-            dbname=settings.db_name,
-            user=settings.db_user,
-            password=settings.db_password,
-            cursor_factory=psycopg2.extras.RealDictCursor,
-        )
+        raise RuntimeError("El pool de PostgreSQL no está inicializado (startup no ejecutado).")
     return _pool
 
 
-def get_conn():
-    pool = get_pool()
-    conn = pool.getconn()
-    return conn
+async def db_dep():
+    async with get_pool().acquire() as conn:
+        yield conn
 
 
-async def db_dep():
-    conn = get_conn()
+def cached(prefix: str, ttl: Union[float, Callable[..., float]], key_fn: Callable[..., Optional[Dict[str, Any]]]):
+    """Cachea en Redis el cuerpo JSON de un handler durante `ttl` segundos.
+
+    key_fn recibe los kwargs del handler y devuelve los parámetros que forman la clave,
+    o None para no cachear esa petición. ttl puede ser también una función de esos kwargs
+    (0 = sin caché). Si Redis no está configurado o falla, se va a la BD.
+
+    El handler no debe recibir la conexión por Depends: FastAPI la tomaría del pool antes
+    de mirar la caché. Debe pedirla dentro, solo en los fallos.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            params = key_fn(**kwargs) if _redis is not None else None
+            seconds = ttl(**kwargs) if callable(ttl) else ttl
+            if params is None or seconds <= 0:
+                return await func(*args, **kwargs)
+            key = f"{prefix}:{hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()}"
+            try:
+                hit = await _redis.get(key)
+            except RedisError as e:
+                logger.debug(f"Redis GET {key} falló: {e}")
+                hit = None
+            if hit is not None:
+                return Response(hit, media_type="application/json")
+            result = await func(*args, **kwargs)
+            body = result.body if isinstance(result, Response) else orjson.dumps(result)
+            try:
+                await _redis.set(key, body, px=max(1, int(seconds * 1000)))
+            except RedisError as e:
+                logger.debug(f"Redis SET {key} falló: {e}")
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+async def _invalidate_cached(prefix: str) -> None:
+    if _redis is None:
+        return
     try:
-        yield conn
-    finally:
-        get_pool().putconn(conn)
+        keys = [k async for k in _redis.scan_iter(match=f"{prefix}:*", count=500)]
+        if keys:
+            await _redis.delete(*keys)
+    except RedisError as e:
+        logger.warning(f"No se pudo invalidar la caché '{prefix}': {e}")
+
 
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # Las columnas json (json_agg, json_build_object) llegan ya decodificadas
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=orjson.loads, schema="pg_catalog")
 
-@app.get("/media")
-async def serve_media(path: str):
+
+async def _fetch_dicts(conn: asyncpg.Connection, sql: str, *args, prefetch: int = 200) -> List[Dict[str, Any]]:
+    """Lee un resultado potencialmente grande con un cursor de servidor, en lotes de `prefetch` filas.
+
+    Cada lote se convierte a dict según llega, en lugar de materializar primero todos los
+    Record y después su copia en dicts.
+    """
+    async with conn.transaction(readonly=True):
+        return [dict(r) async for r in conn.cursor(sql, *args, prefetch=prefetch)]
+
+
+# Historial de ediciones agregado por mensaje; se añade a las consultas de mensajes con include_logs
+_MESSAGE_LOG_COLUMN = ", COALESCE(ml.log, '[]'::json) AS log"
+_MESSAGE_LOG_JOIN = """
+    LEFT JOIN LATERAL (
+        SELECT json_agg(json_build_object(
+                   'msg_id', l.telegram_msg_id, 'chat_id', l.chat_id, 'text', l.text,
+                   'media_type', l.media_type,
+                   'created_at', TO_CHAR(l.created_at, 'YYYY-MM-DD HH24:MI:SS'))
+               ORDER BY l.created_at DESC) AS log
+        FROM message_log l
+        WHERE l.chat_id = m.chat_id AND l.telegram_msg_id = m.msg_id
+    ) ml ON TRUE
+"""
+
+
+# Caché LRU en memoria para ficheros de media pequeños (miniaturas, stickers, fotos).
+# Cada entrada se valida contra st_mtime_ns, así que un fichero reescrito se vuelve a leer.
+_MEDIA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_MEDIA_CACHE_MAX_FILE_BYTES = 2 * 1024 * 1024
+# path -> (mtime_ns, size, body, content_type, etag, last_modified)
+_media_cache: "OrderedDict[str, Tuple[int, int, bytes, str, str, str]]" = OrderedDict()
+_media_cache_bytes = 0
+
+
+def _media_cache_put(path: str, entry: Tuple[int, int, bytes, str, str, str]) -> None:
+    global _media_cache_bytes
+    old = _media_cache.pop(path, None)
+    if old is not None:
+        _media_cache_bytes -= old[1]
+    _media_cache[path] = entry
+    _media_cache_bytes += entry[1]
+    while _media_cache_bytes > _MEDIA_CACHE_MAX_BYTES and _media_cache:
+        _, evicted = _media_cache.popitem(last=False)
+        _media_cache_bytes -= evicted[1]
+
+
+def _not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    return request.headers.get("if-modified-since") == last_modified
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@router.get("/media")
+async def serve_media(path: str, request: Request):
     """Devuelve archivos de media asegurando que estén bajo MEDIA_ROOT."""
+    settings: Settings = request.app.state.settings
     normalized = os.path.normpath(path)
     candidate = (
         normalized
@@ -190,89 +379,217 @@ async def serve_media(path: str):
 
     if base != media_root:
         raise HTTPException(status_code=400, detail="Invalid media path")
-    if not os.path.exists(candidate):
+    # stat y lectura van al threadpool de Starlette: en un volumen lento (NFS, disco
+    # ocupado con descargas) bloquearían el event loop para todas las peticiones.
+    try:
+        st = await run_in_threadpool(os.stat, candidate)
+    except OSError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404, detail="File not found")
 
-    return FileResponse(candidate)
+    if st.st_size > _MEDIA_CACHE_MAX_FILE_BYTES:
+        # Reutiliza el stat ya hecho (FileResponse no vuelve a llamar a os.stat).
+        return FileResponse(
+            candidate,
+            stat_result=st,
+            media_type=mimetypes.guess_type(candidate)[0],
+            filename=os.path.basename(candidate),
+            content_disposition_type="inline",
+        )
+
+    entry = _media_cache.get(candidate)
+    if entry is None or entry[0] != st.st_mtime_ns:
+        body = await run_in_threadpool(_read_file, candidate)
+        content_type = mimetypes.guess_type(candidate)[0] or "application/octet-stream"
+        etag = f'"{st.st_mtime_ns:x}-{len(body):x}"'
+        last_modified = formatdate(st.st_mtime, usegmt=True)
+        entry = (st.st_mtime_ns, len(body), body, content_type, etag, last_modified)
+        _media_cache_put(candidate, entry)
+    else:
+        _media_cache.move_to_end(candidate)
+
+    _, _, body, content_type, etag, last_modified = entry
+    headers = {"ETag": etag, "Last-Modified": last_modified}
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=content_type, headers=headers)
+
+
+# Índices de postgres/init_db.sql de los que dependen las consultas del API
+_EXPECTED_INDEXES = (
+    "idx_messages_chat_acct_msg",
+    "idx_messages_text_trgm",
+    "idx_download_queue_status_updated",
+    "idx_message_log_chat_tg",
+    "idx_messages_text_tsv",
+    "idx_chats_title_trgm",
+    "idx_chats_username_trgm",
+)
+# messages.text_tsv solo existe en esquemas creados con el init_db.sql actual
+_messages_tsv_available = False
 
 
-@app.on_event("startup")
-async def startup_event():
-    # Ensure pool is created and schema exists (sin DDL en runtime).
-    pool = get_pool()
-    conn = pool.getconn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT to_regclass(%s) AS reg", ("public.chat_preferences",))
-            row = cur.fetchone()
-            if not row or not row.get("reg"):
-                raise RuntimeError(
-                    "Falta la tabla 'chat_preferences'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
+async def startup_event(settings: Settings):
+    # Crea el pool y valida que el esquema exista (sin DDL en runtime).
+    global _pool, _redis, _messages_tsv_available
+    if settings.db_password == "":
+        raise RuntimeError(
+            "Falta configurar POSTGRES_PASSWORD/DB_PASSWORD (no hay valor por defecto por seguridad)."
+        )
+    connect_kwargs = dict(
+        host=settings.db_host,
+        port=settings.db_port,
+        database=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password,
+    )
+
+    max_size = settings.db_pool_max
+    if max_size is None:
+        bootstrap = await asyncpg.connect(**connect_kwargs)
+        try:
+            rows = await bootstrap.fetch(
+                "SELECT name, setting::int AS value FROM pg_settings "
+                "WHERE name IN ('max_connections', 'superuser_reserved_connections')"
+            )
+        finally:
+            await bootstrap.close()
+        server = {r["name"]: r["value"] for r in rows}
+        max_size = compute_pool_size(
+            server.get("max_connections", 100),
+            server.get("superuser_reserved_connections", 3),
+            settings.pool_percent,
+            settings.replicas,
+        )
+    # El mínimo se acota: con max_connections altos (p.ej. 10000 en compose) no queremos
+    # abrir cientos de conexiones ociosas al arrancar.
+    min_size = settings.db_pool_min if settings.db_pool_min is not None else max(2, min(10, max_size // 4))
+    min_size = min(min_size, max_size)
+    logger.info(f"Pool PostgreSQL: min_size={min_size}, max_size={max_size} (replicas={settings.replicas})")
+
+    _pool = await asyncpg.create_pool(
+        **connect_kwargs,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=300,
+        statement_cache_size=1024,
+        init=_init_connection,
+    )
+    if settings.redis_url:
+        _redis = aioredis.from_url(settings.redis_url)
+        logger.info("Caché Redis activada para /chats, /chats/{id}/messages y /stats/queue")
+    async with _pool.acquire() as conn:
+        exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", "public.chat_preferences")
+        if not exists:
+            raise RuntimeError(
+                "Falta la tabla 'chat_preferences'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
+            )
+        _messages_tsv_available = await conn.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = 'public' AND table_name = 'messages' AND column_name = 'text_tsv'
+            )
+            """
+        )
+        if not _messages_tsv_available:
+            logger.warning("messages.text_tsv no existe: la búsqueda entre comillas usará ILIKE.")
+        # Los índices no son obligatorios para funcionar, pero sin ellos las consultas del API
+        # degeneran a seq scans: avisamos para que se creen (ver postgres/init_db.sql).
+        for index_name in _EXPECTED_INDEXES:
+            if not await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", f"public.{index_name}"):
+                logger.warning(
+                    f"Falta el índice '{index_name}'. Créalo con CREATE INDEX CONCURRENTLY (ver postgres/init_db.sql)."
                 )
-    finally:
-        pool.putconn(conn)
 
 
-@app.on_event("shutdown")
 async def shutdown_event():
-    global _pool
+    global _pool, _redis
     if _pool:
-        _pool.closeall()
+        await _pool.close()
         _pool = None
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
 
 
-@app.get("/health")
+@router.get("/health")
 async def health():
     return {"status": "ok"}
 
 
-@app.get("/stats/queue", response_model=dict)
-async def queue_stats(conn=Depends(db_dep)):
+# Caché corta para /stats/queue: varias pestañas del panel sondean cada pocos segundos.
+# El lock coalesce las peticiones concurrentes en una sola consulta a la BD.
+_stats_cache: Dict[str, Any] = {"ts": 0.0, "val": None, "lock": asyncio.Lock()}
+
+
+@router.get("/stats/queue", response_model=dict)
+@cached("stats_queue", ttl=lambda **kw: kw["request"].app.state.settings.stats_cache_ttl, key_fn=lambda **kw: {})
+async def queue_stats(request: Request):
+    ttl = request.app.state.settings.stats_cache_ttl
+    if _stats_cache["val"] is not None and time.monotonic() - _stats_cache["ts"] < ttl:
+        return _stats_cache["val"]
+    async with _stats_cache["lock"]:
+        if _stats_cache["val"] is not None and time.monotonic() - _stats_cache["ts"] < ttl:
+            return _stats_cache["val"]
+        async with get_pool().acquire() as conn:
+            val = await _fetch_queue_stats(conn)
+        _stats_cache["val"] = val
+        _stats_cache["ts"] = time.monotonic()
+        return val
+
+
+async def _fetch_queue_stats(conn) -> dict:
     # Nota: queremos que el contador de 'pending' refleje solo las descargas
     # procesables. Si un chat tiene media desactivada (chat_preferences.media_download_enabled = FALSE)
     # esas filas 'pending' siguen existiendo en download_queue, pero el worker no las consumirá.
     # Aquí las excluimos del conteo de 'pending' para que el panel muestre la cola efectiva.
 
-    with conn.cursor() as cur:
-        # Pending TOTAL (sin filtrar por preferencias), útil para UI
-        cur.execute("SELECT COUNT(*) AS total FROM download_queue WHERE status = 'pending';")
-        pending_total = int(cur.fetchone()["total"])
-
-        cur.execute(
-            """
-            SELECT dq.status, COUNT(*) AS total
-            FROM download_queue dq
-            LEFT JOIN chat_preferences cp
-              ON cp.chat_id = dq.chat_id AND cp.account_phone = dq.account_phone
-            WHERE dq.status <> 'pending'
-               OR COALESCE(cp.media_download_enabled, TRUE) = TRUE
-            GROUP BY dq.status
-            ORDER BY dq.status;
-            """
-        )
-        stats = cur.fetchall()
-
-        cur.execute(
-            """
-            SELECT dq.status, COUNT(*) AS older_10m
+    # Una sola consulta: el JOIN con chat_preferences se evalúa una vez (CTE materializada)
+    # y de ahí salen pending_total (sin filtrar por preferencias, útil para UI), stats y aging.
+    payload = await conn.fetchval(
+        """
+        WITH q AS (
+            SELECT dq.status, dq.updated_at,
+                   COALESCE(cp.media_download_enabled, TRUE) AS enabled
             FROM download_queue dq
             LEFT JOIN chat_preferences cp
               ON cp.chat_id = dq.chat_id AND cp.account_phone = dq.account_phone
-            WHERE dq.updated_at < NOW() - INTERVAL '10 minutes'
-              AND (
-                dq.status <> 'pending'
-                OR COALESCE(cp.media_download_enabled, TRUE) = TRUE
-              )
-            GROUP BY dq.status
-            ORDER BY dq.status;
-            """
         )
-        aging = cur.fetchall()
-
-    return {"stats": stats, "aging": aging, "pending_total": pending_total}
+        SELECT json_build_object(
+            'pending_total', (SELECT COUNT(*) FROM q WHERE status = 'pending'),
+            'stats', COALESCE((
+                SELECT json_agg(row_to_json(t) ORDER BY t.status)
+                FROM (
+                    SELECT status, COUNT(*) AS total
+                    FROM q
+                    WHERE status <> 'pending' OR enabled
+                    GROUP BY status
+                ) t
+            ), '[]'::json),
+            'aging', COALESCE((
+                SELECT json_agg(row_to_json(t) ORDER BY t.status)
+                FROM (
+                    SELECT status, COUNT(*) AS older_10m
+                    FROM q
+                    WHERE updated_at < NOW() - INTERVAL '10 minutes'
+                      AND (status <> 'pending' OR enabled)
+                    GROUP BY status
+                ) t
+            ), '[]'::json)
+        ) AS payload;
+        """
+    )
+    return payload
 
 
-@app.get("/chats", response_model=List[Chat])
+@router.get("/chats", response_model=List[Chat])
+@cached(
+    "chats",
+    ttl=10,
+    key_fn=lambda **kw: {k: kw[k] for k in ("account", "chat_id", "chat_type", "search", "limit", "offset")},
+)
 async def list_chats(
     account: Optional[str] = Query(None, description="Filtro por línea"),
     chat_id: Optional[int] = Query(None, description="Filtro por ID de chat"),
@@ -280,44 +597,110 @@ async def list_chats(
     search: Optional[str] = Query(None, description="Buscar en título/username"),
     limit: int = Query(50, le=200),
     offset: int = Query(0, ge=0),
-    conn=Depends(db_dep),
 ):
-    clauses = []
-    params = []
-    if account:
-        clauses.append("c.account_phone = %s")
-        params.append(account)
-    if chat_id is not None:
-        clauses.append("c.chat_id = %s")
-        params.append(chat_id)
-    if chat_type:
-        clauses.append("c.chat_type = %s")
-        params.append(chat_type)
-    if search:
-        clauses.append("(lower(c.title) LIKE %s OR lower(c.username) LIKE %s)")
-        like = f"%{search.lower()}%"
-        params.extend([like, like])
-    where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
-    sql = f"""
+    # SQL estático: los filtros ausentes se pasan como NULL para que el texto (y el plan
+    # cacheado por asyncpg) sea siempre el mismo.
+    sql = """
         SELECT c.chat_id, c.account_phone, c.title, c.chat_type,
                TO_CHAR(MAX(m.created_at), 'YYYY-MM-DD HH24:MI:SS') AS last_msg,
                COALESCE(p.media_download_enabled, TRUE) AS media_download_enabled
         FROM chats c
         LEFT JOIN messages m ON m.chat_id = c.chat_id AND m.account_phone = c.account_phone
         LEFT JOIN chat_preferences p ON p.chat_id = c.chat_id AND p.account_phone = c.account_phone
-        {where_sql}
+        WHERE ($1::text IS NULL OR c.account_phone = $1)
+          AND ($2::bigint IS NULL OR c.chat_id = $2)
+          AND ($3::text IS NULL OR c.chat_type = $3)
+          AND ($4::text IS NULL OR lower(c.title) LIKE $4 OR lower(c.username) LIKE $4)
         GROUP BY c.chat_id, c.account_phone, c.title, c.chat_type, p.media_download_enabled
         ORDER BY last_msg DESC NULLS LAST
-        LIMIT %s OFFSET %s
+        LIMIT $5 OFFSET $6
     """
-    params.extend([limit, offset])
-    with conn.cursor() as cur:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-    return rows
+    like = f"%{search.lower()}%" if search else None
+    # La conexión se pide aquí y no por Depends: un acierto de caché no toca el pool
+    async with get_pool().acquire() as conn:
+        rows = await conn.fetch(sql, account or None, chat_id, chat_type or None, like, limit, offset)
+    return ORJSONResponse([dict(r) for r in rows])
+
+
+def _build_chat_messages_around_sql(include_logs: bool) -> str:
+    log_column = _MESSAGE_LOG_COLUMN if include_logs else ""
+    log_join = _MESSAGE_LOG_JOIN if include_logs else ""
+    return f"""
+            (SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
+                    TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+                    s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name,
+                    0 AS half{log_column}
+             FROM messages m
+             LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
+             {log_join}
+             WHERE m.chat_id = $1 AND m.account_phone = $2 AND m.msg_id <= $3
+               AND ((m.media_type IS NULL OR m.media_type != 'unrecoverable') OR m.msg_id = $3)
+             ORDER BY m.msg_id DESC
+             LIMIT $5)
+            UNION ALL
+            (SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
+                    TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+                    s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name,
+                    1 AS half{log_column}
+             FROM messages m
+             LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
+             {log_join}
+             WHERE m.chat_id = $1 AND m.account_phone = $2 AND m.msg_id > $3
+               AND ((m.media_type IS NULL OR m.media_type != 'unrecoverable') OR m.msg_id = $3)
+             ORDER BY m.msg_id ASC
+             LIMIT $4)
+        """
 
 
-@app.get("/chats/{chat_id}/messages", response_model=Dict[str, Any])
+def _build_chat_messages_sql(filters: frozenset, include_logs: bool) -> str:
+    clauses = ["m.chat_id = %s", "m.account_phone = %s"]
+    if "before_id" in filters:
+        clauses.append("m.msg_id < %s")
+    if "after_id" in filters:
+        clauses.append("m.msg_id > %s")
+    # Siempre filtrar mensajes unrecoverable a nivel de SQL
+    clauses.append("(m.media_type IS NULL OR m.media_type != 'unrecoverable')")
+    log_column = _MESSAGE_LOG_COLUMN if include_logs else ""
+    log_join = _MESSAGE_LOG_JOIN if include_logs else ""
+    return _pg(f"""
+            SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
+                   TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+                   s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name{log_column}
+            FROM messages m
+            LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
+            {log_join}
+            WHERE {" AND ".join(clauses)}
+            ORDER BY m.msg_id DESC
+            LIMIT %s
+        """)
+
+
+# Todas las variantes (2^filtros x include_logs) se compilan una vez al importar: cada
+# combinación tiene siempre el mismo texto y reutiliza el prepared statement de asyncpg.
+_CHAT_MESSAGES_AROUND_SQL = {logs: _build_chat_messages_around_sql(logs) for logs in (False, True)}
+_CHAT_MESSAGES_SQL = {
+    (filters, logs): _build_chat_messages_sql(filters, logs)
+    for filters in (
+        frozenset(),
+        frozenset({"before_id"}),
+        frozenset({"after_id"}),
+        frozenset({"before_id", "after_id"}),
+    )
+    for logs in (False, True)
+}
+
+
+@router.get("/chats/{chat_id}/messages", response_model=Dict[str, Any])
+@cached(
+    "chat_messages",
+    ttl=3,
+    # Solo la primera página (la que se pide al abrir un chat); el resto de cursores no se cachea
+    key_fn=lambda **kw: (
+        {k: kw[k] for k in ("chat_id", "account", "limit", "include_logs")}
+        if kw["before_id"] is None and kw["after_id"] is None and kw["around_id"] is None
+        else None
+    ),
+)
 async def list_chat_messages(
     chat_id: int,
     account: str = Query(..., description="Línea (account_phone)"),
@@ -326,186 +709,110 @@ async def list_chat_messages(
     around_id: Optional[int] = Query(None, description="msg_id central - carga mensajes alrededor de este ID"),
     limit: int = Query(100, le=1000),
     include_logs: bool = Query(True),
-    conn=Depends(db_dep),
 ):
-    # Si se especifica around_id, cargar mensajes alrededor de ese ID
-    if around_id:
-        # Cargar limit/2 mensajes antes y limit/2 después del ID objetivo
-        half_limit = limit // 2
-        
-        clauses = ["m.chat_id = %s", "m.account_phone = %s"]
-        params = [chat_id, account]
-        
-        where_sql = "WHERE " + " AND ".join(clauses)
+    # La conexión se pide aquí y no por Depends: un acierto de caché no toca el pool
+    async with get_pool().acquire() as conn:
+        # Si se especifica around_id, cargar mensajes alrededor de ese ID
+        if around_id:
+            # Cargar limit/2 mensajes antes y limit/2 después del ID objetivo
+            half_limit = limit // 2
         
-        # Obtener mensajes antes del ID (incluyendo el mensaje objetivo)
-        sql_before = f"""
-            SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
-                   TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
-                   s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name
-            FROM messages m
-            LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
-            {where_sql} AND m.msg_id <= %s
-            AND ((m.media_type IS NULL OR m.media_type != 'unrecoverable') OR m.msg_id = %s)
-            ORDER BY m.msg_id DESC
-            LIMIT %s
-        """
-        
-        # Obtener mensajes después del ID
-        sql_after = f"""
-            SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
-                   TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
-                   s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name
-            FROM messages m
-            LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
-            {where_sql} AND m.msg_id > %s
-            AND ((m.media_type IS NULL OR m.media_type != 'unrecoverable') OR m.msg_id = %s)
-            ORDER BY m.msg_id ASC
-            LIMIT %s
-        """
-        
-        messages = []
-        with conn.cursor() as cur:
-            # Obtener mensajes antes (incluyendo el objetivo)
-            cur.execute(sql_before, params + [around_id, around_id, half_limit])
-            messages_before = cur.fetchall()
-            
-            # Obtener mensajes después
-            cur.execute(sql_after, params + [around_id, around_id, half_limit])
-            messages_after = cur.fetchall()
-            
+            # Ambas mitades en un único viaje: "half" = 0 para antes (incluyendo el objetivo), 1 para después
+            sql = _CHAT_MESSAGES_AROUND_SQL[include_logs]
+            messages_before = []
+            messages_after = []
+            # La mitad "antes" lee una fila de más: si llega, hay mensajes más antiguos disponibles
+            for r in await conn.fetch(sql, chat_id, account, around_id, half_limit, half_limit + 1):
+                row = dict(r)
+                (messages_after if row.pop("half") else messages_before).append(row)
+            more_available = len(messages_before) > half_limit
+            messages_before = messages_before[:half_limit]
+
             # Combinar y devolver en DESC (newest first) como el resto del API
             # messages_before ya está en DESC
             # messages_after está en ASC, hay que invertirlo y ponerlo ANTES de messages_before
             messages = list(reversed(messages_after)) + messages_before
-            
-        print(f"DEBUG around_id={around_id}: {len(messages_before)} before + {len(messages_after)} after = {len(messages)} total")
-        
-    else:
-        # Lógica original con before_id/after_id
-        clauses = ["m.chat_id = %s", "m.account_phone = %s"]
-        params = [chat_id, account]
-        if before_id:
-            clauses.append("m.msg_id < %s")
-            params.append(before_id)
-        if after_id:
-            clauses.append("m.msg_id > %s")
-            params.append(after_id)
-        
-        # Siempre filtrar mensajes unrecoverable a nivel de SQL
-        clauses.append("(m.media_type IS NULL OR m.media_type != 'unrecoverable')")
-        
-        where_sql = "WHERE " + " AND ".join(clauses)
-        
-        sql = f"""
-            SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
-                   TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
-                   s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name
-            FROM messages m
-            LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
-            {where_sql}
-            ORDER BY m.msg_id DESC
-            LIMIT %s
-        """
-        params.append(limit)
-        messages = []
-        with conn.cursor() as cur:
-            # Debug logging
-            print(f"DEBUG SQL: {sql}")
-            print(f"DEBUG PARAMS: {params}")
-            cur.execute(sql, params)
-            messages = cur.fetchall()
-            print(f"DEBUG RESULTS: {len(messages)} messages")
-
-    if include_logs and messages:
-        msg_ids = [m["msg_id"] for m in messages]
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT telegram_msg_id AS msg_id, chat_id, text, media_type,
-                       TO_CHAR(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at
-                FROM message_log
-                WHERE chat_id = %s AND telegram_msg_id = ANY(%s)
-                ORDER BY created_at DESC
-                """,
-                (chat_id, msg_ids),
-            )
-            logs = cur.fetchall()
-        log_map = {}
-        for log in logs:
-            log_map.setdefault(log["msg_id"], []).append(log)
-        for m in messages:
-            m["log"] = log_map.get(m["msg_id"], [])
-    
-    # Verificar si hay más mensajes disponibles
-    # Necesitamos buscar el siguiente mensaje válido (no unrecoverable)
-    more_available = False
-    if messages:
-        last_msg_id = messages[-1]["msg_id"]
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT COUNT(*) as count
-                FROM messages m
-                WHERE m.chat_id = %s AND m.account_phone = %s 
-                  AND m.msg_id < %s
-                  AND (m.media_type IS NULL OR m.media_type != 'unrecoverable')
-                LIMIT 1
-                """,
-                (chat_id, account, last_msg_id)
-            )
-            result = cur.fetchone()
-            more_available = result["count"] > 0
-    
-    return {"messages": messages, "more": more_available}
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "around_id=%s: %d before + %d after = %d total",
+                    around_id, len(messages_before), len(messages_after), len(messages),
+                )
+        else:
+            # Lógica original con before_id/after_id: se elige la variante ya compilada según los filtros
+            filters = {"before_id": before_id, "after_id": after_id}
+            active = frozenset(k for k, v in filters.items() if v)
+            sql = _CHAT_MESSAGES_SQL[(active, include_logs)]
+            params = [chat_id, account] + [filters[k] for k in ("before_id", "after_id") if k in active]
+            # Se pide una fila de más para saber si hay más mensajes sin otra consulta
+            params.append(limit + 1)
+            messages = await _fetch_dicts(conn, sql, *params)
+            more_available = len(messages) > limit
+            messages = messages[:limit]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("sql=%s params=%s -> %d messages", sql, params, len(messages))
+
+    return ORJSONResponse({"messages": messages, "more": more_available})
+
+
+_UPSERT_CHAT_PREFERENCE_SQL = """
+    INSERT INTO chat_preferences (chat_id, account_phone, media_download_enabled)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (chat_id, account_phone)
+    DO UPDATE SET media_download_enabled = EXCLUDED.media_download_enabled
+"""
+
+
+@router.patch("/chats/settings")
+async def update_chats_settings_bulk(body: List[ChatSettingsBulkItem], conn=Depends(db_dep)):
+    """Aplica preferencias de varios chats a la vez (una transacción, un executemany)."""
+    if not body:
+        return {"updated": 0}
+    if any(not item.account for item in body):
+        raise HTTPException(status_code=400, detail="account is required")
+    async with conn.transaction():
+        await conn.executemany(
+            _UPSERT_CHAT_PREFERENCE_SQL,
+            [(item.chat_id, item.account, item.media_download_enabled) for item in body],
+        )
+    await _invalidate_cached("chats")
+    return {"updated": len(body)}
 
 
-@app.patch("/chats/{chat_id}/settings")
+@router.patch("/chats/{chat_id}/settings")
 async def update_chat_settings(chat_id: int, body: ChatSettingsUpdate, account: Optional[str] = Query(None), conn=Depends(db_dep)):
     if not account:
         raise HTTPException(status_code=400, detail="account is required")
-    with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO chat_preferences (chat_id, account_phone, media_download_enabled)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (chat_id, account_phone)
-            DO UPDATE SET media_download_enabled = EXCLUDED.media_download_enabled
-            """,
-            (chat_id, account, body.media_download_enabled),
-        )
-        conn.commit()
+    await conn.execute(_UPSERT_CHAT_PREFERENCE_SQL, chat_id, account, body.media_download_enabled)
+    await _invalidate_cached("chats")
     return {"chat_id": chat_id, "account": account, "media_download_enabled": body.media_download_enabled}
 
 
-@app.get("/downloads", response_model=List[DownloadItem])
+@router.get("/downloads", response_model=List[DownloadItem])
 async def list_downloads(
     status: Optional[str] = Query(None),
     chat_id: Optional[int] = Query(None),
     limit: int = Query(50, le=200),
-    offset: int = Query(0, ge=0),
+    offset: int = Query(0, ge=0, description="Obsoleto: usar cursor (X-Next-Cursor)"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente (cabecera X-Next-Cursor)"),
     conn=Depends(db_dep),
 ):
-    clauses = []
-    params = []
-    if status:
-        clauses.append("status = %s")
-        params.append(status)
-    if chat_id:
-        clauses.append("chat_id = %s")
-        params.append(chat_id)
-    where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
-    sql = f"""
+    sql = """
         SELECT dq.id,
                dq.chat_id,
                dq.msg_id,
-               m.account_phone,
+               -- Fallback: si el mensaje no tiene account_phone, se toma del path
+               -- (/app/media_downloads/<account>/<chat>/...)
+               COALESCE(
+                   NULLIF(m.account_phone, ''),
+                   CASE WHEN split_part(dq.path, '/', 4) LIKE '+%' THEN split_part(dq.path, '/', 4) END
+               ) AS account_phone,
                m.sender_id,
                m.media_type,
-               m.media_file_path,
+               regexp_replace(COALESCE(NULLIF(dq.path, ''), m.media_file_path), '^.*/', '') AS file_name,
                dq.status,
                dq.path,
-               TO_CHAR(dq.updated_at, 'YYYY-MM-DD HH24:MI:SS') AS updated_at
+               TO_CHAR(dq.updated_at, 'YYYY-MM-DD HH24:MI:SS') AS updated_at,
+               dq.updated_at AS cursor_ts
         FROM download_queue dq
         LEFT JOIN LATERAL (
             SELECT account_phone, sender_id, media_type, media_file_path
@@ -514,66 +821,45 @@ async def list_downloads(
             ORDER BY account_phone
             LIMIT 1
         ) m ON TRUE
-        {where_sql}
-        ORDER BY dq.updated_at DESC
-        LIMIT %s OFFSET %s
+        WHERE ($1::text IS NULL OR dq.status = $1)
+          AND ($2::bigint IS NULL OR dq.chat_id = $2)
+          AND ($6::int IS NULL
+               OR ($5::text IS NULL AND (dq.updated_at IS NOT NULL OR dq.id < $6::int))
+               OR (dq.updated_at, dq.id) < ($5::text::timestamp, $6::int))
+        ORDER BY dq.updated_at DESC, dq.id DESC
+        LIMIT $3 OFFSET $4
     """
-    params.extend([limit, offset])
-    with conn.cursor() as cur:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+    cursor_ts, cursor_id = _decode_cursor(cursor, ("int",)) if cursor else (None, None)
+    rows = [dict(r) for r in await conn.fetch(sql, status or None, chat_id or None, limit, offset, cursor_ts, cursor_id)]
+    return _rows_response(rows, limit, ("id",))
 
-    # Fallback: si no hay account_phone pero el path la incluye (/app/media_downloads/<account>/<chat>/...)
-    for r in rows:
-        try:
-            if (not r.get("account_phone")) and r.get("path"):
-                parts = str(r["path"]).split("/")
-                # ['', 'app', 'media_downloads', '+3467...', '-100...', ...]
-                if len(parts) >= 4 and parts[3].startswith("+"):
-                    r["account_phone"] = parts[3]
-        except Exception:
-            pass
-
-        try:
-            # file_name: prefer path basename; else fallback to media_file_path basename
-            p = r.get("path") or r.get("media_file_path")
-            if p and not r.get("file_name"):
-                r["file_name"] = os.path.basename(str(p))
-        except Exception:
-            pass
-
-        # El response_model no incluye media_file_path: lo eliminamos si viene del SQL
-        if "media_file_path" in r:
-            r.pop("media_file_path", None)
 
-    return rows
-
-
-@app.get("/chats/{chat_id}/media", response_model=List[DownloadItem])
+@router.get("/chats/{chat_id}/media", response_model=List[DownloadItem])
 async def list_chat_media(
     chat_id: int,
     status: Optional[str] = Query("done"),
     limit: int = Query(50, le=200),
-    offset: int = Query(0, ge=0),
+    offset: int = Query(0, ge=0, description="Obsoleto: usar cursor (X-Next-Cursor)"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente (cabecera X-Next-Cursor)"),
     conn=Depends(db_dep),
 ):
-    clauses = ["chat_id = %s"]
-    params = [chat_id]
-    if status:
-        clauses.append("status = %s")
-        params.append(status)
-    where_sql = "WHERE " + " AND ".join(clauses)
-    sql = f"""
+    sql = """
         SELECT dq.id,
                dq.chat_id,
                dq.msg_id,
-               m.account_phone,
+               -- Fallback: si el mensaje no tiene account_phone, se toma del path
+               -- (/app/media_downloads/<account>/<chat>/...)
+               COALESCE(
+                   NULLIF(m.account_phone, ''),
+                   CASE WHEN split_part(dq.path, '/', 4) LIKE '+%' THEN split_part(dq.path, '/', 4) END
+               ) AS account_phone,
                m.sender_id,
                m.media_type,
-               m.media_file_path,
+               regexp_replace(COALESCE(NULLIF(dq.path, ''), m.media_file_path), '^.*/', '') AS file_name,
                dq.status,
                dq.path,
-               TO_CHAR(dq.updated_at, 'YYYY-MM-DD HH24:MI:SS') AS updated_at
+               TO_CHAR(dq.updated_at, 'YYYY-MM-DD HH24:MI:SS') AS updated_at,
+               dq.updated_at AS cursor_ts
         FROM download_queue dq
         LEFT JOIN LATERAL (
             SELECT account_phone, sender_id, media_type, media_file_path
@@ -582,38 +868,58 @@ async def list_chat_media(
             ORDER BY account_phone
             LIMIT 1
         ) m ON TRUE
-        {where_sql}
-        ORDER BY dq.updated_at DESC
-        LIMIT %s OFFSET %s
+        WHERE dq.chat_id = $1
+          AND ($2::text IS NULL OR dq.status = $2)
+          AND ($6::int IS NULL
+               OR ($5::text IS NULL AND (dq.updated_at IS NOT NULL OR dq.id < $6::int))
+               OR (dq.updated_at, dq.id) < ($5::text::timestamp, $6::int))
+        ORDER BY dq.updated_at DESC, dq.id DESC
+        LIMIT $3 OFFSET $4
     """
-    params.extend([limit, offset])
-    with conn.cursor() as cur:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+    cursor_ts, cursor_id = _decode_cursor(cursor, ("int",)) if cursor else (None, None)
+    rows = [dict(r) for r in await conn.fetch(sql, chat_id, status or None, limit, offset, cursor_ts, cursor_id)]
+    return _rows_response(rows, limit, ("id",))
 
-    for r in rows:
-        try:
-            if (not r.get("account_phone")) and r.get("path"):
-                parts = str(r["path"]).split("/")
-                if len(parts) >= 4 and parts[3].startswith("+"):
-                    r["account_phone"] = parts[3]
-        except Exception:
-            pass
 
-        try:
-            p = r.get("path") or r.get("media_file_path")
-            if p and not r.get("file_name"):
-                r["file_name"] = os.path.basename(str(p))
-        except Exception:
-            pass
+def _build_search_messages_sql(tsv_available: bool) -> str:
+    # Sin la columna text_tsv (esquema antiguo) el predicado no puede referenciarla
+    tsv_match = "m.text_tsv @@ plainto_tsquery('simple', $13)" if tsv_available else "FALSE"
+    return f"""
+        SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
+               TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+               s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name,
+               s.is_bot AS sender_is_bot,
+               c.title AS chat_title, c.chat_type,
+               m.created_at AS cursor_ts
+        FROM messages m
+        LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
+        LEFT JOIN chats c ON m.chat_id = c.chat_id AND m.account_phone = c.account_phone
+        WHERE ($1::text IS NULL OR m.text ILIKE $1)
+          AND ($13::text IS NULL OR {tsv_match})
+          AND ($2::text IS NULL OR m.account_phone = $2)
+          AND ($3::bigint IS NULL OR m.chat_id = $3)
+          AND ($4::bigint IS NULL OR m.sender_id = $4)
+          AND ($5::text IS NULL OR s.username ILIKE $5)
+          AND ($6::text IS NULL OR c.chat_type = $6)
+          AND ($7::boolean IS NOT TRUE OR m.media_file_path IS NOT NULL)
+          AND ($8::text IS NULL OR m.media_type = $8)
+          -- Filtrar mensajes unrecoverable
+          AND (m.media_type IS NULL OR m.media_type != 'unrecoverable')
+          AND ($9::text IS NULL OR m.created_at >= $9::text::timestamp)
+          AND ($10::text IS NULL OR m.created_at <= $10::text::timestamp)
+          AND ($15::bigint IS NULL
+               OR ($14::text IS NULL AND (m.created_at IS NOT NULL
+                   OR (m.chat_id, m.msg_id, m.account_phone) < ($15::bigint, $16::bigint, $17::text)))
+               OR (m.created_at, m.chat_id, m.msg_id, m.account_phone) < ($14::text::timestamp, $15::bigint, $16::bigint, $17::text))
+        ORDER BY m.created_at DESC, m.chat_id DESC, m.msg_id DESC, m.account_phone DESC
+        LIMIT $11 OFFSET $12
+    """
 
-        if "media_file_path" in r:
-            r.pop("media_file_path", None)
 
-    return rows
+_SEARCH_MESSAGES_SQL = {tsv: _build_search_messages_sql(tsv) for tsv in (False, True)}
 
 
-@app.get("/search/messages", response_model=List[MessageItem])
+@router.get("/search/messages", response_model=List[MessageItem])
 async def search_messages(
     q: Optional[str] = Query(None, description="texto a buscar"),
     account: Optional[str] = Query(None, description="Número de cuenta"),
@@ -626,69 +932,67 @@ async def search_messages(
     date_from: Optional[str] = Query(None, description="Fecha desde (YYYY-MM-DD)"),
     date_to: Optional[str] = Query(None, description="Fecha hasta (YYYY-MM-DD)"),
     limit: int = Query(50, le=1000),
-    offset: int = Query(0, ge=0),
+    offset: int = Query(0, ge=0, description="Obsoleto: usar cursor (X-Next-Cursor)"),
+    cursor: Optional[str] = Query(None, description="Cursor de la página siguiente (cabecera X-Next-Cursor)"),
     conn=Depends(db_dep),
 ):
-    clauses = []
-    params = []
-    
-    # Búsqueda de texto
-    if q:
-        clauses.append("m.text ILIKE %s")
-        params.append(f"%{q}%")
-    
-    # Filtros específicos
-    if account:
-        clauses.append("m.account_phone = %s")
-        params.append(account)
-    if chat_id:
-        clauses.append("m.chat_id = %s")
-        params.append(chat_id)
-    if sender_id:
-        clauses.append("m.sender_id = %s")
-        params.append(sender_id)
-    if sender_username:
-        clauses.append("s.username ILIKE %s")
-        params.append(f"%{sender_username}%")
-    if chat_type:
-        clauses.append("c.chat_type = %s")
-        params.append(chat_type)
-    if media_only:
-        clauses.append("m.media_file_path IS NOT NULL")
-    if media_type:
-        clauses.append("m.media_type = %s")
-        params.append(media_type)
-    
-    # Filtrar mensajes unrecoverable
-    clauses.append("(m.media_type IS NULL OR m.media_type != 'unrecoverable')")
-    
-    # Filtros de fecha
-    if date_from:
-        clauses.append("m.created_at >= %s")
-        params.append(date_from)
-    if date_to:
-        clauses.append("m.created_at <= %s")
-        params.append(date_to)
-    
-    where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
-    
-    sql = f"""
-        SELECT m.msg_id, m.chat_id, m.account_phone, m.sender_id, m.text, m.media_type, m.media_file_path,
-               TO_CHAR(m.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
-               s.username AS sender_username, s.first_name AS sender_first_name, s.last_name AS sender_last_name,
-               s.is_bot AS sender_is_bot,
-               c.title AS chat_title, c.chat_type
-        FROM messages m
-        LEFT JOIN senders s ON m.sender_id = s.user_id AND m.account_phone = s.account_phone
-        LEFT JOIN chats c ON m.chat_id = c.chat_id AND m.account_phone = c.account_phone
-        {where_sql}
-        ORDER BY m.created_at DESC
-        LIMIT %s OFFSET %s
-    """
-    params.extend([limit, offset])
-    
-    with conn.cursor() as cur:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-    
-    return rows
+    # Plantilla única: cada filtro ausente llega como NULL, así asyncpg reutiliza el
+    # mismo prepared statement para cualquier combinación de filtros.
+    sql = _SEARCH_MESSAGES_SQL[_messages_tsv_available]
+    # q entre comillas ("palabra exacta") usa el índice full-text; el resto, ILIKE con trigramas
+    words = None
+    if q and q.startswith('"') and _messages_tsv_available:
+        words = q.strip('"').strip() or None
+        q = None
+    cursor_values = _decode_cursor(cursor, ("bigint", "bigint", "text")) if cursor else [None] * 4
+    rows = await _fetch_dicts(
+        conn,
+        sql,
+        f"%{q}%" if q else None,
+        account or None,
+        chat_id or None,
+        sender_id or None,
+        f"%{sender_username}%" if sender_username else None,
+        chat_type or None,
+        bool(media_only),
+        media_type or None,
+        date_from or None,
+        date_to or None,
+        limit,
+        offset,
+        words,
+        *cursor_values,
+    )
+    return _rows_response(rows, limit, ("chat_id", "msg_id", "account_phone"))
+
+
+@functools.lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings()
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """Construye la aplicación; sin argumentos usa la configuración del entorno (cacheada)."""
+    settings = settings or get_settings()
+    app = FastAPI(title="Telegram Monitor API", version="0.1.0", default_response_class=ORJSONResponse)
+    app.state.settings = settings
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=parse_cors_allow_origins(settings.cors_allow_origins),
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"],
+    )
+    app.include_router(router)
+    # Acceso directo a MEDIA_ROOT servido por Starlette (ETag/304 y lectura en streaming).
+    # StaticFiles ya impide salir del directorio; /media se mantiene para rutas absolutas.
+    app.mount("/static-media", StaticFiles(directory=settings.media_root, check_dir=False), name="media")
+
+    app.add_event_handler("startup", functools.partial(startup_event, settings))
+    app.add_event_handler("shutdown", shutdown_event)
+    return app
+
+
+app = create_app()
@@ -47,6 +47,8 @@ CREATE TABLE IF NOT EXISTS messages (
     has_log BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP,
     received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Búsqueda por palabras completas (q entre comillas en /search/messages)
+    text_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED,
     PRIMARY KEY (chat_id, msg_id, account_phone),
     FOREIGN KEY (chat_id, account_phone) REFERENCES chats (chat_id, account_phone) ON DELETE CASCADE
 );
@@ -133,3 +135,14 @@ CREATE INDEX IF NOT EXISTS idx_download_queue_chat ON download_queue(chat_id, ac
 CREATE INDEX IF NOT EXISTS idx_download_queue_file_unique ON download_queue(file_unique_id);
 CREATE INDEX IF NOT EXISTS idx_reactions_msg ON reactions(msg_id, chat_id, account_phone);
 CREATE INDEX IF NOT EXISTS idx_entities_msg ON entities(msg_id, chat_id, account_phone);
+
+-- Índices para las consultas calientes del API (paginación de mensajes, búsqueda, cola y logs).
+-- En una BD ya existente, crearlos a mano con CREATE INDEX CONCURRENTLY para no bloquear escrituras.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_messages_chat_acct_msg ON messages(chat_id, account_phone, msg_id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_text_trgm ON messages USING gin (text gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_download_queue_status_updated ON download_queue(status, updated_at DESC);
+CREATE INDEX IF NOT EXISTS idx_message_log_chat_tg ON message_log(chat_id, telegram_msg_id);
+CREATE INDEX IF NOT EXISTS idx_messages_text_tsv ON messages USING gin (text_tsv);
+CREATE INDEX IF NOT EXISTS idx_chats_title_trgm ON chats USING gin (lower(title) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_chats_username_trgm ON chats USING gin (lower(username) gin_trgm_ops);
@@ -1,8 +1,18 @@
 import psycopg2
 import psycopg2.extras
 import psycopg2.pool
+import atexit
+import io
+import itertools
 import json
 import os
+import queue
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Optional, Dict, Any, List
 from datetime import datetime
 import logging
@@ -27,69 +37,167 @@ DB_NAME = os.environ.get("DB_NAME") or os.environ.get("POSTGRES_DB") or "telegra
 DB_USER = os.environ.get("DB_USER") or os.environ.get("POSTGRES_USER") or "telegram"
 DB_PASSWORD = os.environ.get("DB_PASSWORD") or os.environ.get("POSTGRES_PASSWORD") or "telegram"
 
+# Parámetros de conexión resueltos una sola vez al importar
+_POOL_KWARGS: Dict[str, Any] = {"dsn": DATABASE_URL} if DATABASE_URL else {
+    "host": DB_HOST,
+    "port": DB_PORT,
+    "database": DB_NAME,
+    "user": DB_USER,
+    "password": DB_PASSWORD,
+}
+_CURSOR_FACTORY = psycopg2.extras.RealDictCursor
+
 # Connection pool
 _connection_pool = None
+_pool_semaphore: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+_POOL_TIMEOUT = float(os.environ.get("TG_DB_POOL_TIMEOUT", "30"))
+
+# Las funciones insert_*/update_* hacen commit por defecto; con commit=False el llamante
+# agrupa varias escrituras (p.ej. todo un evento de Telegram) en una sola transacción.
+
+# Filas por viaje en las escrituras por lotes (execute_batch/execute_values)
+_BATCH_PAGE_SIZE = 500
 
 # El esquema debe ser creado por el contenedor PostgreSQL (init_db.sql).
-# Aquí solo validamos su presencia para evitar que el cliente haga DDL.
-_schema_checks = {
-    "chat_preferences_table": False,
-    "download_queue_account_phone": False,
-}
+# Aquí solo validamos su presencia (una vez, al crear el pool) para evitar que el cliente haga DDL.
+_SCHEMA_PROBE_SQL = """
+    SELECT
+        to_regclass('public.chat_preferences') IS NOT NULL,
+        to_regclass('public.download_queue') IS NOT NULL,
+        EXISTS (
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = 'download_queue' AND column_name = 'account_phone'
+        )
+"""
 
 
-def _table_exists(conn, table_name: str) -> bool:
+def _ensure_schema(conn) -> None:
+    """Valida en una sola consulta las tablas/columnas que el cliente necesita."""
     with conn.cursor() as cur:
-        cur.execute("SELECT to_regclass(%s)", (f"public.{table_name}",))
-        row = cur.fetchone()
-    return bool(row and list(row.values())[0])
+        cur.execute(_SCHEMA_PROBE_SQL)
+        has_preferences, has_queue, has_queue_account = cur.fetchone()
+    conn.rollback()
+    if not has_preferences:
+        raise RuntimeError(
+            "Falta la tabla 'chat_preferences'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
+        )
+    if not has_queue:
+        raise RuntimeError(
+            "Falta la tabla 'download_queue'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
+        )
+    if not has_queue_account:
+        raise RuntimeError(
+            "Falta la columna 'download_queue.account_phone'. Actualiza el esquema en PostgreSQL (postgres/init_db.sql) o aplica la migración correspondiente."
+        )
 
 
-def _column_exists(conn, table_name: str, column_name: str) -> bool:
+def _server_connection_limit(conn) -> int:
+    """Conexiones utilizables del servidor (max_connections menos las reservadas)."""
+    override = os.environ.get("POSTGRES_MAX_CONNECTIONS")
+    if override:
+        return int(override)
     with conn.cursor() as cur:
         cur.execute(
-            """
-            SELECT 1
-            FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = %s AND column_name = %s
-            LIMIT 1
-            """,
-            (table_name, column_name),
+            "SELECT name, setting::int FROM pg_settings "
+            "WHERE name IN ('max_connections', 'superuser_reserved_connections')"
         )
-        return cur.fetchone() is not None
+        server = dict(cur.fetchall())
+    conn.rollback()
+    return max(0, server.get("max_connections", 100) - server.get("superuser_reserved_connections", 3))
+
 
 def _get_pool():
-    """Obtiene el pool de conexiones (singleton)."""
-    global _connection_pool
-    if _connection_pool is None:
-        if DATABASE_URL:
-            _connection_pool = psycopg2.pool.SimpleConnectionPool(
-                20, 10000, dsn=DATABASE_URL  # 64 clientes × 25 concurrentes = 1,600 max, pool de 10K para más que suficiente
-            )
-        else:
-            _connection_pool = psycopg2.pool.SimpleConnectionPool(
-                20, 10000,  # 64 clientes × 25 concurrentes = 1,600 max, pool de 10K para más que suficiente
-                host=DB_HOST,
-                port=DB_PORT,
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD
-            )
+    """Obtiene el pool de conexiones (singleton, seguro entre hilos).
+
+    ThreadedConnectionPool + semáforo acotado: al agotarse el pool, get_db_connection
+    espera hasta TG_DB_POOL_TIMEOUT segundos en vez de fallar en el acto.
+    TG_DB_POOL_MAX fija el máximo; si no, se usa TG_DB_POOL_PERCENT de las conexiones
+    del servidor (POSTGRES_MAX_CONNECTIONS o SHOW max_connections) repartido entre las
+    TG_CLIENT_INSTANCES instancias del cliente.
+    """
+    global _connection_pool, _pool_semaphore
+    if _connection_pool is not None:
+        return _connection_pool
+    with _pool_lock:
+        if _connection_pool is not None:
+            return _connection_pool
+        probe = psycopg2.connect(**_POOL_KWARGS)
+        try:
+            _ensure_schema(probe)
+            if os.environ.get("TG_DB_POOL_MAX"):
+                max_size = int(os.environ["TG_DB_POOL_MAX"])
+            else:
+                # Presupuesto compartido con la API (DB_POOL_PERCENT): entre ambos, como mucho 1
+                percent = float(os.environ.get("TG_DB_POOL_PERCENT", "0.3"))
+                instances = max(1, int(os.environ.get("TG_CLIENT_INSTANCES", "1")))
+                max_size = max(4, int(_server_connection_limit(probe) * percent / instances))
+        finally:
+            probe.close()
+        min_size = min(int(os.environ.get("TG_DB_POOL_MIN", "20")), max_size)
+        logger.info(f"Pool PostgreSQL: min={min_size}, max={max_size}")
+        _pool_semaphore = threading.BoundedSemaphore(max_size)
+        _connection_pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, **_POOL_KWARGS)
     return _connection_pool
 
 
-def get_db_connection():
-    """Obtiene conexión a BD desde el pool."""
+def get_db_connection(rows: str = "dict"):
+    """Obtiene conexión a BD desde el pool.
+
+    rows="dict" devuelve filas RealDictRow; rows="tuple" deja el cursor por defecto
+    (sin crear un dict por fila), pensado para rutas de solo escritura.
+    """
     pool = _get_pool()
-    conn = pool.getconn()
-    conn.cursor_factory = psycopg2.extras.RealDictCursor
+    if not _pool_semaphore.acquire(timeout=_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"Pool de conexiones agotado tras {_POOL_TIMEOUT}s de espera")
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_semaphore.release()
+        raise
+    conn.cursor_factory = _CURSOR_FACTORY if rows == "dict" else None
     return conn
 
 
 def close_db_connection(conn):
     """Devuelve conexión al pool."""
     pool = _get_pool()
-    pool.putconn(conn)
+    try:
+        pool.putconn(conn)
+    finally:
+        _pool_semaphore.release()
+
+
+@contextmanager
+def db_conn(rows: str = "dict"):
+    """Presta una conexión del pool y la devuelve al salir (ver get_db_connection)."""
+    conn = get_db_connection(rows)
+    try:
+        yield conn
+    finally:
+        close_db_connection(conn)
+
+
+# Sentencias ya preparadas (PREPARE) en cada conexión física del pool
+_prepared_statements: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def _execute_prepared(cur, name: str, sql: str, params: tuple) -> None:
+    """Ejecuta sql (placeholders %s) como sentencia preparada con nombre en la conexión del cursor.
+
+    La primera vez en cada conexión se envía el PREPARE; después solo EXECUTE con los
+    parámetros, sin volver a mandar ni analizar el texto de la sentencia.
+    """
+    conn = cur.connection
+    with _prepared_lock:
+        prepared = _prepared_statements.setdefault(conn, set())
+    if name not in prepared:
+        counter = itertools.count(1)
+        cur.execute(f"PREPARE {name} AS " + re.sub(r"%s", lambda _m: f"${next(counter)}", sql))
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
 
 
 def _init_schema(conn):
@@ -101,37 +209,54 @@ def _init_schema(conn):
     conn.commit()
 
 
+# %s = VALUES: una fila (insert_or_update_chat) o el marcador de execute_values (flush_chats)
+_UPSERT_CHAT_SQL = """
+    INSERT INTO chats (chat_id, username, title, chat_type, account_phone)
+    VALUES %s
+    ON CONFLICT (chat_id, account_phone) DO UPDATE SET
+        username = EXCLUDED.username,
+        title = EXCLUDED.title,
+        chat_type = EXCLUDED.chat_type,
+        updated_at = CURRENT_TIMESTAMP
+    -- Metadatos repetidos: sin cambios no se reescribe la fila (ni WAL ni tupla muerta)
+    WHERE (chats.username, chats.title, chats.chat_type)
+        IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.title, EXCLUDED.chat_type)
+"""
+
+
 def insert_or_update_chat(conn, chat_id: int, username: Optional[str], 
-                          title: Optional[str], chat_type: str, account_phone: str):
+                          title: Optional[str], chat_type: str, account_phone: str, *, commit: bool = True):
     """Inserta o actualiza un chat."""
     with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO chats (chat_id, username, title, chat_type, account_phone, updated_at)
-            VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (chat_id, account_phone) DO UPDATE SET
-                username = EXCLUDED.username,
-                title = EXCLUDED.title,
-                chat_type = EXCLUDED.chat_type,
-                updated_at = CURRENT_TIMESTAMP
-        """, (chat_id, username, title, chat_type, account_phone))
-    conn.commit()
+        cur.execute(_UPSERT_CHAT_SQL % "(%s, %s, %s, %s, %s)",
+                    (chat_id, username, title, chat_type, account_phone))
+    if commit:
+        conn.commit()
+
+
+_UPSERT_SENDER_SQL = """
+    INSERT INTO senders (user_id, username, first_name, last_name, is_bot, account_phone)
+    VALUES %s
+    ON CONFLICT (user_id, account_phone) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        is_bot = EXCLUDED.is_bot,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE (senders.username, senders.first_name, senders.last_name, senders.is_bot)
+        IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.is_bot)
+"""
 
 
 def insert_or_update_sender(conn, user_id: int, username: Optional[str],
-                            first_name: Optional[str], last_name: Optional[str], is_bot: bool = False, account_phone: str = None):
+                            first_name: Optional[str], last_name: Optional[str], is_bot: bool = False, account_phone: str = None,
+                            *, commit: bool = True):
     """Inserta o actualiza un remitente."""
     with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO senders (user_id, username, first_name, last_name, is_bot, account_phone, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-            ON CONFLICT (user_id, account_phone) DO UPDATE SET
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                last_name = EXCLUDED.last_name,
-                is_bot = EXCLUDED.is_bot,
-                updated_at = CURRENT_TIMESTAMP
-        """, (user_id, username, first_name, last_name, is_bot, account_phone))
-    conn.commit()
+        cur.execute(_UPSERT_SENDER_SQL % "(%s, %s, %s, %s, %s, %s)",
+                    (user_id, username, first_name, last_name, is_bot, account_phone))
+    if commit:
+        conn.commit()
 
 
 def insert_message(conn, msg_id: int, chat_id: int, sender_id: Optional[int],
@@ -139,37 +264,19 @@ def insert_message(conn, msg_id: int, chat_id: int, sender_id: Optional[int],
                   is_forward: bool, forward_sender_id: Optional[int], reply_to_msg_id: Optional[int],
                   edit_date: Optional[datetime], views: Optional[int], forwards: Optional[int],
                   pin: bool, silent: bool, is_post: bool, ttl_period: Optional[int],
-                  topic_id: Optional[int], has_log: bool, created_at: datetime, account_phone: str) -> bool:
+                  topic_id: Optional[int], has_log: bool, created_at: datetime, account_phone: str,
+                  *, commit: bool = True) -> bool:
     """Inserta o actualiza un mensaje en la BD (PK compuesta chat_id, msg_id)."""
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO messages (
-                    msg_id, chat_id, sender_id, text, media_type, media_file_path,
-                    is_forward, forward_sender_id, reply_to_msg_id, edit_date,
-                    views, forwards, pin, silent, is_post, ttl_period, topic_id,
-                    has_log, created_at, account_phone
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT(chat_id, msg_id, account_phone) DO UPDATE SET
-                    sender_id=EXCLUDED.sender_id,
-                    text=EXCLUDED.text,
-                    media_type=EXCLUDED.media_type,
-                    media_file_path=EXCLUDED.media_file_path,
-                    is_forward=EXCLUDED.is_forward,
-                    forward_sender_id=EXCLUDED.forward_sender_id,
-                    reply_to_msg_id=EXCLUDED.reply_to_msg_id,
-                    edit_date=EXCLUDED.edit_date,
-                    views=EXCLUDED.views,
-                    forwards=EXCLUDED.forwards,
-                    pin=EXCLUDED.pin,
-                    silent=EXCLUDED.silent,
-                    is_post=EXCLUDED.is_post,
-                    ttl_period=EXCLUDED.ttl_period,
-                    topic_id=EXCLUDED.topic_id,
-                    has_log=EXCLUDED.has_log,
-                    created_at=EXCLUDED.created_at,
-                    received_at=CURRENT_TIMESTAMP
+            _execute_prepared(
+                cur,
+                "insert_message",
+                f"""
+                INSERT INTO messages ({_MESSAGE_COLUMNS})
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT(chat_id, msg_id, account_phone) DO UPDATE SET {_MESSAGE_UPSERT_SET}
+                WHERE {_MESSAGE_UPSERT_WHERE}
                 """,
                 (
                     msg_id,
@@ -194,7 +301,8 @@ def insert_message(conn, msg_id: int, chat_id: int, sender_id: Optional[int],
                     account_phone,
                 ),
             )
-        conn.commit()
+        if commit:
+            conn.commit()
         return True
     except Exception:
         logger.exception("Error insertando mensaje %s en chat %s", msg_id, chat_id)
@@ -213,122 +321,491 @@ def update_message(conn, msg_id: int, *,
                    silent: Optional[bool] = None,
                    is_post: Optional[bool] = None,
                    ttl_period: Optional[int] = None,
-                   topic_id: Optional[int] = None) -> bool:
+                   topic_id: Optional[int] = None,
+                   commit: bool = True) -> bool:
     """Actualiza campos de un mensaje existente. Solo actualiza los no-None."""
-    fields = []
-    values = []
-
-    if text is not None:
-        fields.append("text = %s")
-        values.append(text)
-    if media_type is not None:
-        fields.append("media_type = %s")
-        values.append(media_type)
-    if media_file_path is not None:
-        fields.append("media_file_path = %s")
-        values.append(media_file_path)
-    if edit_date is not None:
-        fields.append("edit_date = %s")
-        values.append(edit_date)
-    if views is not None:
-        fields.append("views = %s")
-        values.append(views)
-    if forwards is not None:
-        fields.append("forwards = %s")
-        values.append(forwards)
-    if pin is not None:
-        fields.append("pin = %s")
-        values.append(pin)
-    if silent is not None:
-        fields.append("silent = %s")
-        values.append(silent)
-    if is_post is not None:
-        fields.append("is_post = %s")
-        values.append(is_post)
-    if ttl_period is not None:
-        fields.append("ttl_period = %s")
-        values.append(ttl_period)
-    if topic_id is not None:
-        fields.append("topic_id = %s")
-        values.append(topic_id)
-
-    if not fields:
+    values = (text, media_type, media_file_path, edit_date, views, forwards,
+              pin, silent, is_post, ttl_period, topic_id)
+    if all(v is None for v in values):
         return False
 
-    fields.append("received_at = CURRENT_TIMESTAMP")
-    where_clause = "WHERE msg_id = %s" if chat_id is None else "WHERE msg_id = %s AND chat_id = %s"
-    query = f"UPDATE messages SET {', '.join(fields)} {where_clause}"
-    values.append(msg_id)
-    if chat_id is not None:
-        values.append(chat_id)
-    
+    # Sentencia fija: los campos a None conservan su valor (COALESCE), así el texto
+    # de la consulta no cambia entre llamadas y el plan se reutiliza.
     with conn.cursor() as cur:
-        cur.execute(query, values)
-    conn.commit()
-    return cur.rowcount > 0
+        cur.execute(
+            """
+            UPDATE messages SET
+                text = COALESCE(%s, text),
+                media_type = COALESCE(%s, media_type),
+                media_file_path = COALESCE(%s, media_file_path),
+                edit_date = COALESCE(%s, edit_date),
+                views = COALESCE(%s, views),
+                forwards = COALESCE(%s, forwards),
+                pin = COALESCE(%s, pin),
+                silent = COALESCE(%s, silent),
+                is_post = COALESCE(%s, is_post),
+                ttl_period = COALESCE(%s, ttl_period),
+                topic_id = COALESCE(%s, topic_id),
+                received_at = CURRENT_TIMESTAMP
+            WHERE msg_id = %s AND (%s::bigint IS NULL OR chat_id = %s)
+            """,
+            values + (msg_id, chat_id, chat_id),
+        )
+        updated = cur.rowcount > 0
+    if commit:
+        conn.commit()
+    return updated
 
 
-def insert_reactions(conn, msg_id: int, chat_id: int, reactions_data: list, account_phone: str = None):
+def insert_reactions(conn, msg_id: int, chat_id: int, reactions_data: list, account_phone: str = None,
+                     *, commit: bool = True):
     """Inserta reacciones para un mensaje (se borra y reescribe por idempotencia)."""
     if not reactions_data:
         return
 
+    emojis = [reaction.get("emoji") for reaction in reactions_data]
+    counts = [reaction.get("count", 1) for reaction in reactions_data]
     with conn.cursor() as cur:
-        cur.execute("DELETE FROM reactions WHERE msg_id = %s AND chat_id = %s AND account_phone = %s", (msg_id, chat_id, account_phone))
-        for reaction in reactions_data:
-            emoji = reaction.get("emoji")
-            count = reaction.get("count", 1)
-            cur.execute(
-                """
-                INSERT INTO reactions (msg_id, chat_id, emoji, count, account_phone)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (msg_id, chat_id, emoji, count, account_phone),
-            )
-    conn.commit()
+        # DELETE + INSERT en un único execute; las filas viajan como arrays paralelos (un solo plan)
+        cur.execute(
+            """
+            DELETE FROM reactions WHERE msg_id = %(msg_id)s AND chat_id = %(chat_id)s AND account_phone = %(account)s;
+            INSERT INTO reactions (msg_id, chat_id, emoji, count, account_phone)
+            SELECT %(msg_id)s, %(chat_id)s, u.emoji, u.count, %(account)s
+            FROM unnest(%(emojis)s::text[], %(counts)s::int[]) AS u(emoji, count)
+            """,
+            {"msg_id": msg_id, "chat_id": chat_id, "account": account_phone, "emojis": emojis, "counts": counts},
+        )
+    if commit:
+        conn.commit()
 
 
-def insert_entities(conn, msg_id: int, chat_id: int, entities_data: list, account_phone: str = None):
+def insert_entities(conn, msg_id: int, chat_id: int, entities_data: list, account_phone: str = None,
+                    *, commit: bool = True):
     """Inserta entidades (menciones, hashtags, URLs, etc.) para un mensaje."""
     if not entities_data:
         return
 
     with conn.cursor() as cur:
-        cur.execute("DELETE FROM entities WHERE msg_id = %s AND chat_id = %s AND account_phone = %s", (msg_id, chat_id, account_phone))
-        for entity in entities_data:
-            entity_type = entity.get("type")
-            offset = entity.get("offset")
-            length = entity.get("length")
-            text = entity.get("text")
-            cur.execute(
-                """
-                INSERT INTO entities (msg_id, chat_id, entity_type, entity_offset, entity_length, text, account_phone)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """,
-                (msg_id, chat_id, entity_type, offset, length, text, account_phone),
-            )
-    conn.commit()
+        cur.execute(
+            """
+            DELETE FROM entities WHERE msg_id = %(msg_id)s AND chat_id = %(chat_id)s AND account_phone = %(account)s;
+            INSERT INTO entities (msg_id, chat_id, entity_type, entity_offset, entity_length, text, account_phone)
+            SELECT %(msg_id)s, %(chat_id)s, u.entity_type, u.entity_offset, u.entity_length, u.text, %(account)s
+            FROM unnest(%(types)s::text[], %(offsets)s::int[], %(lengths)s::int[], %(texts)s::text[])
+                AS u(entity_type, entity_offset, entity_length, text)
+            """,
+            {
+                "msg_id": msg_id,
+                "chat_id": chat_id,
+                "account": account_phone,
+                "types": [entity.get("type") for entity in entities_data],
+                "offsets": [entity.get("offset") for entity in entities_data],
+                "lengths": [entity.get("length") for entity in entities_data],
+                "texts": [entity.get("text") for entity in entities_data],
+            },
+        )
+    if commit:
+        conn.commit()
+
+
+# %s = VALUES: una fila (insert_message_log) o el marcador de execute_values (flush_message_logs)
+_INSERT_MESSAGE_LOG_SQL = """
+    WITH ins AS (
+        INSERT INTO message_log (
+            telegram_msg_id, chat_id, sender_id, text, media_type, media_file_path,
+            is_forward, reply_to_msg_id, edited, edit_date, created_at, account_phone
+        ) VALUES %s
+        RETURNING telegram_msg_id, chat_id, account_phone
+    )
+    UPDATE messages m SET has_log = TRUE
+    FROM (SELECT DISTINCT telegram_msg_id, chat_id, account_phone FROM ins) k
+    WHERE m.msg_id = k.telegram_msg_id AND m.chat_id = k.chat_id AND m.account_phone = k.account_phone
+"""
+_INSERT_MESSAGE_LOG_ONE_SQL = _INSERT_MESSAGE_LOG_SQL % "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
 
 
 def insert_message_log(conn, telegram_msg_id: int, chat_id: int, sender_id: Optional[int],
                        text: Optional[str], media_type: Optional[str], media_file_path: Optional[str],
                        is_forward: bool, reply_to_msg_id: Optional[int], edited: bool,
-                       edit_date: Optional[datetime], created_at: datetime, account_phone: str):
+                       edit_date: Optional[datetime], created_at: datetime, account_phone: str,
+                       *, commit: bool = True):
     """Inserta una versión de mensaje (incluye ediciones) sin sobrescribir el original."""
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO message_log (
-                telegram_msg_id, chat_id, sender_id, text, media_type, media_file_path,
-                is_forward, reply_to_msg_id, edited, edit_date, created_at, account_phone
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """,
+        # INSERT + marcado del mensaje principal como con logs en una sola sentencia (forma fija: preparada)
+        _execute_prepared(
+            cur,
+            "insert_message_log",
+            _INSERT_MESSAGE_LOG_ONE_SQL,
             (telegram_msg_id, chat_id, sender_id, text, media_type, media_file_path,
              is_forward, reply_to_msg_id, edited, edit_date, created_at, account_phone)
         )
-        # Marcar mensaje principal como con logs
-        cur.execute("UPDATE messages SET has_log = TRUE WHERE msg_id = %s AND chat_id = %s AND account_phone = %s", (telegram_msg_id, chat_id, account_phone))
-    conn.commit()
+    if commit:
+        conn.commit()
+
+
+def flush_chats(conn, rows: List[tuple]) -> None:
+    """Upsert por lotes de chats (chat_id, username, title, chat_type, account_phone). No hace commit."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, _UPSERT_CHAT_SQL, rows, page_size=_BATCH_PAGE_SIZE)
+
+
+def flush_senders(conn, rows: List[tuple]) -> None:
+    """Upsert por lotes de remitentes (user_id, username, first_name, last_name, is_bot, account_phone). No hace commit."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, _UPSERT_SENDER_SQL, rows, page_size=_BATCH_PAGE_SIZE)
+
+
+_MESSAGE_COLUMNS = (
+    "msg_id, chat_id, sender_id, text, media_type, media_file_path, "
+    "is_forward, forward_sender_id, reply_to_msg_id, edit_date, "
+    "views, forwards, pin, silent, is_post, ttl_period, topic_id, "
+    "has_log, created_at, account_phone"
+)
+
+
+_MESSAGE_UPSERT_SET = """
+    sender_id=EXCLUDED.sender_id,
+    text=EXCLUDED.text,
+    media_type=EXCLUDED.media_type,
+    media_file_path=EXCLUDED.media_file_path,
+    is_forward=EXCLUDED.is_forward,
+    forward_sender_id=EXCLUDED.forward_sender_id,
+    reply_to_msg_id=EXCLUDED.reply_to_msg_id,
+    edit_date=EXCLUDED.edit_date,
+    views=EXCLUDED.views,
+    forwards=EXCLUDED.forwards,
+    pin=EXCLUDED.pin,
+    silent=EXCLUDED.silent,
+    is_post=EXCLUDED.is_post,
+    ttl_period=EXCLUDED.ttl_period,
+    topic_id=EXCLUDED.topic_id,
+    has_log=EXCLUDED.has_log,
+    created_at=EXCLUDED.created_at,
+    received_at=CURRENT_TIMESTAMP
+"""
+
+# Solo se actualiza si algo cambió: reingestas idénticas no generan WAL ni tuplas muertas
+_MESSAGE_UPSERT_WHERE = """
+    (messages.sender_id, messages.text, messages.media_type, messages.media_file_path,
+     messages.is_forward, messages.forward_sender_id, messages.reply_to_msg_id, messages.edit_date,
+     messages.views, messages.forwards, messages.pin, messages.silent, messages.is_post,
+     messages.ttl_period, messages.topic_id, messages.has_log, messages.created_at)
+    IS DISTINCT FROM
+    (EXCLUDED.sender_id, EXCLUDED.text, EXCLUDED.media_type, EXCLUDED.media_file_path,
+     EXCLUDED.is_forward, EXCLUDED.forward_sender_id, EXCLUDED.reply_to_msg_id, EXCLUDED.edit_date,
+     EXCLUDED.views, EXCLUDED.forwards, EXCLUDED.pin, EXCLUDED.silent, EXCLUDED.is_post,
+     EXCLUDED.ttl_period, EXCLUDED.topic_id, EXCLUDED.has_log, EXCLUDED.created_at)
+"""
+
+# Por encima de este número de filas compensa COPY + staging frente a execute_values
+_COPY_MIN_ROWS = int(os.environ.get("TG_DB_COPY_ROWS", str(_BATCH_PAGE_SIZE)))
+
+
+def flush_messages(conn, rows: List[tuple]) -> None:
+    """Upsert por lotes de mensajes (tuplas en el orden de insert_message). No hace commit."""
+    if not rows:
+        return
+    if len(rows) > _COPY_MIN_ROWS:
+        copy_messages(conn, rows)
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            f"""
+            INSERT INTO messages ({_MESSAGE_COLUMNS}) VALUES %s
+            ON CONFLICT(chat_id, msg_id, account_phone) DO UPDATE SET {_MESSAGE_UPSERT_SET}
+            WHERE {_MESSAGE_UPSERT_WHERE}
+            """,
+            rows,
+            page_size=_BATCH_PAGE_SIZE,
+        )
+
+
+def _copy_text_value(value) -> str:
+    """Serializa un valor al formato text de COPY."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_messages(conn, rows: List[tuple]) -> None:
+    """Upsert masivo de mensajes vía COPY a una tabla temporal + INSERT ... SELECT. No hace commit.
+
+    La tabla de staging es TEMP (por sesión): no toca el esquema compartido y
+    varios clientes pueden usarla a la vez sin pisarse.
+    """
+    if not rows:
+        return
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_text_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS messages_staging "
+            "(LIKE messages INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        cur.execute("TRUNCATE messages_staging")
+        cur.copy_expert(f"COPY messages_staging ({_MESSAGE_COLUMNS}) FROM STDIN", buf)
+        cur.execute(
+            f"""
+            INSERT INTO messages ({_MESSAGE_COLUMNS})
+            SELECT {_MESSAGE_COLUMNS} FROM messages_staging
+            ON CONFLICT(chat_id, msg_id, account_phone) DO UPDATE SET {_MESSAGE_UPSERT_SET}
+            WHERE {_MESSAGE_UPSERT_WHERE}
+            """
+        )
+
+
+def flush_message_logs(conn, rows: List[tuple]) -> None:
+    """Inserta por lotes versiones de mensaje (orden de insert_message_log) y marca has_log. No hace commit."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(cur, _INSERT_MESSAGE_LOG_SQL, rows, page_size=_BATCH_PAGE_SIZE)
+
+
+# Sentencias de flush_reactions/flush_entities: constantes de módulo, sin rearmar el texto en cada lote
+_DELETE_REACTIONS_SQL = """
+    DELETE FROM reactions r
+    USING (VALUES %s) AS k(msg_id, chat_id, account_phone)
+    WHERE r.msg_id = k.msg_id AND r.chat_id = k.chat_id AND r.account_phone = k.account_phone
+"""
+_INSERT_REACTIONS_SQL = "INSERT INTO reactions (msg_id, chat_id, emoji, count, account_phone) VALUES %s"
+_DELETE_ENTITIES_SQL = """
+    DELETE FROM entities e
+    USING (VALUES %s) AS k(msg_id, chat_id, account_phone)
+    WHERE e.msg_id = k.msg_id AND e.chat_id = k.chat_id AND e.account_phone = k.account_phone
+"""
+_INSERT_ENTITIES_SQL = """
+    INSERT INTO entities (msg_id, chat_id, entity_type, entity_offset, entity_length, text, account_phone)
+    VALUES %s
+"""
+
+
+def flush_reactions(conn, rows: List[tuple]) -> None:
+    """Reescribe por lotes las reacciones (msg_id, chat_id, emoji, count, account_phone). No hace commit."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        keys = list({(r[0], r[1], r[4]) for r in rows})
+        psycopg2.extras.execute_values(cur, _DELETE_REACTIONS_SQL, keys, page_size=_BATCH_PAGE_SIZE)
+        psycopg2.extras.execute_values(cur, _INSERT_REACTIONS_SQL, rows, page_size=_BATCH_PAGE_SIZE)
+
+
+def flush_entities(conn, rows: List[tuple]) -> None:
+    """Reescribe por lotes las entidades (msg_id, chat_id, type, offset, length, text, account_phone). No hace commit."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        keys = list({(r[0], r[1], r[6]) for r in rows})
+        psycopg2.extras.execute_values(cur, _DELETE_ENTITIES_SQL, keys, page_size=_BATCH_PAGE_SIZE)
+        psycopg2.extras.execute_values(cur, _INSERT_ENTITIES_SQL, rows, page_size=_BATCH_PAGE_SIZE)
+
+
+# Errores de conexión (servidor reiniciado, red caída): el lote se reintenta entero con otra conexión
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Un chat/remitente idéntico al último escrito hace menos de esto no se vuelve a enviar a BD
+_UPSERT_TTL = float(os.environ.get("TG_UPSERT_TTL_SECONDS", "600"))
+
+# Commit asíncrono para los lotes de mensajes: un corte del servidor puede perder el último
+# instante de commits, pero esos mensajes se recuperan en el siguiente catch-up (se parte del
+# mayor msg_id en BD). TG_DB_ASYNC_COMMIT=0 vuelve a esperar el fsync del WAL en cada lote.
+_MESSAGE_ASYNC_COMMIT = os.environ.get("TG_DB_ASYNC_COMMIT", "1").lower() not in ("0", "false", "no")
+
+
+class MessageBuffer:
+    """Acumula mensajes (con su chat, remitente, log, reacciones y entidades) para escribirlos
+    en una sola transacción. Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(self, max_rows: int = _BATCH_PAGE_SIZE, on_failure=None):
+        self.max_rows = max_rows
+        # Se llama (sin argumentos, fuera del lock) cuando un lote o un mensaje no llega a BD
+        self._on_failure = on_failure
+        self._lock = threading.Lock()
+        # clave -> (fila, instante) de chats/remitentes confirmados en BD por este buffer
+        self._written: Dict[tuple, tuple] = {}
+        self._chats: Dict[tuple, tuple] = {}
+        self._senders: Dict[tuple, tuple] = {}
+        self._messages: Dict[tuple, tuple] = {}
+        self._logs: List[tuple] = []
+        self._reactions: Dict[tuple, List[tuple]] = {}
+        self._entities: Dict[tuple, List[tuple]] = {}
+        self._max_ids: Dict[tuple, int] = {}
+        # Máximos del lote que se está escribiendo: siguen visibles hasta el commit
+        self._flushing_max_ids: Dict[tuple, int] = {}
+        # Serializa los flush entre sí sin bloquear add() durante la transacción
+        self._flush_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def add(self, message_row: tuple, log_row: Optional[tuple] = None,
+            reactions: Optional[List[tuple]] = None, entities: Optional[List[tuple]] = None,
+            chat_row: Optional[tuple] = None, sender_row: Optional[tuple] = None) -> bool:
+        """Añade un mensaje; devuelve True si el buffer ya alcanzó max_rows y conviene hacer flush()."""
+        msg_id, chat_id, account_phone = message_row[0], message_row[1], message_row[19]
+        key = (chat_id, msg_id, account_phone)
+        with self._lock:
+            # Un mismo mensaje repetido en el lote se queda con la última versión
+            # (ON CONFLICT no puede tocar la misma fila dos veces en una sentencia).
+            if chat_row is not None and not self._recently_written(("chat", chat_row[0], chat_row[4]), chat_row):
+                self._chats[(chat_row[0], chat_row[4])] = chat_row
+            if sender_row is not None and not self._recently_written(("sender", sender_row[0], sender_row[5]), sender_row):
+                self._senders[(sender_row[0], sender_row[5])] = sender_row
+            self._messages[key] = message_row
+            if log_row is not None:
+                self._logs.append(log_row)
+            if reactions:
+                self._reactions[key] = reactions
+            if entities:
+                self._entities[key] = entities
+            chat_key = (chat_id, account_phone)
+            self._max_ids[chat_key] = max(self._max_ids.get(chat_key, 0), msg_id)
+            return len(self._messages) >= self.max_rows
+
+    def _recently_written(self, key: tuple, row: tuple) -> bool:
+        written = self._written.get(key)
+        return written is not None and written[0] == row and time.monotonic() - written[1] < _UPSERT_TTL
+
+    def _mark_written(self, chats: List[tuple], senders: List[tuple]) -> None:
+        # Se llama con self._lock tomado, tras un commit correcto
+        now = time.monotonic()
+        if len(self._written) > 50_000:
+            # Limpieza perezosa de entradas caducadas
+            self._written = {k: v for k, v in self._written.items() if now - v[1] < _UPSERT_TTL}
+        for row in chats:
+            self._written[("chat", row[0], row[4])] = (row, now)
+        for row in senders:
+            self._written[("sender", row[0], row[5])] = (row, now)
+
+    def pending_max_id(self, chat_id: int, account_phone: str) -> int:
+        """Mayor msg_id pendiente de escribir para el chat (0 si no hay ninguno)."""
+        key = (chat_id, account_phone)
+        with self._lock:
+            return max(self._max_ids.get(key, 0), self._flushing_max_ids.get(key, 0))
+
+    def flush(self, conn) -> int:
+        """Escribe todo lo pendiente en una transacción; devuelve el número de mensajes escritos.
+
+        El lock solo se toma para separar el lote: add() no espera a la transacción. Si se
+        pierde la conexión, el lote vuelve al buffer y se relanza el error (ver CONNECTION_ERRORS).
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self._messages:
+                    return 0
+                batch = (self._chats, self._senders, self._messages, self._logs,
+                         self._reactions, self._entities, self._max_ids)
+                self._flushing_max_ids = self._max_ids
+                self._chats, self._senders = {}, {}
+                self._messages, self._logs, self._reactions, self._entities, self._max_ids = {}, [], {}, {}, {}
+            chats = list(batch[0].values())
+            senders = list(batch[1].values())
+            messages = list(batch[2].values())
+            logs = batch[3]
+            reactions = [row for rows in batch[4].values() for row in rows]
+            entities = [row for rows in batch[5].values() for row in rows]
+            try:
+                try:
+                    if _MESSAGE_ASYNC_COMMIT:
+                        with conn.cursor() as cur:
+                            cur.execute("SET LOCAL synchronous_commit = off")
+                    # Orden de claves foráneas: chats/senders, messages y después message_log/reactions/entities
+                    flush_chats(conn, chats)
+                    flush_senders(conn, senders)
+                    flush_messages(conn, messages)
+                    flush_message_logs(conn, logs)
+                    flush_reactions(conn, reactions)
+                    flush_entities(conn, entities)
+                    conn.commit()
+                    with self._lock:
+                        self._mark_written(chats, senders)
+                except Exception as exc:
+                    lost = isinstance(exc, CONNECTION_ERRORS)
+                    try:
+                        conn.rollback()
+                    except CONNECTION_ERRORS:
+                        lost = True
+                    if lost:
+                        # Sin conexión no se puede aislar nada fila a fila: el lote entero se reintenta
+                        with self._lock:
+                            self._requeue(*batch)
+                        logger.warning(f"Conexión perdida escribiendo lote de {len(messages)} mensajes; vuelven al buffer")
+                        self._failed()
+                        raise
+                    with self._lock:
+                        # Por si el fallo es un chat/remitente que ya no existe: volver a enviarlos todos
+                        self._written.clear()
+                    logger.exception(f"Error escribiendo lote de {len(messages)} mensajes; se reintenta uno a uno")
+                    if not self._flush_one_by_one(conn, chats, senders, messages, logs, reactions, entities):
+                        self._failed()
+            finally:
+                with self._lock:
+                    self._flushing_max_ids = {}
+            return len(messages)
+
+    def _requeue(self, chats, senders, messages, logs, reactions, entities, max_ids) -> None:
+        # Se llama con self._lock tomado. Lo añadido durante la transacción es más reciente y se conserva
+        for pending, detached in ((self._chats, chats), (self._senders, senders), (self._messages, messages),
+                                  (self._reactions, reactions), (self._entities, entities)):
+            for key, value in detached.items():
+                pending.setdefault(key, value)
+        self._logs = logs + self._logs
+        for key, msg_id in max_ids.items():
+            self._max_ids[key] = max(self._max_ids.get(key, 0), msg_id)
+
+    def _failed(self) -> None:
+        if self._on_failure is not None:
+            try:
+                self._on_failure()
+            except Exception:
+                logger.exception("Error en el aviso de escritura fallida")
+
+    @staticmethod
+    def _flush_one_by_one(conn, chats, senders, messages, logs, reactions, entities) -> bool:
+        # Aísla la fila problemática: el resto del lote se guarda igualmente. False si alguna falló
+        ok = True
+        for flush_fn, rows in ((flush_chats, chats), (flush_senders, senders)):
+            for row in rows:
+                try:
+                    flush_fn(conn, [row])
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    ok = False
+                    logger.exception("Error insertando %s %s", flush_fn.__name__, row[0])
+        for row in messages:
+            msg_key = (row[0], row[1], row[19])
+            try:
+                flush_messages(conn, [row])
+                flush_message_logs(conn, [r for r in logs if (r[0], r[1], r[11]) == msg_key])
+                flush_reactions(conn, [r for r in reactions if (r[0], r[1], r[4]) == msg_key])
+                flush_entities(conn, [r for r in entities if (r[0], r[1], r[6]) == msg_key])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                ok = False
+                logger.exception("Error insertando mensaje %s en chat %s", row[0], row[1])
+        return ok
 
 
 def get_messages_by_chat(conn, chat_id: int, limit: int = 100) -> list:
@@ -358,52 +835,56 @@ def get_messages_by_sender(conn, sender_id: int, limit: int = 100) -> list:
 
 
 def export_messages_json(conn, output_file: str = "messages_export.json"):
-    """Exporta todos los mensajes a JSON."""
-    with conn.cursor() as cur:
+    """Exporta todos los mensajes a JSON (en streaming, con reacciones y entidades agregadas)."""
+    count = 0
+    # Cursor de servidor: solo itersize filas en memoria, y una sola consulta en vez de 2N+1.
+    # Buffer de escritura de 1 MiB: un write() al disco cada muchas filas, no cada pocas
+    with conn.cursor(name="export_messages") as cur, open(output_file, "w", encoding="utf-8", buffering=1 << 20) as f:
+        cur.itersize = 1000
         cur.execute("""
-            SELECT * FROM messages ORDER BY created_at
+            SELECT m.*,
+                   COALESCE((
+                       SELECT json_agg(json_build_object('emoji', r.emoji, 'count', r.count))
+                       FROM reactions r
+                       WHERE r.msg_id = m.msg_id AND r.chat_id = m.chat_id
+                   ), '[]'::json) AS reactions,
+                   COALESCE((
+                       SELECT json_agg(json_build_object(
+                           'entity_type', e.entity_type, 'offset', e.entity_offset,
+                           'length', e.entity_length, 'text', e.text))
+                       FROM entities e
+                       WHERE e.msg_id = m.msg_id AND e.chat_id = m.chat_id
+                   ), '[]'::json) AS entities
+            FROM messages m
+            ORDER BY m.created_at
         """)
-        rows = cur.fetchall()
-    
-    data = []
-    for row in rows:
-        msg_dict = dict(row)
-        # Obtener reacciones
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT emoji, count FROM reactions WHERE msg_id = %s AND chat_id = %s",
-                (row["msg_id"], row["chat_id"])
-            )
-            reactions = cur.fetchall()
-        msg_dict["reactions"] = [dict(r) for r in reactions]
-        
-        # Obtener entidades
-        with conn.cursor() as cur:
-            cur.execute(
-                "SELECT entity_type, entity_offset as offset, entity_length as length, text FROM entities WHERE msg_id = %s AND chat_id = %s",
-                (row["msg_id"], row["chat_id"])
-            )
-            entities = cur.fetchall()
-        msg_dict["entities"] = [dict(e) for e in entities]
-        
-        data.append(msg_dict)
-    
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
-    
-    return len(data)
+        f.write("[")
+        for row in cur:
+            f.write(",\n" if count else "\n")
+            f.write(json.dumps(dict(row), ensure_ascii=False, indent=2, default=str))
+            count += 1
+        f.write("\n]\n" if count else "]\n")
+    conn.commit()
+    return count
 
 
 def get_max_message_id_in_chat(conn, chat_id: int, account_phone: str) -> int:
     """Obtiene el ID de mensaje más alto guardado en un chat para una cuenta específica."""
     try:
-        with conn.cursor() as cur:
+        # Cursor de tuplas explícito: funciona igual con conexiones dict o tuple
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            # Lectura hacia atrás de idx_messages_chat_acct_msg: una sola tupla
             cur.execute(
-                "SELECT MAX(msg_id) FROM messages WHERE chat_id = %s AND account_phone = %s",
+                """
+                SELECT msg_id FROM messages
+                WHERE chat_id = %s AND account_phone = %s
+                ORDER BY msg_id DESC
+                LIMIT 1
+                """,
                 (chat_id, account_phone)
             )
             result = cur.fetchone()
-        max_id = result["max"] if result and result["max"] else 0
+        max_id = result[0] if result and result[0] else 0
         logger.debug(f"get_max_message_id_in_chat({chat_id}, {account_phone}) = {max_id}")
         return max_id
     except Exception as e:
@@ -411,33 +892,57 @@ def get_max_message_id_in_chat(conn, chat_id: int, account_phone: str) -> int:
         return 0
 
 
-def get_stats(conn) -> dict:
-    """Obtiene estadísticas generales."""
+def get_max_message_ids(conn, chat_ids: List[int], account_phone: str) -> Dict[int, int]:
+    """Como get_max_message_id_in_chat para varios chats en un solo viaje ({chat_id: max_id})."""
+    if not chat_ids:
+        return {}
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        # Subconsulta LATERAL por chat: cada una es la misma lectura de índice de LIMIT 1
+        cur.execute(
+            """
+            SELECT c.chat_id, m.msg_id
+            FROM unnest(%s::bigint[]) AS c(chat_id)
+            LEFT JOIN LATERAL (
+                SELECT msg_id FROM messages
+                WHERE chat_id = c.chat_id AND account_phone = %s
+                ORDER BY msg_id DESC
+                LIMIT 1
+            ) m ON TRUE
+            """,
+            (list(chat_ids), account_phone),
+        )
+        return {chat_id: max_id or 0 for chat_id, max_id in cur.fetchall()}
+
+
+def get_stats(conn, approximate: bool = False) -> dict:
+    """Obtiene estadísticas generales en una sola consulta.
+
+    Con approximate=True usa reltuples de pg_class (sin recorrer las tablas; depende de ANALYZE).
+    """
     with conn.cursor() as cur:
-        cur.execute("SELECT COUNT(*) as cnt FROM messages")
-        total_messages = cur.fetchone()["cnt"]
-        cur.execute("SELECT COUNT(*) as cnt FROM chats")
-        total_chats = cur.fetchone()["cnt"]
-        cur.execute("SELECT COUNT(*) as cnt FROM senders")
-        total_senders = cur.fetchone()["cnt"]
-        cur.execute("SELECT COUNT(*) as cnt FROM reactions")
-        total_reactions = cur.fetchone()["cnt"]
-    
-    stats = {
-        "total_messages": total_messages,
-        "total_chats": total_chats,
-        "total_senders": total_senders,
-        "total_reactions": total_reactions,
-    }
-    return stats
+        if approximate:
+            cur.execute("""
+                SELECT
+                    (SELECT reltuples::bigint FROM pg_class WHERE oid = 'public.messages'::regclass) AS total_messages,
+                    (SELECT reltuples::bigint FROM pg_class WHERE oid = 'public.chats'::regclass) AS total_chats,
+                    (SELECT reltuples::bigint FROM pg_class WHERE oid = 'public.senders'::regclass) AS total_senders,
+                    (SELECT reltuples::bigint FROM pg_class WHERE oid = 'public.reactions'::regclass) AS total_reactions
+            """)
+        else:
+            cur.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM messages) AS total_messages,
+                    (SELECT COUNT(*) FROM chats) AS total_chats,
+                    (SELECT COUNT(*) FROM senders) AS total_senders,
+                    (SELECT COUNT(*) FROM reactions) AS total_reactions
+            """)
+        return dict(cur.fetchone())
 
 
 # ---- Cola de descargas ----
 
 def enqueue_download(conn, msg_id: int, chat_id: int, chat_label: str, media_dir: Optional[str], file_size: Optional[int], file_unique_id: Optional[str], account_phone: str) -> None:
     """Encola un mensaje para descarga de media. Idempotente por msg_id y por file_unique_id."""
-    ensure_chat_preferences_table(conn)
-    ensure_download_queue_account_phone(conn)
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -450,27 +955,55 @@ def enqueue_download(conn, msg_id: int, chat_id: int, chat_label: str, media_dir
     conn.commit()
 
 
+# Chats con descarga de media deshabilitada: tabla pequeña y casi estática, se cachea en
+# proceso para quitar el LEFT JOIN a chat_preferences de las consultas de la cola.
+_DISABLED_PREFS_TTL = 30.0
+_disabled_prefs_cache = (frozenset(), 0.0)
+_disabled_prefs_lock = threading.Lock()
+
+
+def _get_disabled_media_chats(conn) -> frozenset:
+    """Devuelve {(chat_id, account_phone)} con media_download_enabled = FALSE (refresco cada 30 s)."""
+    global _disabled_prefs_cache
+    with _disabled_prefs_lock:
+        pairs, loaded_at = _disabled_prefs_cache
+        if time.monotonic() - loaded_at < _DISABLED_PREFS_TTL:
+            return pairs
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.execute("SELECT chat_id, account_phone FROM chat_preferences WHERE media_download_enabled = FALSE")
+            pairs = frozenset(cur.fetchall())
+        _disabled_prefs_cache = (pairs, time.monotonic())
+        return pairs
+
+
+def _pending_downloads_filter(conn, account_phone: Optional[str]):
+    """Condiciones WHERE (y sus parámetros) comunes a las consultas de pendientes."""
+    where = ["dq.status = 'pending'"]
+    params = []
+    if account_phone:
+        where.append("dq.account_phone = %s")
+        params.append(account_phone)
+    disabled = _get_disabled_media_chats(conn)
+    if account_phone:
+        disabled = [pair for pair in disabled if pair[1] == account_phone]
+    if disabled:
+        where.append("(dq.chat_id, dq.account_phone) NOT IN %s")
+        params.append(tuple(disabled))
+    return where, params
+
+
 def fetch_pending_downloads(conn, limit: int = 10, account_phone: Optional[str] = None):
     """Obtiene descargas pendientes priorizando ficheros pequeños.
 
     Si account_phone se proporciona, limita la cola a esa línea.
     """
-    ensure_chat_preferences_table(conn)
-    ensure_download_queue_account_phone(conn)
     with conn.cursor() as cur:
-        params = []
-        where = ["dq.status = 'pending'", "COALESCE(cp.media_download_enabled, TRUE) = TRUE"]
-        if account_phone:
-            where.append("dq.account_phone = %s")
-            params.append(account_phone)
-
+        where, params = _pending_downloads_filter(conn, account_phone)
         params.append(limit)
         cur.execute(
             f"""
             SELECT dq.id, dq.msg_id, dq.chat_id, dq.chat_label, dq.media_dir, dq.file_size, dq.file_unique_id, dq.account_phone
             FROM download_queue dq
-            LEFT JOIN chat_preferences cp
-                ON cp.chat_id = dq.chat_id AND cp.account_phone = dq.account_phone
             WHERE {' AND '.join(where)}
             ORDER BY dq.file_size ASC NULLS LAST, dq.created_at ASC, dq.id ASC
             LIMIT %s
@@ -485,22 +1018,13 @@ def fetch_recent_pending_downloads(conn, limit: int = 3, account_phone: Optional
 
     Si account_phone se proporciona, limita la cola a esa línea.
     """
-    ensure_chat_preferences_table(conn)
-    ensure_download_queue_account_phone(conn)
     with conn.cursor() as cur:
-        params = []
-        where = ["dq.status = 'pending'", "COALESCE(cp.media_download_enabled, TRUE) = TRUE"]
-        if account_phone:
-            where.append("dq.account_phone = %s")
-            params.append(account_phone)
-
+        where, params = _pending_downloads_filter(conn, account_phone)
         params.append(limit)
         cur.execute(
             f"""
             SELECT dq.id, dq.msg_id, dq.chat_id, dq.chat_label, dq.media_dir, dq.file_size, dq.file_unique_id, dq.account_phone
             FROM download_queue dq
-            LEFT JOIN chat_preferences cp
-                ON cp.chat_id = dq.chat_id AND cp.account_phone = dq.account_phone
             WHERE {' AND '.join(where)}
             ORDER BY dq.file_size ASC NULLS LAST, dq.created_at DESC, dq.id DESC
             LIMIT %s
@@ -511,37 +1035,15 @@ def fetch_recent_pending_downloads(conn, limit: int = 3, account_phone: Optional
 
 
 def ensure_chat_preferences_table(conn) -> None:
-    """Valida que exista la tabla chat_preferences (sin crearla).
-
-    La creación de esquema debe hacerse en PostgreSQL (init_db.sql).
-    """
-    if _schema_checks["chat_preferences_table"]:
-        return
-    if not _table_exists(conn, "chat_preferences"):
-        raise RuntimeError(
-            "Falta la tabla 'chat_preferences'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
-        )
-    _schema_checks["chat_preferences_table"] = True
+    """Compatibilidad: el esquema se valida una vez al crear el pool (_ensure_schema)."""
 
 
 def ensure_download_queue_account_phone(conn) -> None:
-    """Valida que exista la columna account_phone en download_queue (sin alterarla)."""
-    if _schema_checks["download_queue_account_phone"]:
-        return
-    if not _table_exists(conn, "download_queue"):
-        raise RuntimeError(
-            "Falta la tabla 'download_queue'. El esquema debe inicializarse en PostgreSQL (postgres/init_db.sql)."
-        )
-    if not _column_exists(conn, "download_queue", "account_phone"):
-        raise RuntimeError(
-            "Falta la columna 'download_queue.account_phone'. Actualiza el esquema en PostgreSQL (postgres/init_db.sql) o aplica la migración correspondiente."
-        )
-    _schema_checks["download_queue_account_phone"] = True
+    """Compatibilidad: el esquema se valida una vez al crear el pool (_ensure_schema)."""
 
 
 def is_media_download_enabled(conn, chat_id: int, account_phone: str) -> bool:
     """Devuelve True si el chat tiene habilitada la descarga de media (default True)."""
-    ensure_chat_preferences_table(conn)
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -555,10 +1057,33 @@ def is_media_download_enabled(conn, chat_id: int, account_phone: str) -> bool:
     return bool(row["enabled"]) if row else True
 
 
+# LRU en proceso file_unique_id -> ruta descargada. Solo guarda aciertos: una ruta 'done' no
+# caduca, mientras que un "no descargado" dejaría de ser cierto al terminar la descarga.
+_UNIQUE_ID_CACHE_SIZE = int(os.environ.get("TG_UNIQUE_ID_CACHE_SIZE", "100000"))
+_unique_id_paths: "OrderedDict[str, str]" = OrderedDict()
+_unique_id_lock = threading.Lock()
+
+
+def remember_downloaded_path(file_unique_id: Optional[str], path: Optional[str]) -> None:
+    """Registra en la LRU una ruta descargada (tras leerla de BD o completar una descarga)."""
+    if not file_unique_id or not path or _UNIQUE_ID_CACHE_SIZE <= 0:
+        return
+    with _unique_id_lock:
+        _unique_id_paths[file_unique_id] = path
+        _unique_id_paths.move_to_end(file_unique_id)
+        while len(_unique_id_paths) > _UNIQUE_ID_CACHE_SIZE:
+            _unique_id_paths.popitem(last=False)
+
+
 def get_downloaded_path_by_unique_id(conn, file_unique_id: Optional[str]) -> Optional[str]:
     """Devuelve una ruta ya descargada para un file_unique_id, si existe."""
     if not file_unique_id:
         return None
+    with _unique_id_lock:
+        path = _unique_id_paths.get(file_unique_id)
+        if path is not None:
+            _unique_id_paths.move_to_end(file_unique_id)
+            return path
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -570,7 +1095,52 @@ def get_downloaded_path_by_unique_id(conn, file_unique_id: Optional[str]) -> Opt
             (file_unique_id,)
         )
         row = cur.fetchone()
-    return row["path"] if row else None
+    path = row["path"] if row else None
+    remember_downloaded_path(file_unique_id, path)
+    return path
+
+
+def _claim_pending_downloads(conn, limit: int, account_phone: Optional[str], order_by: str) -> list:
+    where, params = _pending_downloads_filter(conn, account_phone)
+    params.append(limit)
+    with conn.cursor() as cur:
+        # Selección + marcado in_progress atómicos; SKIP LOCKED reparte filas distintas entre workers
+        cur.execute(
+            f"""
+            UPDATE download_queue q
+            SET status = 'in_progress', attempts = q.attempts + 1, updated_at = CURRENT_TIMESTAMP
+            FROM (
+                SELECT dq.id
+                FROM download_queue dq
+                WHERE {' AND '.join(where)}
+                ORDER BY {order_by}
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) picked
+            WHERE q.id = picked.id
+            RETURNING q.id, q.msg_id, q.chat_id, q.chat_label, q.media_dir, q.file_size, q.file_unique_id, q.account_phone
+            """,
+            tuple(params),
+        )
+        rows = [dict(row) for row in cur.fetchall()]
+    conn.commit()
+    return rows
+
+
+def claim_pending_downloads(conn, limit: int = 10, account_phone: Optional[str] = None) -> list:
+    """Como fetch_pending_downloads, pero deja las filas en 'in_progress' en la misma sentencia."""
+    return _claim_pending_downloads(
+        conn, limit, account_phone,
+        "dq.file_size ASC NULLS LAST, dq.created_at ASC, dq.id ASC",
+    )
+
+
+def claim_recent_pending_downloads(conn, limit: int = 3, account_phone: Optional[str] = None) -> list:
+    """Como fetch_recent_pending_downloads, pero deja las filas en 'in_progress' en la misma sentencia."""
+    return _claim_pending_downloads(
+        conn, limit, account_phone,
+        "dq.file_size ASC NULLS LAST, dq.created_at DESC, dq.id DESC",
+    )
 
 
 def mark_download_in_progress(conn, row_id: int) -> None:
@@ -640,25 +1210,139 @@ def mark_download_failed(conn, row_id: int, error: str) -> None:
     conn.commit()
 
 
-def mark_message_unrecoverable(conn, chat_id: int, msg_id: int, account_phone: str, reason: str = "unrecoverable") -> None:
+class DownloadStatusWriter(threading.Thread):
+    """Hilo que agrupa los cambios de estado de download_queue y los escribe por lotes.
+
+    Los llamantes solo encolan (done/failed) y siguen; el hilo junta lo que llegue en
+    ~100 ms (hasta 500 filas) y lo aplica en un único UPDATE ... FROM (VALUES ...) con un
+    solo commit por lote.
+    """
+
+    _SQL = """
+        UPDATE download_queue q
+        SET status = v.status,
+            path = CASE WHEN v.status = 'done' THEN v.path ELSE q.path END,
+            error = v.error,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (VALUES %s) AS v(id, status, path, error)
+        WHERE q.id = v.id
+    """
+    _TEMPLATE = "(%s::int, %s::text, %s::text, %s::text)"
+
+    def __init__(self, max_rows: int = 500, max_wait: float = 0.1):
+        super().__init__(name="download-status-writer", daemon=True)
+        self._queue = queue.Queue()
+        self._max_rows = max_rows
+        self._max_wait = max_wait
+
+    def done(self, row_id: int, path: str) -> None:
+        self._queue.put((row_id, "done", path, None))
+
+    def failed(self, row_id: int, error: str) -> None:
+        self._queue.put((row_id, "failed", None, error[:500]))
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Vacía lo pendiente y termina el hilo (se registra en atexit)."""
+        self._queue.put(None)
+        self.join(timeout)
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            # Última actualización por id gana (orden de llegada)
+            batch = {item[0]: item}
+            deadline = time.monotonic() + self._max_wait
+            while len(batch) < self._max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch[item[0]] = item
+            self._write(list(batch.values()))
+
+    def _write(self, rows: List[tuple]) -> None:
+        try:
+            with db_conn(rows="tuple") as conn:
+                try:
+                    with conn.cursor() as cur:
+                        # Estado reconstruible (reset_stuck_downloads): no hace falta esperar al fsync del WAL
+                        cur.execute("SET LOCAL synchronous_commit = off")
+                        psycopg2.extras.execute_values(cur, self._SQL, rows, template=self._TEMPLATE, page_size=_BATCH_PAGE_SIZE)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+        except Exception:
+            # Las filas quedan en 'in_progress' y reset_stuck_downloads las devuelve a 'pending'
+            logger.exception(f"Error escribiendo {len(rows)} estados de descarga")
+
+
+_download_status_writer: Optional[DownloadStatusWriter] = None
+_download_status_writer_lock = threading.Lock()
+
+
+def get_download_status_writer() -> DownloadStatusWriter:
+    """Obtiene el escritor de estados de descarga (singleton, arrancado bajo demanda)."""
+    global _download_status_writer
+    with _download_status_writer_lock:
+        if _download_status_writer is None:
+            _download_status_writer = DownloadStatusWriter()
+            _download_status_writer.start()
+            atexit.register(_download_status_writer.stop)
+        return _download_status_writer
+
+
+_MARK_UNRECOVERABLE_TEMPLATE = """(%s, %s, NULL, %s, %s, NULL,
+              FALSE, NULL, NULL, NULL,
+              NULL, NULL, FALSE, FALSE, FALSE, NULL, NULL,
+              FALSE, CURRENT_TIMESTAMP, %s)"""
+# %s = VALUES: una fila (mark_message_unrecoverable) o el marcador de execute_values (mark_messages_unrecoverable)
+_MARK_UNRECOVERABLE_SQL = """
+    INSERT INTO messages (
+        msg_id, chat_id, sender_id, text, media_type, media_file_path,
+        is_forward, forward_sender_id, reply_to_msg_id, edit_date,
+        views, forwards, pin, silent, is_post, ttl_period, topic_id,
+        has_log, created_at, account_phone
+    ) VALUES %s
+    ON CONFLICT (chat_id, msg_id, account_phone) DO NOTHING
+"""
+_MARK_UNRECOVERABLE_ONE_SQL = _MARK_UNRECOVERABLE_SQL % _MARK_UNRECOVERABLE_TEMPLATE
+
+
+def mark_message_unrecoverable(conn, chat_id: int, msg_id: int, account_phone: str, reason: str = "unrecoverable",
+                               *, commit: bool = True) -> None:
     """Inserta un placeholder para cerrar gaps de mensajes que Telegram no entrega."""
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            INSERT INTO messages (
-                msg_id, chat_id, sender_id, text, media_type, media_file_path,
-                is_forward, forward_sender_id, reply_to_msg_id, edit_date,
-                views, forwards, pin, silent, is_post, ttl_period, topic_id,
-                has_log, created_at, account_phone
-            ) VALUES (%s, %s, NULL, %s, %s, NULL,
-                      FALSE, NULL, NULL, NULL,
-                      NULL, NULL, FALSE, FALSE, FALSE, NULL, NULL,
-                      FALSE, CURRENT_TIMESTAMP, %s)
-            ON CONFLICT (chat_id, msg_id, account_phone) DO NOTHING
-            """,
+        _execute_prepared(
+            cur, "mark_unrecoverable", _MARK_UNRECOVERABLE_ONE_SQL,
             (msg_id, chat_id, f"__UNRECOVERABLE__:{reason}", "unrecoverable", account_phone),
         )
-    conn.commit()
+    if commit:
+        conn.commit()
+
+
+def mark_messages_unrecoverable(conn, chat_id: int, msg_ids, account_phone: str, reason: str = "unrecoverable",
+                                *, commit: bool = True) -> None:
+    """Como mark_message_unrecoverable para varios ids del chat, en una sentencia por página."""
+    if not msg_ids:
+        return
+    text = f"__UNRECOVERABLE__:{reason}"
+    rows = [(msg_id, chat_id, text, "unrecoverable", account_phone) for msg_id in sorted(msg_ids)]
+    with conn.cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur, _MARK_UNRECOVERABLE_SQL, rows, template=_MARK_UNRECOVERABLE_TEMPLATE, page_size=_BATCH_PAGE_SIZE,
+        )
+    if commit:
+        conn.commit()
 
 
 def get_chat_gaps(conn, chat_id: int, account_phone: str, limit: int = 1000) -> list:
@@ -667,6 +1351,9 @@ def get_chat_gaps(conn, chat_id: int, account_phone: str, limit: int = 1000) ->
     Retorna una lista de rangos (min_id, max_id) donde faltan mensajes.
     """
     with conn.cursor() as cur:
+        # LAG sobre idx_messages_chat_acct_msg recorrido en orden: un solo pase O(N) sin Sort,
+        # y solo las filas de gap llegan al top-N del LIMIT. Un generate_series(min, max) EXCEPT
+        # materializaría cada id del rango (incluidos los existentes) antes de agrupar.
         cur.execute(
             """
             WITH message_sequence AS (
@@ -675,7 +1362,6 @@ def get_chat_gaps(conn, chat_id: int, account_phone: str, limit: int = 1000) ->
                     LAG(msg_id) OVER (ORDER BY msg_id) as prev_msg_id
                 FROM messages
                 WHERE chat_id = %s AND account_phone = %s
-                ORDER BY msg_id
             )
             SELECT 
                 prev_msg_id + 1 as gap_start,
@@ -1,15 +1,27 @@
 import argparse
 import asyncio
+import atexit
 import logging
+import logging.handlers
 import os
-import re
 import sys
 import unicodedata
 import mimetypes
+import queue
 import threading
-from datetime import datetime
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from typing import Optional
 
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa json de la stdlib
+    orjson = None
+import json
+
 from dotenv import load_dotenv
 from telethon import TelegramClient, events
 from telethon.sessions import StringSession, SQLiteSession
@@ -22,43 +34,121 @@ from telethon.tl.types import (
     DocumentAttributeAnimated,
     DocumentAttributeSticker,
 )
-from telethon.errors import SessionPasswordNeededError
+from telethon.errors import SessionPasswordNeededError, FloodWaitError
+from telethon.utils import get_peer_id
 
 from .notifier import get_notifier
 
 from .db import (
-    get_db_connection, close_db_connection, insert_or_update_chat, insert_or_update_sender,
-    insert_message, insert_reactions, insert_entities, update_message,
-    insert_message_log, get_max_message_id_in_chat, get_chat_gaps,
-    enqueue_download, fetch_pending_downloads, fetch_recent_pending_downloads, get_downloaded_path_by_unique_id,
-    mark_download_in_progress, mark_download_done, mark_download_failed,
-    reset_stuck_downloads, mark_message_unrecoverable,
-    is_media_download_enabled,
+    get_db_connection, close_db_connection, db_conn,
+    flush_chats, flush_senders, flush_message_logs, flush_reactions, flush_entities,
+    get_max_message_id_in_chat, get_max_message_ids, get_chat_gaps,
+    enqueue_download, claim_pending_downloads, claim_recent_pending_downloads, get_downloaded_path_by_unique_id,
+    remember_downloaded_path, get_download_status_writer,
+    reset_stuck_downloads, mark_messages_unrecoverable,
+    is_media_download_enabled, MessageBuffer, CONNECTION_ERRORS,
+    get_stats, export_messages_json, get_messages_by_chat,
 )
 
 load_dotenv()
 
+# Variables de entorno consultadas en caminos calientes: se leen una sola vez al arrancar
+TG_PHONE = os.environ.get("TG_PHONE")
+TG_MEDIA_DIR = os.environ.get("TG_MEDIA_DIR") or "media_downloads"
+TG_STATE_FILE = os.environ.get("TG_STATE_FILE", "state.json")
+
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 HISTORIC_GAP_THRESHOLD = int(os.environ.get("LISTENER_HISTORIC_GAP_THRESHOLD", "10"))
+# Diálogos que el catch-up global procesa a la vez (cada uno con su pool de workers)
+_CATCHUP_PARALLEL_DIALOGS = max(1, int(os.environ.get("TG_CATCHUP_PARALLEL_DIALOGS", "4")))
+# Espera máxima entre pasadas del catch-up global una vez convergido
+_CATCHUP_IDLE_SECONDS = int(os.environ.get("TG_CATCHUP_IDLE_SECONDS", "30"))
+# Cada cuánto vuelve a pedir la lista de diálogos el catch-up global (chats nuevos)
+_CATCHUP_DIALOGS_TTL = int(os.environ.get("TG_CATCHUP_DIALOGS_TTL_SECONDS", "300"))
+
+# Todas las escrituras a fichero/consola de los loggers pasan por una cola: el bucle
+# asyncio solo encola el registro y un único hilo (QueueListener) hace la E/S.
+_LOG_FORMATTER = logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s")
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_handlers = []
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class _BufferedFileHandler(logging.FileHandler):
+    """FileHandler con buffer de 64 KiB: vuelca al llegar un WARNING+ o cada 500 ms.
+
+    Evita un write() por línea en los logs INFO de mucho volumen (live/catchup/download).
+    """
+
+    _instances = []
+    _flusher: Optional[threading.Thread] = None
+    _FLUSH_INTERVAL = 0.5
+
+    def __init__(self, filename: str, buffer_size: int = 65536, **kwargs):
+        self._buffer_size = buffer_size
+        super().__init__(filename, **kwargs)
+        _BufferedFileHandler._instances.append(self)
+        if _BufferedFileHandler._flusher is None:
+            _BufferedFileHandler._flusher = threading.Thread(
+                target=_BufferedFileHandler._flush_loop, name="log-flusher", daemon=True
+            )
+            _BufferedFileHandler._flusher.start()
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self._buffer_size,
+                    encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except Exception:
+            self.handleError(record)
 
-# File handler para SOLO errores/avisos persistentes (WARNING, ERROR, CRITICAL)
+    @staticmethod
+    def _flush_loop() -> None:
+        while True:
+            time.sleep(_BufferedFileHandler._FLUSH_INTERVAL)
+            for handler in list(_BufferedFileHandler._instances):
+                try:
+                    handler.flush()
+                except Exception:
+                    pass
+
+
+def _add_queued_handler(handler: logging.Handler, logger_name: str) -> None:
+    """Registra un handler real en el listener, solo para registros de logger_name."""
+    handler.setFormatter(_LOG_FORMATTER)
+    handler.addFilter(logging.Filter(logger_name))
+    _log_handlers.append(handler)
+    if _log_listener is not None:
+        _log_listener.handlers = tuple(_log_handlers)
+
+
+def _attach_queue_handler(target: logging.Logger) -> None:
+    if not any(isinstance(h, logging.handlers.QueueHandler) for h in target.handlers):
+        target.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+
+# File handler para SOLO errores/avisos persistentes (WARNING, ERROR, CRITICAL); sin buffer
 _error_log_file = os.environ.get("TG_ERROR_LOG", "/output/err-logs/tel-cli.error.log")
 os.makedirs(os.path.dirname(_error_log_file), exist_ok=True)
-if not any(isinstance(h, logging.FileHandler) and h.baseFilename == _error_log_file for h in logger.handlers):
-    fh_error = logging.FileHandler(_error_log_file, encoding="utf-8")
-    fh_error.setLevel(logging.WARNING)  # SOLO WARNING, ERROR, CRITICAL
-    fh_error.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-    logger.addHandler(fh_error)
+fh_error = logging.FileHandler(_error_log_file, encoding="utf-8")
+fh_error.setLevel(logging.WARNING)  # SOLO WARNING, ERROR, CRITICAL
+_add_queued_handler(fh_error, logger.name)
 
 # File handler para salida estándar (INFO y superiores)
 _output_log_file = os.environ.get("TG_OUTPUT_LOG", "/output/out-logs/tel-cli.output.log")
 os.makedirs(os.path.dirname(_output_log_file), exist_ok=True)
-if not any(isinstance(h, logging.FileHandler) and h.baseFilename == _output_log_file for h in logger.handlers):
-    fh_output = logging.FileHandler(_output_log_file, encoding="utf-8")
-    fh_output.setLevel(logging.INFO)  # INFO, WARNING, ERROR, CRITICAL
-    fh_output.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-    logger.addHandler(fh_output)
+fh_output = _BufferedFileHandler(_output_log_file, encoding="utf-8")
+fh_output.setLevel(logging.INFO)  # INFO, WARNING, ERROR, CRITICAL
+_add_queued_handler(fh_output, logger.name)
+_attach_queue_handler(logger)
+
+
+_log_dirs_created = {os.path.dirname(_error_log_file), os.path.dirname(_output_log_file)}
 
 
 # Loggers por thread (separados)
@@ -68,26 +158,26 @@ def _create_thread_logger(thread_name: str):
     thread_logger.setLevel(logging.INFO)
     thread_logger.propagate = False
     
-    # Fichero del thread
+    # Fichero del thread (el directorio se crea una sola vez por proceso)
     out_logs_dir = "/output/out-logs"
-    os.makedirs(out_logs_dir, exist_ok=True)
+    if out_logs_dir not in _log_dirs_created:
+        os.makedirs(out_logs_dir, exist_ok=True)
+        _log_dirs_created.add(out_logs_dir)
     log_file = f"{out_logs_dir}/tel-cli.{thread_name.lower()}.log"
     
     # Remover handlers anteriores si existen
     thread_logger.handlers.clear()
     
-    # File handler para este thread
-    fh = logging.FileHandler(log_file, encoding="utf-8")
+    # File handler y consola para este thread (los escribe el hilo del listener)
+    fh = _BufferedFileHandler(log_file, encoding="utf-8")
     fh.setLevel(logging.INFO)
-    fh.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-    thread_logger.addHandler(fh)
+    _add_queued_handler(fh, thread_logger.name)
     
-    # Console handler
     ch = logging.StreamHandler()
     ch.setLevel(logging.INFO)
-    ch.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s"))
-    thread_logger.addHandler(ch)
-    
+    _add_queued_handler(ch, thread_logger.name)
+
+    _attach_queue_handler(thread_logger)
     return thread_logger
 
 
@@ -96,11 +186,31 @@ logger_live = _create_thread_logger("live")
 logger_catchup = _create_thread_logger("catchup")
 logger_download = _create_thread_logger("download")
 
+_log_listener = logging.handlers.QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 # Cliente compartido para todos los threads (DEPRECATED - cada thread debe crear su propio)
 _shared_client = None
 _shared_client_lock = threading.Lock()
 
 
+@lru_cache(maxsize=1)
+def _parsed_string_session() -> Optional[tuple]:
+    """Decodifica TG_SESSION_STRING una sola vez: (dc_id, server_address, port, auth_key, takeout_id) o None."""
+    session_string = os.environ.get("TG_SESSION_STRING")
+    if not session_string:
+        return None
+    string_session = StringSession(session_string)
+    return (
+        string_session.dc_id,
+        string_session.server_address,
+        string_session.port,
+        string_session.auth_key,
+        getattr(string_session, "takeout_id", None),
+    )
+
+
 def build_client() -> TelegramClient:
     """
     Construye cliente de Telegram con FileSession.
@@ -117,30 +227,31 @@ def build_client() -> TelegramClient:
     session_base = "/app/me"  # Telethon creará /app/me.session
 
     # 1) Si no existe el archivo y tenemos TG_SESSION_STRING, materializarlo a FileSession
-    if not os.path.exists(session_file):
-        session_string = os.environ.get("TG_SESSION_STRING")
-        if session_string:
-            logger.info("🧩 TG_SESSION_STRING detectado: generando /app/me.session antes de conectar...")
-            file_session = SQLiteSession(session_base)
-            string_session = StringSession(session_string)
-
-            # Copiar parámetros de DC/autenticación
-            file_session.set_dc(string_session.dc_id, string_session.server_address, string_session.port)
-            file_session.auth_key = string_session.auth_key
-
-            # Copiar takeout_id si existiera
-            if hasattr(string_session, "takeout_id") and hasattr(file_session, "takeout_id"):
-                file_session.takeout_id = getattr(string_session, "takeout_id")
-
-            file_session.save()
-
-            if os.path.exists(session_file):
-                logger.info("✅ /app/me.session creado desde TG_SESSION_STRING")
-            else:
-                logger.warning("⚠️ No se pudo verificar la creación de /app/me.session; se intentará igualmente")
+    session_exists = os.path.exists(session_file)
+    parsed = None if session_exists else _parsed_string_session()
+    if parsed is not None:
+        logger.info("🧩 TG_SESSION_STRING detectado: generando /app/me.session antes de conectar...")
+        dc_id, server_address, port, auth_key, takeout_id = parsed
+        file_session = SQLiteSession(session_base)
+
+        # Copiar parámetros de DC/autenticación
+        file_session.set_dc(dc_id, server_address, port)
+        file_session.auth_key = auth_key
+
+        # Copiar takeout_id si existiera
+        if takeout_id is not None and hasattr(file_session, "takeout_id"):
+            file_session.takeout_id = takeout_id
+
+        file_session.save()
+
+        session_exists = os.path.exists(session_file)
+        if session_exists:
+            logger.info("✅ /app/me.session creado desde TG_SESSION_STRING")
+        else:
+            logger.warning("⚠️ No se pudo verificar la creación de /app/me.session; se intentará igualmente")
 
     # 2) Usar siempre FileSession (necesario para persistencia y event handlers)
-    if os.path.exists(session_file):
+    if session_exists:
         logger.info(f"✅ Usando FileSession: {session_file}")
         session = session_base
     else:
@@ -195,6 +306,40 @@ async def _ensure_connected(client: TelegramClient, sleep_seconds: int = 10) ->
         return False
 
 
+async def _with_retry(coro_factory, *, label: str, context: str, failure: str, tries: int = 5,
+                      client: Optional[TelegramClient] = None, pause: float = 0.0) -> bool:
+    """Ejecuta coro_factory() con reintentos y backoff exponencial; devuelve True si tuvo éxito.
+
+    FloodWaitError espera lo que indica Telegram sin gastar intento; ValueError/TypeError son
+    datos inválidos y no se reintentan. Con client, reconecta antes de cada intento.
+    """
+    retry_count = 0
+    last_exception = None
+    while retry_count < tries:
+        if client is not None and not await _ensure_connected(client, sleep_seconds=min(60, 2 ** retry_count)):
+            retry_count += 1
+            last_exception = RuntimeError("Cliente desconectado")
+            continue
+        try:
+            await coro_factory()
+            return True
+        except FloodWaitError as e:
+            logger.warning(f"⏳ FloodWait {e.seconds}s en {label}; reintentando tras la espera")
+            await asyncio.sleep(e.seconds + 1)
+        except (ValueError, TypeError):
+            logger.exception(f"❌ FALLO CRÍTICO: {label} en {context}: error no recuperable, sin reintentos. {failure}")
+            return False
+        except Exception as e:
+            retry_count += 1
+            last_exception = e
+            if retry_count < tries:
+                wait_time = 2 ** retry_count  # Backoff exponencial: 2s, 4s, 8s, 16s
+                logger.warning(f"Error en {label} (intento {retry_count}/{tries}), reintentando en {wait_time}s: {str(e)}")
+                await asyncio.sleep(wait_time + pause)
+    logger.error(f"❌ FALLO CRÍTICO: {label} en {context} tras {tries} reintentos. {failure}", exc_info=last_exception)
+    return False
+
+
 def _is_interactive_tty() -> bool:
     try:
         return bool(sys.stdin and sys.stdin.isatty())
@@ -257,12 +402,19 @@ async def list_dialogs(client: TelegramClient, limit: int) -> None:
         print(f"{dialog.id} | {tipo} | {username_fmt} | {name}")
 
 
+_LABEL_EXTRA_CHARS = frozenset("-_. ")
+
+
 def _sanitize_label(text: str) -> str:
-    allowed = "-_. "
-    return "".join(c for c in text if c.isalnum() or c in allowed).strip().replace(" ", "_")
+    # isalnum() (Unicode) se mantiene: las etiquetas con acentos/otros alfabetos no deben cambiar
+    return "".join(c for c in text if c.isalnum() or c in _LABEL_EXTRA_CHARS).strip().replace(" ", "_")
 
 
-INVALID_FS_CHARS_RE = re.compile(r'[<>:"/\\|?*\x00-\x1F]')
+# Caracteres inválidos en nombres de fichero (<>:"/\|?* y controles 0x00-0x1F) -> "-";
+# \n, \r y \t pasan a espacio para que el colapso de espacios los absorba
+_FS_TRANSLATE = str.maketrans(
+    {**{c: "-" for c in '<>:"/\\|?*'}, **{chr(i): "-" for i in range(0x20)}, "\n": " ", "\r": " ", "\t": " "}
+)
 WINDOWS_RESERVED_NAMES = {"CON", "PRN", "AUX", "NUL"}
 WINDOWS_RESERVED_NAMES.update({f"COM{i}" for i in range(1, 10)})
 WINDOWS_RESERVED_NAMES.update({f"LPT{i}" for i in range(1, 10)})
@@ -271,9 +423,9 @@ MAX_FILENAME_LENGTH = 180
 
 def _sanitize_filename(name: str, max_length: int = MAX_FILENAME_LENGTH) -> str:
     """Sanitize file names for cross-platform safety."""
-    normalized = unicodedata.normalize("NFC", name or "").replace("\n", " ").replace("\r", " ").replace("\t", " ")
-    cleaned = INVALID_FS_CHARS_RE.sub("-", normalized)
-    cleaned = re.sub(r"\s+", " ", cleaned).strip(" .")
+    cleaned = unicodedata.normalize("NFC", name or "").translate(_FS_TRANSLATE)
+    # split() sin argumentos colapsa cualquier racha de espacios Unicode (como \s+)
+    cleaned = " ".join(cleaned.split()).strip(" .")
 
     if not cleaned:
         cleaned = "file"
@@ -288,6 +440,7 @@ def _sanitize_filename(name: str, max_length: int = MAX_FILENAME_LENGTH) -> str:
     return f"{base}{ext}" if base else f"file{ext}"
 
 
+@lru_cache(maxsize=512)
 def _guess_extension_from_mime(mime_type: Optional[str]) -> Optional[str]:
     if not mime_type:
         return None
@@ -295,34 +448,62 @@ def _guess_extension_from_mime(mime_type: Optional[str]) -> Optional[str]:
     return guessed if guessed else None
 
 
-def _classify_media_type(message) -> str:
-    doc = getattr(message, "document", None)
-    if getattr(message, "photo", None):
+# Atributo de documento -> categoría; DocumentAttributeAudio depende de .voice y va aparte
+_MEDIA_ATTR_TYPES = {
+    DocumentAttributeSticker: "sticker",
+    DocumentAttributeVideo: "video",
+    DocumentAttributeAnimated: "animation",
+    DocumentAttributeAudio: None,
+}
+
+
+@lru_cache(maxsize=256)
+def _classify_media_type_cached(has_photo: bool, attr_kind: Optional[tuple], mime_type: Optional[str],
+                                has_voice: bool, media_class: Optional[str]) -> str:
+    if has_photo:
         return "photo"
-    if doc:
-        attrs = getattr(doc, "attributes", []) or []
-        for attr in attrs:
-            if isinstance(attr, DocumentAttributeSticker):
-                return "sticker"
-            if isinstance(attr, DocumentAttributeAudio):
-                return "voice" if getattr(attr, "voice", False) else "audio"
-            if isinstance(attr, DocumentAttributeVideo):
-                return "video"
-            if isinstance(attr, DocumentAttributeAnimated):
-                return "animation"
-        mime_type = getattr(doc, "mime_type", "") or ""
+    if mime_type is not None:
+        if attr_kind is not None:
+            kind, voice = attr_kind
+            if kind is DocumentAttributeAudio:
+                return "voice" if voice else "audio"
+            return _MEDIA_ATTR_TYPES[kind]
+        mime_type = mime_type or ""
         if mime_type.startswith("video/"):
             return "video"
         if mime_type.startswith("audio/"):
             return "audio"
         return "document"
-    if getattr(message, "voice", None):
+    if has_voice:
         return "voice"
-    if getattr(message, "media", None):
-        return type(message.media).__name__ or "other"
+    if media_class is not None:
+        return media_class or "other"
     return "other"
 
 
+def _classify_media_type(message) -> str:
+    # Se reduce el mensaje a una clave hashable pequeña: ráfagas del mismo tipo de media
+    # salen de la caché. Solo decide el primer atributo reconocido (búsqueda por type() en un dict).
+    doc = getattr(message, "document", None)
+    attr_kind = None
+    mime_type = None
+    if doc:
+        for attr in getattr(doc, "attributes", None) or ():
+            kind = type(attr)
+            if kind in _MEDIA_ATTR_TYPES:
+                attr_kind = (kind, kind is DocumentAttributeAudio and bool(getattr(attr, "voice", False)))
+                break
+        mime_type = getattr(doc, "mime_type", "") or ""
+    media = getattr(message, "media", None)
+    return _classify_media_type_cached(
+        bool(getattr(message, "photo", None)),
+        attr_kind,
+        mime_type,
+        bool(getattr(message, "voice", None)),
+        type(media).__name__ if media else None,
+    )
+
+
 def _infer_media_filename(message, media_type: str, file_unique_id: Optional[str] = None) -> str:
     file_obj = getattr(message, "file", None)
     name = getattr(file_obj, "name", None) if file_obj else None
@@ -346,30 +527,188 @@ def _infer_media_filename(message, media_type: str, file_unique_id: Optional[str
     return _sanitize_filename(name)
 
 
+@lru_cache(maxsize=None)
 def _media_base_dir(media_dir: Optional[str]) -> str:
-    base = media_dir or os.environ.get("TG_MEDIA_DIR") or "media_downloads"
-    phone = os.environ.get("TG_PHONE", "default")
+    base = media_dir or TG_MEDIA_DIR
+    phone = TG_PHONE or "default"
     return os.path.join(base, phone)
 
 
-def _write_chat_metadata(chat, base_dir: str) -> None:
-    chat_id = getattr(chat, "id", None)
-    if chat_id is None:
+# Directorios ya creados por este proceso (evita un makedirs/stat por descarga)
+_dirs_created: set = set()
+_dirs_created_lock = threading.Lock()
+
+
+def _ensure_dir(path: str) -> None:
+    if path in _dirs_created:
         return
+    os.makedirs(path, exist_ok=True)
+    with _dirs_created_lock:
+        _dirs_created.add(path)
+
+
+def _json_dumps(obj) -> bytes:
+    """Serializa a JSON indentado en UTF-8 (orjson si está instalado)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+# (base_dir, chat_id) -> (title, username) ya escritos en .metadata.json
+_chat_meta_cache: dict = {}
+
+
+def _write_chat_metadata_sync(chat_id: int, title: Optional[str], username: Optional[str], base_dir: str) -> bool:
     metadata = {
         "chat_id": chat_id,
-        "title": getattr(chat, "title", None),
-        "username": getattr(chat, "username", None),
+        "title": title,
+        "username": username,
         "updated_at": datetime.utcnow().isoformat() + "Z",
     }
     path = os.path.join(base_dir, str(chat_id), ".metadata.json")
-    os.makedirs(os.path.dirname(path), exist_ok=True)
     try:
-        import json
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        _ensure_dir(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(_json_dumps(metadata))
+        return True
     except Exception:
         logger.warning(f"No se pudo escribir metadata de chat {chat_id}")
+        return False
+
+
+async def _write_chat_metadata(chat, base_dir: str) -> None:
+    """Escribe .metadata.json del chat solo si title/username cambiaron, fuera del event loop."""
+    chat_id = getattr(chat, "id", None)
+    if chat_id is None:
+        return
+    title = getattr(chat, "title", None)
+    username = getattr(chat, "username", None)
+    key = (base_dir, chat_id)
+    if _chat_meta_cache.get(key) == (title, username):
+        return
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, _write_chat_metadata_sync, chat_id, title, username, base_dir):
+        _chat_meta_cache[key] = (title, username)
+
+
+# Escritura de mensajes por lotes: el buffer se vuelca al llegar a TG_DB_FLUSH_ROWS mensajes
+# o cada TG_DB_FLUSH_MS milisegundos (una transacción por lote en vez de una por mensaje).
+# Aviso al catch-up global en reposo: un mensaje que no llegó a BD o un gap pequeño lo despiertan
+_catchup_wakeup: Optional[asyncio.Event] = None
+_catchup_wakeup_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _request_catchup() -> None:
+    """Despierta al catch-up global; se puede llamar desde el hilo escritor."""
+    if _catchup_wakeup is None:
+        return
+    try:
+        on_loop = asyncio.get_running_loop() is _catchup_wakeup_loop
+    except RuntimeError:
+        on_loop = False
+    if on_loop:
+        _catchup_wakeup.set()
+    else:
+        _catchup_wakeup_loop.call_soon_threadsafe(_catchup_wakeup.set)
+
+
+_message_buffer = MessageBuffer(max_rows=int(os.environ.get("TG_DB_FLUSH_ROWS", "500")), on_failure=_request_catchup)
+_MESSAGE_FLUSH_INTERVAL = int(os.environ.get("TG_DB_FLUSH_MS", "200")) / 1000
+# Con más de TG_DB_BACKPRESSURE_ROWS mensajes pendientes el productor espera al volcado
+_MESSAGE_BACKPRESSURE_ROWS = int(os.environ.get("TG_DB_BACKPRESSURE_ROWS", str(_message_buffer.max_rows * 4)))
+_message_flusher_task: Optional[asyncio.Task] = None
+_message_flush_requested: Optional[asyncio.Event] = None
+# Un único hilo escritor: los volcados no bloquean el event loop y se aplican en orden
+_db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+
+def flush_message_buffer() -> int:
+    """Vuelca a BD los mensajes pendientes del buffer; devuelve cuántos se escribieron."""
+    if not len(_message_buffer):
+        return 0
+    try:
+        with db_conn(rows="tuple") as db:
+            return _message_buffer.flush(db)
+    except CONNECTION_ERRORS:
+        # El lote ha vuelto al buffer; el pool descarta la conexión rota y se pide otra
+        logger.warning("Conexión perdida volcando el buffer de mensajes; reintento con otra conexión")
+        with db_conn(rows="tuple") as db:
+            return _message_buffer.flush(db)
+
+
+async def flush_message_buffer_async(drain: bool = False) -> int:
+    """Como flush_message_buffer, pero en el hilo escritor sin bloquear el event loop.
+
+    Con drain=True se pasa siempre por el hilo, así que al volver también han terminado
+    los volcados que ya estuvieran en curso.
+    """
+    if not drain and not len(_message_buffer):
+        return 0
+    return await asyncio.get_running_loop().run_in_executor(_db_writer, flush_message_buffer)
+
+
+async def _db_read(fn, *args, rows: str = "tuple"):
+    """Ejecuta fn(conexión, *args) con una conexión del pool en un hilo del executor por defecto.
+
+    Para lecturas: no bloquean el event loop y no esperan detrás de las escrituras de _db_writer.
+    """
+    def _run():
+        with db_conn(rows=rows) as db:
+            return fn(db, *args)
+
+    return await asyncio.get_running_loop().run_in_executor(None, _run)
+
+
+def _db_ping(db) -> None:
+    with db.cursor() as cur:
+        cur.execute("SELECT 1")
+
+
+async def _message_flusher() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_message_flush_requested.wait(), timeout=_MESSAGE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _message_flush_requested.clear()
+        try:
+            await flush_message_buffer_async()
+        except Exception:
+            logger.exception("Error volcando el buffer de mensajes")
+
+
+def _ensure_message_flusher() -> None:
+    global _message_flusher_task, _message_flush_requested
+    if _message_flusher_task is None or _message_flusher_task.done():
+        _message_flush_requested = asyncio.Event()
+        _message_flusher_task = asyncio.get_running_loop().create_task(_message_flusher())
+
+
+# (chat_id, cuenta) -> mayor msg_id conocido. Todas las escrituras de la cuenta pasan por este
+# proceso, así que basta con leerlo de BD una vez por chat y mantenerlo en memoria.
+_chat_max_ids: dict = {}
+
+
+async def _previous_max_message_id(chat_id: int, account_phone: str, msg_id: int) -> int:
+    """Devuelve el mayor msg_id previo del chat y registra msg_id como visto."""
+    key = (chat_id, account_phone)
+    previous = _chat_max_ids.get(key)
+    if previous is None:
+        previous = await _db_read(get_max_message_id_in_chat, chat_id, account_phone)
+        # Lo pendiente en el buffer aún no está en BD: cuenta para no ver gaps falsos
+        previous = max(previous, _message_buffer.pending_max_id(chat_id, account_phone))
+        # Otro mensaje del chat pudo registrarse mientras se leía la BD
+        previous = max(previous, _chat_max_ids.get(key, 0))
+    _chat_max_ids[key] = max(previous, msg_id)
+    return previous
+
+
+# chat_id -> tarea de catch-up en background en curso
+_catchup_inflight: dict = {}
 
 
 async def _catch_up_chat_background(client: TelegramClient, chat_id: int, download: bool, media_dir: Optional[str], max_mb: Optional[int], account_phone: str = None) -> None:
@@ -381,26 +720,58 @@ async def _catch_up_chat_background(client: TelegramClient, chat_id: int, downlo
 
 
 def _state_path() -> str:
-    return os.environ.get("TG_STATE_FILE", "state.json")
+    return TG_STATE_FILE
 
 
 def _load_state() -> dict:
     path = _state_path()
     if os.path.exists(path):
         try:
-            import json
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return _json_loads(f.read())
         except Exception:
             return {}
     return {}
 
 
-def _save_state(state: dict) -> None:
-    import json
+def _write_state_file(data: bytes) -> None:
+    """Escritura atómica: fichero temporal + os.replace (un corte a mitad no corrompe el estado)."""
     path = _state_path()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# Guardado en segundo plano: como mucho una escritura en curso; las llamadas mientras tanto
+# solo marcan el estado como sucio y se agrupan en la siguiente escritura.
+_state_save_task: Optional[asyncio.Task] = None
+_state_dirty: Optional[dict] = None
+
+
+async def _state_saver() -> None:
+    global _state_dirty
+    loop = asyncio.get_running_loop()
+    while _state_dirty is not None:
+        # Se serializa en el bucle (el dict se sigue modificando aquí) y se escribe en un hilo
+        data = _json_dumps(_state_dirty)
+        _state_dirty = None
+        try:
+            await loop.run_in_executor(None, _write_state_file, data)
+        except Exception:
+            logger.warning("No se pudo guardar el estado en disco")
+
+
+def _save_state(state: dict) -> None:
+    global _state_save_task, _state_dirty
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _write_state_file(_json_dumps(state))
+        return
+    _state_dirty = state
+    if _state_save_task is None or _state_save_task.done():
+        _state_save_task = asyncio.create_task(_state_saver())
 
 
 def _update_last_id(state: dict, chat_id: int, message_id: int) -> None:
@@ -410,8 +781,73 @@ def _update_last_id(state: dict, chat_id: int, message_id: int) -> None:
         state[key] = {"last_id": message_id}
 
 
-async def _download_media_task(message, chat, media_dir: Optional[str], max_mb: Optional[int]) -> Optional[str]:
+# Descarga en paralelo por tramos para ficheros grandes (varias peticiones getFile en vuelo)
+_DOWNLOAD_WORKERS = int(os.environ.get("TG_DOWNLOAD_WORKERS", "4"))
+_PARALLEL_DOWNLOAD_MIN_BYTES = int(os.environ.get("TG_PARALLEL_DOWNLOAD_MIN_MB", "10")) * 1024 * 1024
+_DOWNLOAD_REQUEST_SIZE = 512 * 1024
+
+
+async def _parallel_download(message, target_path: str, file_size: int, workers: int = _DOWNLOAD_WORKERS) -> Optional[str]:
+    """Descarga el documento del mensaje en `workers` tramos concurrentes escritos con os.pwrite.
+
+    Ante un FloodWaitError espera lo indicado y reintenta con la mitad de tramos; con uno
+    solo recurre a download_media.
+    """
+    client = message.client
+    part_path = f"{target_path}.part"
+    while workers > 1:
+        part_size = -(-file_size // workers)
+        part_size = -(-part_size // _DOWNLOAD_REQUEST_SIZE) * _DOWNLOAD_REQUEST_SIZE
+        fd = os.open(part_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, file_size)
+
+            async def _download_part(start: int) -> None:
+                offset = start
+                async for chunk in client.iter_download(
+                    message.media,
+                    offset=start,
+                    limit=part_size // _DOWNLOAD_REQUEST_SIZE,
+                    request_size=_DOWNLOAD_REQUEST_SIZE,
+                    file_size=file_size,
+                ):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+
+            tasks = [asyncio.ensure_future(_download_part(start)) for start in range(0, file_size, part_size)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Un tramo falló: parar los demás antes de cerrar el descriptor
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        except FloodWaitError as e:
+            os.close(fd)
+            workers //= 2
+            logger.warning(f"  ⏳ FloodWait {e.seconds}s descargando msg_id={message.id}; reintento con {max(1, workers)} tramos")
+            await asyncio.sleep(e.seconds)
+            continue
+        except BaseException:
+            os.close(fd)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        os.close(fd)
+        os.replace(part_path, target_path)
+        return target_path
+
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return await message.download_media(file=target_path)
+
+
+async def _download_media_task(message, chat, media_dir: Optional[str], max_mb: Optional[int], account_phone: str = None) -> Optional[str]:
     """Descarga media en segundo plano con nombres saneados y rutas por chat_id/tipo."""
+    if account_phone is None:
+        account_phone = TG_PHONE or "unknown"
     try:
         file_size = None
         if getattr(message, "file", None) and hasattr(message.file, "size"):
@@ -429,83 +865,116 @@ async def _download_media_task(message, chat, media_dir: Optional[str], max_mb:
 
         media_category = _classify_media_type(message)
         base_dir = _media_base_dir(media_dir)
-        _write_chat_metadata(chat, base_dir)
+        await _write_chat_metadata(chat, base_dir)
         chat_dir = os.path.join(base_dir, str(message.chat_id), media_category)
-        os.makedirs(chat_dir, exist_ok=True)
+        _ensure_dir(chat_dir)
 
         file_unique_id = getattr(message.file, "unique_id", None) if getattr(message, "file", None) else None
         filename = _infer_media_filename(message, media_category, file_unique_id)
         target_path = os.path.normpath(os.path.join(chat_dir, filename))
 
-        path = await message.download_media(file=target_path)
+        if (
+            getattr(message, "document", None) is not None
+            and file_size is not None
+            and file_size >= _PARALLEL_DOWNLOAD_MIN_BYTES
+            and _DOWNLOAD_WORKERS > 1
+        ):
+            path = await _parallel_download(message, target_path, file_size)
+        else:
+            path = await message.download_media(file=target_path)
         if not path:
             logger.info(f"  ✗ No se pudo descargar media de msg_id={message.id}")
             return None
 
         logger.info(f"  ✓ Descargado msg_id={message.id}: {path}")
 
-        db = get_db_connection()
-        try:
-            with db.cursor() as cur:
-                cur.execute("UPDATE messages SET media_file_path = %s WHERE msg_id = %s AND chat_id = %s", (path, message.id, message.chat_id))
-            db.commit()
-            return path
-        finally:
-            close_db_connection(db)
+        def _write_path() -> None:
+            with db_conn(rows="tuple") as db:
+                # Una descarga pequeña puede terminar antes del volcado periódico: sin él, el UPDATE no encontraría la fila
+                _message_buffer.flush(db)
+                with db.cursor() as cur:
+                    cur.execute(
+                        "UPDATE messages SET media_file_path = %s WHERE msg_id = %s AND chat_id = %s AND account_phone = %s",
+                        (path, message.id, message.chat_id, account_phone),
+                    )
+                db.commit()
+
+        await asyncio.get_running_loop().run_in_executor(_db_writer, _write_path)
+        return path
     except Exception as exc:
         logger.warning(f"  ✗ Error descargando media msg_id={getattr(message, 'id', '?')}: {exc}")
         return None
 
 
 def _get_file_size(message) -> Optional[int]:
-    size = None
-    if getattr(message, "file", None) and hasattr(message.file, "size"):
-        size = message.file.size
-    elif getattr(message, "media", None) and hasattr(message.media, "size"):
-        size = message.media.size
-    return size
+    # message.file es una propiedad de Telethon: se lee una sola vez
+    file = getattr(message, "file", None)
+    if file:
+        try:
+            return file.size
+        except AttributeError:
+            pass
+    media = getattr(message, "media", None)
+    if media:
+        try:
+            return media.size
+        except AttributeError:
+            pass
+    return None
 
 
-async def _enqueue_media_download(message, chat, media_dir: Optional[str], max_mb: Optional[int], account_phone: str = None) -> None:
+async def _enqueue_media_download(message, chat, media_dir: Optional[str], max_mb: Optional[int], account_phone: str = None, update_row: bool = True) -> Optional[str]:
+    """Encola la descarga de la media del mensaje; devuelve la ruta si ya estaba descargada.
+
+    Con update_row=False la ruta reutilizada no se escribe en messages: el llamante la pone
+    en la fila que aún va a añadir al buffer.
+    """
     if account_phone is None:
-        account_phone = os.environ.get("TG_PHONE", "unknown")
+        account_phone = TG_PHONE or "unknown"
         
-    # Respeta preferencia de descarga (por defecto True si no existe registro)
-    pref_conn = get_db_connection()
-    try:
-        enabled = is_media_download_enabled(pref_conn, message.chat_id, account_phone)
-    finally:
-        close_db_connection(pref_conn)
-    if not enabled:
-        logger.info(f"  ⊘ Media saltada por preferencia deshabilitada: chat={message.chat_id} cuenta={account_phone}")
-        return
-
     file_size = _get_file_size(message)
     if max_mb is not None and file_size is not None and file_size > max_mb * 1024 * 1024:
         logger.info(
             f"  ⊘ Media saltada (>{max_mb}MB): msg_id={message.id}, size={(file_size/1024/1024):.2f}MB"
         )
-        return
+        return None
 
     chat_label = str(message.chat_id)
     file_unique_id = None
     if getattr(message, "file", None) is not None:
         file_unique_id = getattr(message.file, "unique_id", None)
-    db = get_db_connection()
-    try:
-        existing_path = get_downloaded_path_by_unique_id(db, file_unique_id)
-        if existing_path:
-            with db.cursor() as cur:
-                cur.execute(
-                    "UPDATE messages SET media_file_path = %s WHERE msg_id = %s AND chat_id = %s AND account_phone = %s",
-                    (existing_path, message.id, message.chat_id, account_phone),
-                )
-            db.commit()
-            logger.info(f"  ⊘ Media ya descargada (file_unique_id) reutilizada: {existing_path}")
-        else:
+
+    def _write_enqueue() -> tuple:
+        # Una sola conexión del pool para preferencia + deduplicación + encolado.
+        # Devuelve (encolada, ruta reutilizada)
+        with db_conn() as db:
+            # Respeta preferencia de descarga (por defecto True si no existe registro)
+            if not is_media_download_enabled(db, message.chat_id, account_phone):
+                logger.info(f"  ⊘ Media saltada por preferencia deshabilitada: chat={message.chat_id} cuenta={account_phone}")
+                return False, None
+
+            existing_path = get_downloaded_path_by_unique_id(db, file_unique_id)
+            if existing_path:
+                logger.info(f"  ⊘ Media ya descargada (file_unique_id) reutilizada: {existing_path}")
+                if update_row:
+                    # El mensaje puede seguir en el buffer: sin volcarlo, el UPDATE no encontraría la fila
+                    _message_buffer.flush(db)
+                    with db.cursor() as cur:
+                        cur.execute(
+                            "UPDATE messages SET media_file_path = %s WHERE msg_id = %s AND chat_id = %s AND account_phone = %s",
+                            (existing_path, message.id, message.chat_id, account_phone),
+                        )
+                    db.commit()
+                return False, existing_path
             enqueue_download(db, message.id, message.chat_id, chat_label, media_dir, file_size, file_unique_id, account_phone)
-    finally:
-        close_db_connection(db)
+            return True, None
+
+    # En el hilo escritor, como los volcados del buffer: el commit no frena el event loop
+    enqueued, existing_path = await asyncio.get_running_loop().run_in_executor(_db_writer, _write_enqueue)
+    if enqueued:
+        # El Event de asyncio solo se toca desde el loop
+        _notify_download_enqueued()
+    return existing_path
 
 
 async def _process_queue_item(client: TelegramClient, row: dict, semaphore: asyncio.Semaphore, media_dir: Optional[str], max_mb: Optional[int], download_logger) -> None:
@@ -530,21 +999,19 @@ async def _process_queue_item(client: TelegramClient, row: dict, semaphore: asyn
                 if not msg:
                     raise RuntimeError("Mensaje no encontrado para descarga")
 
-                chat = await msg.get_chat()
+                chat = await _message_entity(msg, "chat")
                 chat_name = getattr(chat, 'title', None) or getattr(chat, 'username', None) or str(row['chat_id'])
                 download_logger.info(f"   Descargando de '{chat_name}' - MSG#{row['msg_id']}")
-                path = await _download_media_task(msg, chat, row.get("media_dir") or media_dir, max_mb)
+                path = await _download_media_task(msg, chat, row.get("media_dir") or media_dir, max_mb, row.get("account_phone"))
 
-                conn2 = get_db_connection()
-                try:
-                    if path:
-                        mark_download_done(conn2, row["id"], path)
-                        download_logger.info(f"   ✓ Descarga completada: {path}")
-                    else:
-                        mark_download_failed(conn2, row["id"], "Sin ruta devuelta")
-                        download_logger.warning(f"   ✗ Descarga sin ruta devuelta para MSG#{row['msg_id']}")
-                finally:
-                    close_db_connection(conn2)
+                # El estado se escribe en segundo plano, agrupado con el de otras descargas
+                if path:
+                    get_download_status_writer().done(row["id"], path)
+                    remember_downloaded_path(row.get("file_unique_id"), path)
+                    download_logger.info(f"   ✓ Descarga completada: {path}")
+                else:
+                    get_download_status_writer().failed(row["id"], "Sin ruta devuelta")
+                    download_logger.warning(f"   ✗ Descarga sin ruta devuelta para MSG#{row['msg_id']}")
                 return
             except Exception as exc:
                 retry_count += 1
@@ -557,15 +1024,20 @@ async def _process_queue_item(client: TelegramClient, row: dict, semaphore: asyn
                     await asyncio.sleep(wait_time)
                     continue
 
-                conn3 = get_db_connection()
-                try:
-                    mark_download_failed(conn3, row["id"], str(last_exception))
-                    download_logger.error(f"   ❌ Error descargando MSG#{row['msg_id']}: {str(last_exception)[:100]}")
-                finally:
-                    close_db_connection(conn3)
+                get_download_status_writer().failed(row["id"], str(last_exception))
+                download_logger.error(f"   ❌ Error descargando MSG#{row['msg_id']}: {str(last_exception)[:100]}")
                 return
 
 
+# Aviso al productor de la cola de descargas cuando se encola algo nuevo (evita esperar al sondeo)
+_download_wakeup: Optional[asyncio.Event] = None
+
+
+def _notify_download_enqueued() -> None:
+    if _download_wakeup is not None:
+        _download_wakeup.set()
+
+
 async def process_download_queue(
     client: TelegramClient,
     media_dir: Optional[str],
@@ -576,18 +1048,20 @@ async def process_download_queue(
 ) -> None:
     """Procesa la cola de descargas con prioridad a mensajes recientes.
 
-    - Concurrencia total: 8 (por defecto).
+    - Concurrencia total: 8 (por defecto), como workers persistentes que leen de una asyncio.PriorityQueue.
+    - Un único productor reclama filas en BD (SKIP LOCKED) solo cuando hay workers libres.
     - Reserva mínima: 3 slots dedicados a los mensajes más recientes disponibles.
     """
-    semaphore = asyncio.Semaphore(max(1, concurrency))
-    min_recent_slots = 3
+    global _download_wakeup
+    concurrency = max(1, concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    min_recent_slots = min(3, concurrency)
     logger_download.info(
         f"🚀 Procesador de descargas iniciado (concurrencia={concurrency}, min_recent_slots={min_recent_slots}, stop_when_empty={stop_when_empty})"
     )
-    processed_count = 0
 
     if account_phone is None:
-        account_phone = os.environ.get("TG_PHONE")
+        account_phone = TG_PHONE
 
     # Rehidratar descargas colgadas en 'in_progress' (al arrancar)
     conn_reset = get_db_connection()
@@ -598,82 +1072,160 @@ async def process_download_queue(
     finally:
         close_db_connection(conn_reset)
 
-    tasks = set()
-    tasks_recent = set()
+    # (prioridad, id, fila): los recientes (0) se atienden antes que los FIFO (1) ya encolados
+    work_queue: "asyncio.PriorityQueue[tuple]" = asyncio.PriorityQueue()
+    _download_wakeup = asyncio.Event()
+    slot_freed = asyncio.Event()
+    busy = 0  # filas reclamadas (en cola o descargándose)
+    busy_recent = 0
+    processed_count = 0
 
-    while True:
-        # Si hay corte de red, mejor reintentar reconexión con backoff antes de lanzar nuevas tareas.
-        # (Las tareas individuales también protegen sus llamadas con _ensure_connected.)
-        if not await _ensure_connected(client, sleep_seconds=10):
-            continue
+    async def _worker() -> None:
+        nonlocal busy, busy_recent, processed_count
+        while True:
+            priority, _, row = await work_queue.get()
+            recent = priority == 0
+            try:
+                await _process_queue_item(client, row, semaphore, media_dir, max_mb, logger_download)
+            except Exception:
+                logger_download.exception(f"Error inesperado procesando Queue ID={row.get('id')}")
+            finally:
+                busy -= 1
+                if recent:
+                    busy_recent -= 1
+                processed_count += 1
+                work_queue.task_done()
+                slot_freed.set()
+                if processed_count % 50 == 0:
+                    logger_download.info(f"✓ Total descargas procesadas: {processed_count}")
+
+    workers = [asyncio.create_task(_worker()) for _ in range(concurrency)]
+    try:
+        while True:
+            # Si hay corte de red, mejor reintentar reconexión con backoff antes de reclamar más filas.
+            # (Las tareas individuales también protegen sus llamadas con _ensure_connected.)
+            if not await _ensure_connected(client, sleep_seconds=10):
+                continue
 
-        # Limpia tareas terminadas y contabiliza
-        done = {t for t in tasks if t.done()}
-        tasks = {t for t in tasks if not t.done()}
-        tasks_recent = {t for t in tasks_recent if not t.done()}
-        if done:
-            processed_count += len(done)
-            logger_download.info(f"✓ Tareas completadas en esta iteración: {len(done)} | Total procesadas: {processed_count}")
-
-        # Rellenar hasta la concurrencia deseada
-        while len(tasks) < concurrency:
-            slots_available = concurrency - len(tasks)
-            logger_download.info(f"⚙️ Slots libres: {slots_available}, tareas activas: {len(tasks)}")
+            free = concurrency - busy
+            if free <= 0:
+                slot_freed.clear()
+                await slot_freed.wait()
+                continue
+
+            _download_wakeup.clear()
+            claimed = 0
             conn = get_db_connection()
             try:
                 # Prioridad: mensajes más recientes (mínimo 3 slots dedicados mientras existan)
-                recent_deficit = max(0, min_recent_slots - len(tasks_recent))
-                recent_slots = min(recent_deficit, concurrency - len(tasks))
-
+                recent_slots = min(max(0, min_recent_slots - busy_recent), free)
                 if recent_slots > 0:
-                    recent_rows = fetch_recent_pending_downloads(conn, limit=recent_slots, account_phone=account_phone)
-                    if not recent_rows:
-                        logger_download.info("⏸ No hay pendientes recientes para cubrir slots priorizados")
-                    for row in recent_rows:
-                        mark_download_in_progress(conn, row["id"])
-                        task = asyncio.create_task(
-                            _process_queue_item(client, row, semaphore, media_dir, max_mb, logger_download)
-                        )
-                        tasks.add(task)
-                        tasks_recent.add(task)
+                    for row in claim_recent_pending_downloads(conn, limit=recent_slots, account_phone=account_phone):
+                        busy += 1
+                        busy_recent += 1
+                        claimed += 1
+                        work_queue.put_nowait((0, row["id"], row))
 
                 # Resto de slots con criterio FIFO clásico
-                slots_available = concurrency - len(tasks)
-                if slots_available <= 0:
-                    break
-
-                rows = fetch_pending_downloads(conn, limit=slots_available, account_phone=account_phone)
-                if not rows:
-                    logger_download.info(f"⏸ No hay pendientes para ocupar {slots_available} slots libres")
-                    break
-
-                if len(rows) < slots_available:
-                    logger_download.info(f"↘️ Solo se obtuvieron {len(rows)} pendientes de {slots_available} solicitados")
-
-                for row in rows:
-                    mark_download_in_progress(conn, row["id"])
-                    task = asyncio.create_task(
-                        _process_queue_item(client, row, semaphore, media_dir, max_mb, logger_download)
-                    )
-                    tasks.add(task)
+                fifo_slots = concurrency - busy
+                if fifo_slots > 0:
+                    for row in claim_pending_downloads(conn, limit=fifo_slots, account_phone=account_phone):
+                        busy += 1
+                        claimed += 1
+                        work_queue.put_nowait((1, row["id"], row))
             finally:
                 close_db_connection(conn)
 
-        if tasks:
-            # Esperar a que al menos una tarea finalice para mantener flujo continuo
-            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-            continue
+            if claimed:
+                logger_download.info(f"⚙️ Reclamadas {claimed} descargas (activas: {busy}/{concurrency})")
+                continue
 
-        # Si no hay tareas en curso ni pendientes, seguir sondeando indefinidamente
-        await asyncio.sleep(3)
+            # Nada pendiente: dormir hasta que se encole algo o se libere un worker (sondeo de respaldo
+            # cada 3 s por si encola otro proceso).
+            slot_freed.clear()
+            wakeups = [asyncio.ensure_future(_download_wakeup.wait()), asyncio.ensure_future(slot_freed.wait())]
+            try:
+                await asyncio.wait(wakeups, timeout=3, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in wakeups:
+                    waiter.cancel()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        _download_wakeup = None
 
 
-async def _process_message(client: TelegramClient, message, download: bool, media_dir: Optional[str], max_mb: Optional[int], logger_live=None, account_phone: str = None) -> Optional[str]:
+def _reaction_rows(message, chat_id: int, account_phone: str) -> list:
+    """Filas (msg_id, chat_id, emoji, count, account_phone) de las reacciones del mensaje."""
+    reactions = getattr(message, "reactions", None)
+    results = getattr(reactions, "results", None) if reactions else None
+    if not results:
+        return []
+    msg_id = message.id
+    return [
+        (msg_id, chat_id, getattr(r.reaction, "emoticon", None) or str(r.reaction), getattr(r, "count", 1), account_phone)
+        for r in results
+    ]
+
+
+def _entity_rows(message, chat_id: int, account_phone: str) -> list:
+    """Filas (msg_id, chat_id, type, offset, length, text, account_phone) de las entidades del mensaje."""
+    entities = message.entities
+    if not entities:
+        return []
+    # Los offsets de Telegram son unidades UTF-16 sobre el texto sin formato (message.message):
+    # se codifica una vez y se corta por bytes (2 por unidad), correcto también con emojis.
+    raw = message.message
+    u16 = raw.encode("utf-16-le") if raw else None
+    msg_id = message.id
+    return [
+        (msg_id, chat_id, type(e).__name__, e.offset, e.length,
+         u16[e.offset * 2:(e.offset + e.length) * 2].decode("utf-16-le", "replace") if u16 else None,
+         account_phone)
+        for e in entities
+    ]
+
+
+# Remitentes/chats ya resueltos, por id marcado (sender_id/chat_id). Si Telethon no adjuntó la
+# entidad al mensaje, se reutiliza la última vista antes de pedirla con get_sender()/get_chat().
+_ENTITY_CACHE_SIZE = 10_000
+_entity_cache: "OrderedDict[int, object]" = OrderedDict()
+
+
+async def _message_entity(message, kind: str):
+    """Devuelve message.sender o message.chat (kind) evitando RPCs siempre que se pueda."""
+    entity = getattr(message, kind)
+    key = getattr(message, f"{kind}_id")
+    if entity is None and key is not None:
+        entity = _entity_cache.get(key)
+    if entity is None:
+        entity = await (message.get_sender() if kind == "sender" else message.get_chat())
+    if entity is not None and key is not None:
+        _entity_cache[key] = entity
+        _entity_cache.move_to_end(key)
+        if len(_entity_cache) > _ENTITY_CACHE_SIZE:
+            _entity_cache.popitem(last=False)
+    return entity
+
+
+def _chat_type(chat) -> str:
+    if isinstance(chat, User):
+        return "bot" if getattr(chat, "bot", False) else "user"
+    if isinstance(chat, Chat):
+        return "group"
+    if isinstance(chat, Channel):
+        return "supergroup" if getattr(chat, "megagroup", False) else "channel"
+    return "unknown"
+
+
+async def _process_any(client: TelegramClient, message, download: bool, media_dir: Optional[str], max_mb: Optional[int],
+                       logger_live=None, account_phone: str = None, *, edited: bool) -> Optional[str]:
+    """Guarda un mensaje nuevo (edited=False) o una edición (edited=True) y lo registra en el log."""
     if logger_live is None:
         logger_live = logger
     if account_phone is None:
-        account_phone = os.environ.get("TG_PHONE", "unknown")
-    sender = await message.get_sender()
+        account_phone = TG_PHONE or "unknown"
+    sender = await _message_entity(message, "sender")
     sender_id = getattr(sender, "id", None)
     sender_username = getattr(sender, "username", None) if sender else None
     sender_first_name = getattr(sender, "first_name", None) if sender else None
@@ -686,7 +1238,7 @@ async def _process_message(client: TelegramClient, message, download: bool, medi
         or (sender_first_name if sender_first_name else None)
         or (str(sender_id) if sender_id is not None else "desconocido")
     )
-    chat = await message.get_chat()
+    chat = await _message_entity(message, "chat")
     chat_username = getattr(chat, "username", None)
     chat_title = getattr(chat, "title", None)
     if chat_title is None and isinstance(chat, User):
@@ -698,337 +1250,174 @@ async def _process_message(client: TelegramClient, message, download: bool, medi
     chat_name = chat_title
     chat_id = message.chat_id  # Identificador único e inmutable
     gap = None
-    
-    # Guardar en BD
-    db = get_db_connection()
+    media_enqueued = False
+
+    # Propiedades de Telethon leídas una sola vez: sirven para la fila de BD y para el log
+    media = message.media
+    text = message.text
+
     try:
-        previous_max_id = get_max_message_id_in_chat(db, chat_id, account_phone)
-        # Determinar tipo de chat
-        if isinstance(chat, User):
-            chat_type = "bot" if getattr(chat, "bot", False) else "user"
-        elif isinstance(chat, Chat):
-            chat_type = "group"
-        elif isinstance(chat, Channel):
-            chat_type = "supergroup" if getattr(chat, "megagroup", False) else "channel"
-        else:
-            chat_type = "unknown"
-        
-        # Insertar/actualizar chat
-        insert_or_update_chat(
-            db,
-            chat_id,
-            chat_username,
-            chat_title,
-            chat_type,
-            account_phone,
-        )
-        
-        # Insertar/actualizar remitente
+        # Chat y remitente se escriben antes que messages (claves foráneas)
+        chat_row = (chat_id, chat_username, chat_title, _chat_type(chat), account_phone)
+        sender_row = None
         if sender_id is not None:
-            fallback_username = sender_username or (str(sender_id) if sender_id is not None else None)
-            insert_or_update_sender(
-                db,
-                sender_id,
-                fallback_username,
-                sender_first_name,
-                sender_last_name,
-                sender_is_bot,
-                account_phone,
-            )
-        
+            fallback_username = sender_username or str(sender_id)
+            sender_row = (sender_id, fallback_username, sender_first_name, sender_last_name, sender_is_bot, account_phone)
+
         # Determinar tipo de media y ruta
-        media_type = _classify_media_type(message) if message.media else None
+        media_type = _classify_media_type(message) if media else None
         media_file_path = None
-        
-        # Información de reenvío
-        forward_sender_id = None
-        if message.forward:
-            forward_sender_id = getattr(message.forward, "sender_id", None)
-        
+
         # Información de reply
         reply_to_msg_id = None
         if message.reply_to:
             reply_to_msg_id = message.reply_to.reply_to_msg_id
-        
-        # Asegurar que los valores son tipos primitivos (no métodos)
-        edit_date = None
-        if hasattr(message, "edit_date") and message.edit_date:
-            edit_date = message.edit_date
-        
-        views = getattr(message, "views", None)
-        if callable(views):
-            views = None
 
-        forwards = getattr(message, "forwards", None)
-        if callable(forwards):
-            forwards = None
-        
-        created_at = message.date if message.date else None
+        edit_date = getattr(message, "edit_date", None) or None
 
-        # Flags booleanos seguros
-        pin_flag = bool(getattr(message, "pinned", False))
-        silent_flag = bool(getattr(message, "silent", False))
-        post_flag = bool(getattr(message, "post", False))
-        
-        # Insertar mensaje
-        insert_message(db, message.id, chat_id, sender_id,
-                      message.text, media_type, media_file_path,
-                      bool(message.forward), forward_sender_id, reply_to_msg_id,
-                      edit_date,
-                      views,
-                      forwards,
-                      pin_flag,
-                      silent_flag,
-                      post_flag,
-                      getattr(message, "ttl_period", None),
-                      getattr(message, "topic_id", None),
-                      False,
-                      created_at,
-                      account_phone)
-        gap = message.id - previous_max_id
-
-        # Log de versión (mensaje original)
-        insert_message_log(db, message.id, chat_id, sender_id,
-                   message.text, media_type, media_file_path,
-                   bool(message.forward), reply_to_msg_id,
-                   edited=False,
-                   edit_date=edit_date,
-                   created_at=created_at,
-                   account_phone=account_phone)
-        
-        # Insertar reacciones si existen
-        if hasattr(message, "reactions") and message.reactions:
-            reactions_data = []
-            if hasattr(message.reactions, "results"):
-                for reaction in message.reactions.results:
-                    emoji_text = reaction.reaction.emoticon if hasattr(reaction.reaction, "emoticon") else str(reaction.reaction)
-                    reactions_data.append({
-                        "emoji": emoji_text,
-                        "count": reaction.count if hasattr(reaction, "count") else 1
-                    })
-            insert_reactions(db, message.id, chat_id, reactions_data, account_phone)
-        
-        # Insertar entidades (menciones, hashtags, URLs, etc.)
-        if message.entities:
-            entities_data = []
-            for entity in message.entities:
-                entity_type = type(entity).__name__
-                offset = entity.offset
-                length = entity.length
-                # Extraer texto de la entidad
-                text = message.text[offset:offset+length] if message.text else None
-                entities_data.append({
-                    "type": entity_type,
-                    "offset": offset,
-                    "length": length,
-                    "text": text
-                })
-            insert_entities(db, message.id, chat_id, entities_data, account_phone)
+        # Versión del mensaje: la original o una nueva marcada como editada (no se sobrescribe)
+        log_row = (
+            message.id, chat_id, sender_id,
+            text, media_type, media_file_path,
+            bool(message.forward), reply_to_msg_id,
+            edited, edit_date, (message.date or edit_date) if edited else message.date, account_phone,
+        )
+        reaction_rows = _reaction_rows(message, chat_id, account_phone)
+        entity_rows = _entity_rows(message, chat_id, account_phone)
+
+        if edited:
+            def _write_edit() -> None:
+                with db_conn(rows="tuple") as db:
+                    # El mensaje original puede seguir en el buffer: message_log/reactions lo referencian
+                    _message_buffer.flush(db)
+                    flush_chats(db, [chat_row])
+                    if sender_row is not None:
+                        flush_senders(db, [sender_row])
+                    flush_message_logs(db, [log_row])
+                    flush_reactions(db, reaction_rows)
+                    flush_entities(db, entity_rows)
+                    # Un solo commit para todo el evento (chat, remitente, versión, reacciones, entidades)
+                    db.commit()
+
+            # En el hilo escritor: ordenado con los volcados del buffer y sin bloquear el event loop
+            await asyncio.get_running_loop().run_in_executor(_db_writer, _write_edit)
+        else:
+            # Guardar vía buffer: solo se usa conexión la primera vez que se ve el chat
+            previous_max_id = await _previous_max_message_id(chat_id, account_phone, message.id)
+
+            # Información de reenvío
+            forward_sender_id = None
+            if message.forward:
+                forward_sender_id = getattr(message.forward, "sender_id", None)
+
+            # Asegurar que los valores son tipos primitivos (no métodos)
+            views = getattr(message, "views", None)
+            if callable(views):
+                views = None
+            forwards = getattr(message, "forwards", None)
+            if callable(forwards):
+                forwards = None
+
+            # La media se encola antes de añadir la fila: si ya estaba descargada (mismo
+            # file_unique_id), la ruta va en la propia fila en vez de en un UPDATE tras volcar el buffer
+            if download and media:
+                media_enqueued = True
+                try:
+                    media_file_path = await _enqueue_media_download(message, chat, media_dir, max_mb, account_phone, update_row=False)
+                except Exception as exc:
+                    logger.warning(f"  ⚠ Error encolando media para msg_id={message.id}: {exc}")
+
+            # Mensaje (mismo orden de columnas que insert_message)
+            message_row = (
+                message.id, chat_id, sender_id,
+                text, media_type, media_file_path,
+                bool(message.forward), forward_sender_id, reply_to_msg_id,
+                edit_date,
+                views,
+                forwards,
+                bool(getattr(message, "pinned", False)),
+                bool(getattr(message, "silent", False)),
+                bool(getattr(message, "post", False)),
+                getattr(message, "ttl_period", None),
+                getattr(message, "topic_id", None),
+                False,
+                message.date,
+                account_phone,
+            )
+            gap = message.id - previous_max_id
+
+            # Se encola para el próximo volcado por lotes (hilo escritor); si el buffer está lleno
+            # se adelanta el volcado, y si se acumula demasiado se espera a que termine
+            _ensure_message_flusher()
+            if _message_buffer.add(message_row, log_row, reaction_rows, entity_rows, chat_row, sender_row):
+                _message_flush_requested.set()
+                if len(_message_buffer) >= _MESSAGE_BACKPRESSURE_ROWS:
+                    await flush_message_buffer_async()
     except Exception as exc:
-        logger.error(f"Error guardando mensaje en BD: {exc}")
-    finally:
-        close_db_connection(db)
-    
-    # Determinar tipo de contenido (para log)
-    content_type = "texto"
-    content_preview = message.text or "(vacío)"
-    
-    if message.media:
-        media_type = type(message.media).__name__
-        content_type = f"media ({media_type})"
-        content_preview = f"[{media_type}]"
-    
-    if message.poll:
-        content_type = "encuesta"
-        poll_q = getattr(message.poll, "question", None) or "(sin pregunta)"
-        content_preview = f"[Encuesta: {poll_q}]"
-    
-    if message.contact:
-        content_type = "contacto"
-        content_preview = f"[Contacto: {message.contact.first_name}]"
-    
-    # Construir log detallado con ID único y nombre como referencia
-    timestamp = message.date.isoformat() if message.date else "N/A"
-    msg_id = message.id
-    reply_to = f" (respuesta a {message.reply_to.reply_to_msg_id})" if message.reply_to else ""
-    is_forward = " [REENVIADO]" if message.forward else ""
-    
-    log_header = f"[chat_id={chat_id} ({chat_name})] MSG#{msg_id} | {timestamp} | {sender_name}{reply_to}{is_forward}"
-    log_content = f"Tipo: {content_type} | {content_preview}"
-    
-    logger_live.info(log_header)
-    logger_live.info(f"  {log_content}")
-    
+        logger.error(f"Error guardando mensaje{' editado' if edited else ''} en BD: {exc}")
+        _request_catchup()
+
+    # Construir log detallado con ID único y nombre como referencia (solo si INFO no se descarta)
+    if logger_live.isEnabledFor(logging.INFO):
+        content_type = "texto"
+        content_preview = text or "(vacío)"
+        if media:
+            media_class = type(media).__name__
+            content_type = f"media ({media_class})"
+            content_preview = f"[{media_class}]"
+        poll = message.poll
+        contact = message.contact
+        if poll:
+            content_type = "encuesta"
+            content_preview = f"[Encuesta: {getattr(poll, 'question', None) or '(sin pregunta)'}]"
+        if contact:
+            content_type = "contacto"
+            content_preview = f"[Contacto: {contact.first_name}]"
+
+        if edited and message.edit_date:
+            timestamp = message.edit_date.isoformat()
+        else:
+            timestamp = message.date.isoformat() if message.date else "N/A"
+        reply_to = f" (respuesta a {message.reply_to.reply_to_msg_id})" if message.reply_to else ""
+
+        logger_live.info(
+            "[chat_id=%s (%s)] MSG#%s%s | %s | %s%s%s",
+            chat_id, chat_name, message.id, " (EDITADO)" if edited else "", timestamp,
+            sender_name, reply_to, " [REENVIADO]" if message.forward else "",
+        )
+        logger_live.info("  Tipo: %s | %s", content_type, content_preview)
+
     # Si hay media y está permitido, encolamos para descarga asíncrona y no bloqueante
-    # Esto es no-bloqueante: si falla, solo se registra, no afecta al mensaje guardado
-    if download and message.media:
+    # Esto es no-bloqueante: si falla, solo se registra, no afecta al mensaje guardado.
+    # Los mensajes nuevos ya la encolaron al construir su fila; aquí quedan las ediciones
+    if download and media and not media_enqueued:
         try:
             await _enqueue_media_download(message, chat, media_dir, max_mb, account_phone)
         except Exception as exc:
-            logger.warning(f"  ⚠ Error encolando media para msg_id={message.id}: {exc}")
-    
+            logger.warning(f"  ⚠ Error encolando media{' editada' if edited else ''} para msg_id={message.id}: {exc}")
+
     # Detectar gaps y lanzar catch-up automático en background (independiente de si hay media)
     if gap is not None and gap > HISTORIC_GAP_THRESHOLD:
-        asyncio.create_task(_catch_up_chat_background(client, chat_id, download, media_dir, max_mb, account_phone))
-        logger.info(f"Gap detectado en {chat_id}: {gap} msgs, catch-up en background")
+        # Un solo catch-up en curso por chat: una ráfaga con gap no lanza uno por mensaje
+        running = _catchup_inflight.get(chat_id)
+        if running is None or running.done():
+            task = asyncio.create_task(_catch_up_chat_background(client, chat_id, download, media_dir, max_mb, account_phone))
+            _catchup_inflight[chat_id] = task
+            task.add_done_callback(lambda t, key=chat_id: _catchup_inflight.pop(key, None) if _catchup_inflight.get(key) is t else None)
+            logger.info(f"Gap detectado en {chat_id}: {gap} msgs, catch-up en background")
+    elif gap is not None and gap > 1:
+        # Gap por debajo del umbral: lo rellena la siguiente pasada del catch-up global
+        _request_catchup()
 
     return None
 
 
-async def _process_edited_message(client: TelegramClient, message, download: bool, media_dir: Optional[str], max_mb: Optional[int], logger_live=None, account_phone: str = None) -> Optional[str]:
-    if logger_live is None:
-        logger_live = logger
-    if account_phone is None:
-        account_phone = os.environ.get("TG_PHONE", "unknown")
-    sender = await message.get_sender()
-    sender_id = getattr(sender, "id", None)
-    sender_username = getattr(sender, "username", None) if sender else None
-    sender_first_name = getattr(sender, "first_name", None) if sender else None
-    sender_last_name = getattr(sender, "last_name", None) if sender else None
-    sender_is_bot = bool(getattr(sender, "bot", False)) if sender else False
-    sender_name = (
-        sender_username
-        or (sender_first_name if sender_first_name else None)
-        or (str(sender_id) if sender_id is not None else "desconocido")
-    )
-    chat = await message.get_chat()
-    chat_username = getattr(chat, "username", None)
-    chat_title = getattr(chat, "title", None)
-    if chat_title is None and isinstance(chat, User):
-        name_parts = [getattr(chat, "first_name", None), getattr(chat, "last_name", None)]
-        name_combined = " ".join([p for p in name_parts if p]) or None
-        chat_title = name_combined or chat_username
-    if chat_title is None:
-        chat_title = chat_username or str(message.chat_id)
-    chat_name = chat_title
-    chat_id = message.chat_id
-
-    db = get_db_connection()
-    try:
-        # Actualizar chat y remitente por si cambian username/title
-        if isinstance(chat, User):
-            chat_type = "bot" if getattr(chat, "bot", False) else "user"
-        elif isinstance(chat, Chat):
-            chat_type = "group"
-        elif isinstance(chat, Channel):
-            chat_type = "supergroup" if getattr(chat, "megagroup", False) else "channel"
-        else:
-            chat_type = "unknown"
-        insert_or_update_chat(
-            db,
-            chat_id,
-            chat_username,
-            chat_title,
-            chat_type,
-            account_phone,
-        )
-        if sender_id is not None:
-            fallback_username = sender_username or (str(sender_id) if sender_id is not None else None)
-            insert_or_update_sender(
-                db,
-                sender_id,
-                fallback_username,
-                sender_first_name,
-                sender_last_name,
-                sender_is_bot,
-                account_phone,
-            )
-
-        media_type = _classify_media_type(message) if message.media else None
-        media_file_path = None
-
-        forward_sender_id = None
-        if message.forward:
-            forward_sender_id = getattr(message.forward, "sender_id", None)
-
-        reply_to_msg_id = None
-        if message.reply_to:
-            reply_to_msg_id = message.reply_to.reply_to_msg_id
+async def _process_message(client: TelegramClient, message, download: bool, media_dir: Optional[str], max_mb: Optional[int], logger_live=None, account_phone: str = None) -> Optional[str]:
+    return await _process_any(client, message, download, media_dir, max_mb, logger_live, account_phone, edited=False)
 
-        edit_date = message.edit_date if hasattr(message, "edit_date") else None
-        views = getattr(message, "views", None)
-        if callable(views):
-            views = None
-        forwards = getattr(message, "forwards", None)
-        if callable(forwards):
-            forwards = None
-
-        pin_flag = bool(getattr(message, "pinned", False))
-        silent_flag = bool(getattr(message, "silent", False))
-        post_flag = bool(getattr(message, "post", False))
-
-        # No sobrescribimos el mensaje original: guardamos una versión nueva marcada como editada
-        insert_message_log(db, message.id, chat_id, sender_id,
-                           message.text, media_type, media_file_path,
-                           bool(message.forward), reply_to_msg_id,
-                           edited=True,
-                           edit_date=edit_date,
-                           created_at=message.date or edit_date,
-                           account_phone=account_phone)
-
-        # Refrescar reacciones
-        if hasattr(message, "reactions") and message.reactions:
-            reactions_data = []
-            if hasattr(message.reactions, "results"):
-                for reaction in message.reactions.results:
-                    emoji_text = reaction.reaction.emoticon if hasattr(reaction.reaction, "emoticon") else str(reaction.reaction)
-                    reactions_data.append({
-                        "emoji": emoji_text,
-                        "count": reaction.count if hasattr(reaction, "count") else 1
-                    })
-            insert_reactions(db, message.id, chat_id, reactions_data, account_phone)
-
-        # Refrescar entidades
-        if message.entities:
-            entities_data = []
-            for entity in message.entities:
-                entity_type = type(entity).__name__
-                offset = entity.offset
-                length = entity.length
-                text = message.text[offset:offset+length] if message.text else None
-                entities_data.append({
-                    "type": entity_type,
-                    "offset": offset,
-                    "length": length,
-                    "text": text
-                })
-            insert_entities(db, message.id, chat_id, entities_data, account_phone)
-        db.commit()
-    except Exception as exc:
-        logger.error(f"Error guardando mensaje editado en BD: {exc}")
-    finally:
-        close_db_connection(db)
-    content_type = "texto"
-    content_preview = message.text or "(vacío)"
-    if message.media:
-        media_type = type(message.media).__name__
-        content_type = f"media ({media_type})"
-        content_preview = f"[{media_type}]"
-    if message.poll:
-        content_type = "encuesta"
-        poll_q = getattr(message.poll, "question", None) or "(sin pregunta)"
-        content_preview = f"[Encuesta: {poll_q}]"
-    if message.contact:
-        content_type = "contacto"
-        content_preview = f"[Contacto: {message.contact.first_name}]"
-
-    timestamp = message.edit_date.isoformat() if message.edit_date else (message.date.isoformat() if message.date else "N/A")
-    reply_to = f" (respuesta a {message.reply_to.reply_to_msg_id})" if message.reply_to else ""
-    is_forward = " [REENVIADO]" if message.forward else ""
-    log_header = f"[chat_id={chat_id} ({chat_name})] MSG#{message.id} (EDITADO) | {timestamp} | {sender_name}{reply_to}{is_forward}"
-    log_content = f"Tipo: {content_type} | {content_preview}"
-    logger_live.info(log_header)
-    logger_live.info(f"  {log_content}")
-
-    # Si hay media y está permitido, encolamos para descarga (no bloqueante)
-    # Cualquier error al encolar no afecta el guardado del mensaje editado
-    if download and message.media:
-        try:
-            await _enqueue_media_download(message, chat, media_dir, max_mb, account_phone)
-        except Exception as exc:
-            logger.warning(f"  ⚠ Error encolando media editada para msg_id={message.id}: {exc}")
 
-    return None
+async def _process_edited_message(client: TelegramClient, message, download: bool, media_dir: Optional[str], max_mb: Optional[int], logger_live=None, account_phone: str = None) -> Optional[str]:
+    return await _process_any(client, message, download, media_dir, max_mb, logger_live, account_phone, edited=True)
 
 
 async def resolve_chat(client: TelegramClient, ref: str):
@@ -1059,71 +1448,119 @@ async def show_history(client: TelegramClient, target: str, limit: int) -> None:
         print(f"[{message.id}] {author}: {message.text}")
 
 
+# Ids por petición de get_messages(ids=...) (límite de messages.getMessages/channels.getMessages)
+_GAP_FETCH_BY_IDS_MAX = 100
+
+
+async def _iter_gap_messages(client: TelegramClient, entity, gap_start: int, gap_end: int, gap_size: int):
+    """Mensajes existentes del rango [gap_start, gap_end], en orden ascendente.
+
+    Los gaps pequeños se piden por ids en una sola llamada; los grandes se paginan con iter_messages.
+    """
+    if gap_end - gap_start + 1 <= _GAP_FETCH_BY_IDS_MAX:
+        msgs = await client.get_messages(entity, ids=list(range(gap_start, gap_end + 1)))
+        for msg in msgs:
+            if msg is not None:
+                yield msg
+        return
+    async for msg in client.iter_messages(
+        entity,
+        min_id=gap_start - 1,
+        max_id=gap_end + 1,
+        limit=gap_size,
+        reverse=True,
+        wait_time=0.5,
+    ):
+        yield msg
+
+
+class _MessageWorkerPool:
+    """Pool fijo de corrutinas que procesan mensajes desde una asyncio.Queue acotada.
+
+    Sustituye a "una tarea por mensaje + semáforo": put() espera si la cola está llena
+    (contrapresión sobre iter_messages) y join() espera a que se procese todo lo encolado.
+    """
+
+    # iter_messages pide páginas de 100 mensajes: con hueco para dos, la siguiente petición a
+    # Telegram se solapa con el procesado de la anterior en vez de esperar a que se vacíe la cola
+    _PREFETCH_MESSAGES = 200
+
+    def __init__(self, handler, workers: int):
+        self._handler = handler
+        self._size = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(workers * 2, self._PREFETCH_MESSAGES))
+        self._workers: list = []  # se arrancan con el primer mensaje (chats sin novedades no crean tareas)
+
+    async def _run(self) -> None:
+        while True:
+            args = await self._queue.get()
+            try:
+                await self._handler(*args)
+            except Exception:
+                logger.exception("Error inesperado procesando mensaje de catch-up")
+            finally:
+                self._queue.task_done()
+
+    async def put(self, *args) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._run()) for _ in range(self._size)]
+        await self._queue.put(args)
+
+    async def join(self) -> None:
+        await self._queue.join()
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
 async def catch_up_chat(client: TelegramClient, target: str, download: bool = False, media_dir: Optional[str] = None, max_mb: Optional[int] = None, account_phone: str = None) -> None:
     """Descarga todos los mensajes faltantes de un chat (basado en BD, no en state.json)."""
     entity = await resolve_chat(client, target)
-    chat_id = (await client.get_entity(entity)).id
+    # Id marcado (como message.chat_id, que es lo que se guarda en BD) sin otra llamada a Telegram
+    chat_id = get_peer_id(entity)
     
     # Obtener el ID más alto de mensaje guardado en la BD para este chat
-    db = get_db_connection()
-    try:
-        max_msg_id_in_db = get_max_message_id_in_chat(db, chat_id, account_phone)
-    finally:
-        close_db_connection(db)
+    max_msg_id_in_db = max(
+        await _db_read(get_max_message_id_in_chat, chat_id, account_phone),
+        _message_buffer.pending_max_id(chat_id, account_phone),
+    )
     
     logger.info(f"Catch-up para chat {chat_id}: buscando mensajes con ID > {max_msg_id_in_db}")
     
-    # Semáforo más conservador para evitar saturación cuando hay múltiples listeners
-    # Con 64 clientes: 64 × 25 = 1,600 tareas máximo
-    semaphore = asyncio.Semaphore(25)
-    
-    async def process_with_limit(msg):
-        async with semaphore:
-            max_retries = 5
-            retry_count = 0
-            last_exception = None
-            
-            while retry_count < max_retries:
-                try:
-                    await _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone)
-                    return  # Éxito
-                except Exception as e:
-                    retry_count += 1
-                    last_exception = e
-                    if retry_count < max_retries:
-                        wait_time = 2 ** retry_count  # Backoff exponencial: 2s, 4s, 8s, 16s, 32s
-                        logger.warning(f"Error en MSG#{msg.id} (intento {retry_count}/{max_retries}), reintentando en {wait_time}s: {str(e)}")
-                        await asyncio.sleep(wait_time + 0.5)  # +0.5s para liberar pool
-                    else:
-                        logger.exception(f"❌ FALLO CRÍTICO: MSG#{msg.id} en chat {chat_id} tras {max_retries} reintentos. NO SE GUARDÓ EL MENSAJE.")
-                        logger.exception(f"Última excepción: {last_exception}")
+    async def process_with_retries(msg):
+        await _with_retry(
+            lambda: _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone),
+            label=f"MSG#{msg.id}", context=f"chat {chat_id}", failure="NO SE GUARDÓ EL MENSAJE.",
+            pause=0.5,  # +0.5s para liberar pool
+        )
     
-    # Procesar mensajes en batches grandes para máximo rendimiento
+    # Pool más conservador para evitar saturación cuando hay múltiples listeners
+    # Con 64 clientes: 64 × 25 = 1,600 workers máximo
+    pool = _MessageWorkerPool(process_with_retries, workers=25)
     count_catchup = 0
-    batch_size = 200
-    tasks = []
-    
-    async for msg in client.iter_messages(entity, min_id=max_msg_id_in_db, limit=None, reverse=True, wait_time=0.5):
-        tasks.append(asyncio.create_task(process_with_limit(msg)))
-        count_catchup += 1
-        
-        # Procesar batch cuando alcance el límite
-        if len(tasks) >= batch_size:
-            await asyncio.gather(*tasks)
-            tasks = []
+    try:
+        async for msg in client.iter_messages(entity, min_id=max_msg_id_in_db, limit=None, reverse=True, wait_time=0.5):
+            await pool.put(msg)
+            count_catchup += 1
             if count_catchup % 250 == 0:
-                logger.info(f"Catch-up: {count_catchup} mensajes procesados...")
-    
-    # Procesar mensajes restantes
-    if tasks:
-        await asyncio.gather(*tasks)
+                logger.info("Catch-up: %s mensajes procesados...", count_catchup)
+        
+        # Esperar a los mensajes restantes
+        await pool.join()
+    finally:
+        await pool.close()
+    # Drenar el buffer antes de dar el catch-up por terminado
+    await flush_message_buffer_async(drain=True)
     
     logger.info(f"✓ Catch-up completado: {count_catchup} mensajes procesados en chat {chat_id}")
 
 
 async def run_listener(client: TelegramClient, target: Optional[str], download: bool = False, media_dir: Optional[str] = None, catch_up: bool = False, max_mb: Optional[int] = None) -> None:
     # Obtener account_phone del entorno
-    account_phone = os.environ.get("TG_PHONE", "unknown")
+    account_phone = TG_PHONE or "unknown"
 
     notifier = get_notifier(logger=logger)
 
@@ -1131,12 +1568,8 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
         if not notifier.enabled:
             return
         try:
-            await asyncio.to_thread(
-                notifier.notify,
-                key=key,
-                text=text,
-                min_interval_seconds=min_interval_seconds,
-            )
+            # Solo encola: el envío corre en el hilo del notificador sin frenar el event loop
+            notifier.notify(key=key, text=text, min_interval_seconds=min_interval_seconds)
         except Exception as exc:
             logger.warning(f"No se pudo enviar notificación (key={key}): {exc}")
     
@@ -1156,6 +1589,11 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
 
     # Estado de último mensaje
     state = _load_state()
+    # Despierta al catch-up global en reposo (ver _request_catchup); sin avisos, la
+    # siguiente pasada llega por timeout
+    global _catchup_wakeup, _catchup_wakeup_loop
+    _catchup_wakeup = asyncio.Event()
+    _catchup_wakeup_loop = asyncio.get_running_loop()
 
     # Registrar event handlers para mensajes en tiempo real ANTES del catch-up
     # Esto permite recibir mensajes live mientras se procesa el catch-up en paralelo
@@ -1164,57 +1602,24 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
     
     @client.on(events.NewMessage(chats=chats))
     async def handler(event):
-        max_retries = 5
-        retry_count = 0
-        last_exception = None
-        
-        while retry_count < max_retries:
-            try:
-                # Si nos quedamos desconectados, intentar reconectar antes de procesar.
-                if not await _ensure_connected(client, sleep_seconds=min(60, 2 ** retry_count)):
-                    retry_count += 1
-                    last_exception = RuntimeError("Cliente desconectado")
-                    continue
-                await _process_message(client, event.message, download, media_dir, max_mb, logger_live, account_phone)
-                return  # Éxito
-            except Exception as e:
-                retry_count += 1
-                last_exception = e
-                if retry_count < max_retries:
-                    wait_time = 2 ** retry_count
-                    logger.warning(f"Error en MSG#{event.message.id} (intento {retry_count}/{max_retries}), reintentando en {wait_time}s: {str(e)}")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.exception(f"❌ FALLO CRÍTICO: MSG#{event.message.id} en chat {event.chat_id} tras {max_retries} reintentos. NO SE GUARDÓ.")
-                    logger.exception(f"Última excepción: {last_exception}")
+        # Con client, si nos quedamos desconectados se reconecta antes de procesar.
+        saved = await _with_retry(
+            lambda: _process_message(client, event.message, download, media_dir, max_mb, logger_live, account_phone),
+            label=f"MSG#{event.message.id}", context=f"chat {event.chat_id}", failure="NO SE GUARDÓ.",
+            client=client,
+        )
+        if not saved:
+            _request_catchup()
         _update_last_id(state, event.chat_id, event.message.id)
         _save_state(state)
 
     @client.on(events.MessageEdited(chats=chats))
     async def edited_handler(event):
-        max_retries = 5
-        retry_count = 0
-        last_exception = None
-        
-        while retry_count < max_retries:
-            try:
-                # Si nos quedamos desconectados, intentar reconectar antes de procesar.
-                if not await _ensure_connected(client, sleep_seconds=min(60, 2 ** retry_count)):
-                    retry_count += 1
-                    last_exception = RuntimeError("Cliente desconectado")
-                    continue
-                await _process_edited_message(client, event.message, download, media_dir, max_mb)
-                return  # Éxito
-            except Exception as e:
-                retry_count += 1
-                last_exception = e
-                if retry_count < max_retries:
-                    wait_time = 2 ** retry_count
-                    logger.warning(f"Error en EDIT MSG#{event.message.id} (intento {retry_count}/{max_retries}), reintentando en {wait_time}s: {str(e)}")
-                    await asyncio.sleep(wait_time)
-                else:
-                    logger.exception(f"❌ FALLO CRÍTICO: EDIT MSG#{event.message.id} en chat {event.chat_id} tras {max_retries} reintentos. NO SE ACTUALIZÓ.")
-                    logger.exception(f"Última excepción: {last_exception}")
+        await _with_retry(
+            lambda: _process_edited_message(client, event.message, download, media_dir, max_mb),
+            label=f"EDIT MSG#{event.message.id}", context=f"chat {event.chat_id}", failure="NO SE ACTUALIZÓ.",
+            client=client,
+        )
         _update_last_id(state, event.chat_id, event.message.id)
         _save_state(state)
 
@@ -1248,61 +1653,39 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
             try:
                 if chats is not None:
                     # Catch-up para un chat específico
-                    chat_id = (await client.get_entity(chats)).id if not isinstance(chats, int) else chats
+                    chat_id = get_peer_id(chats) if not isinstance(chats, int) else chats
                     key = str(chat_id)
 
-                    db = get_db_connection()
-                    try:
-                        max_msg_id_in_db = get_max_message_id_in_chat(db, chat_id, account_phone)
-                    finally:
-                        close_db_connection(db)
+                    max_msg_id_in_db = await _db_read(get_max_message_id_in_chat, chat_id, account_phone)
 
                     logger.info(f"Catch-up para chat {key}: buscando mensajes con ID > {max_msg_id_in_db}")
 
-                    # Semáforo balanceado para velocidad sin saturar pool ni flood wait de Telegram
-                    # Con 64 clientes: 64 × 50 = 3,200 tareas (< pool 250 × 64 = 16,000)
-                    semaphore = asyncio.Semaphore(50)
-
-                    async def process_with_limit(msg):
-                        async with semaphore:
-                            max_retries = 5
-                            retry_count = 0
-                            last_exception = None
-
-                            while retry_count < max_retries:
-                                try:
-                                    await _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone)
-                                    return  # Éxito
-                                except Exception as e:
-                                    retry_count += 1
-                                    last_exception = e
-                                    if retry_count < max_retries:
-                                        wait_time = 2 ** retry_count  # Backoff exponencial: 2s, 4s, 8s, 16s, 32s
-                                        logger.warning(f"Error en MSG#{msg.id} (intento {retry_count}/{max_retries}), reintentando en {wait_time}s: {str(e)}")
-                                        await asyncio.sleep(wait_time + 0.1)  # +0.1s para liberar pool
-                                    else:
-                                        logger.exception(f"❌ FALLO CRÍTICO: MSG#{msg.id} en chat {chat_id} tras {max_retries} reintentos. NO SE GUARDÓ EL MENSAJE.")
-                                        logger.exception(f"Última excepción: {last_exception}")
+                    async def process_with_retries(msg):
+                        await _with_retry(
+                            lambda: _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone),
+                            label=f"MSG#{msg.id}", context=f"chat {chat_id}", failure="NO SE GUARDÓ EL MENSAJE.",
+                            pause=0.1,  # +0.1s para liberar pool
+                        )
 
+                    # Pool balanceado para velocidad sin saturar pool ni flood wait de Telegram
+                    # Con 64 clientes: 64 × 50 = 3,200 workers (< pool 250 × 64 = 16,000)
+                    pool = _MessageWorkerPool(process_with_retries, workers=50)
                     count_catchup = 0
-                    batch_size = 200
-                    tasks = []
-
-                    async for msg in client.iter_messages(chats, min_id=max_msg_id_in_db, reverse=True):
-                        tasks.append(asyncio.create_task(process_with_limit(msg)))
-                        _update_last_id(state, msg.chat_id, msg.id)
-                        count_catchup += 1
-
-                        # Procesar batch cuando alcance el límite
-                        if len(tasks) >= batch_size:
-                            await asyncio.gather(*tasks)
-                            tasks = []
+                    last_id = 0  # reverse=True: ids ascendentes, el último es el mayor
+                    try:
+                        async for msg in client.iter_messages(chats, min_id=max_msg_id_in_db, reverse=True):
+                            await pool.put(msg)
+                            last_id = msg.id
+                            count_catchup += 1
 
-                    # Procesar mensajes restantes
-                    if tasks:
-                        await asyncio.gather(*tasks)
+                        # Esperar a los mensajes restantes
+                        await pool.join()
+                    finally:
+                        await pool.close()
 
-                    _save_state(state)
+                    if last_id:
+                        _update_last_id(state, chat_id, last_id)
+                        _save_state(state)
                     logger.info(f"Catch-up completado: {count_catchup} mensajes procesados")
 
                     # Chat específico: si llegó hasta aquí, consideramos catch-up completado.
@@ -1311,33 +1694,114 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
                     # Catch-up para TODOS los chats
                     logger.info("Catch-up para TODOS los chats (iterativo hasta completar TODOS los gaps)...")
 
-                    # Semáforo balanceado para velocidad sin saturar pool ni flood wait de Telegram
-                    # Con 64 clientes: 64 × 50 = 3,200 tareas (< pool 250 × 64 = 16,000)
-                    semaphore = asyncio.Semaphore(50)
-
                     global_iteration = 0
                     total_global_catchup = 0
+                    # Lista de diálogos reutilizada entre pasadas (GetDialogs pagina todo el listado)
+                    dialogs = []
+                    dialogs_fetched_at = 0.0
+
+                    async def process_with_retries(msg, chat_id, dialog_name):
+                        await _with_retry(
+                            lambda: _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone),
+                            label=f"MSG#{msg.id} en {dialog_name}", context=f"chat {chat_id} ({dialog_name})",
+                            failure="NO SE GUARDÓ.",
+                        )
+
+                    async def catch_up_dialog(index, dialog, max_ids):
+                        """Mensajes nuevos + gaps de un diálogo; devuelve (mensajes procesados, de ellos en gaps)."""
+                        chat_id = dialog.id
 
-                    async def process_with_limit(msg, chat_id, dialog_name):
-                        async with semaphore:
-                            max_retries = 5
-                            retry_count = 0
-                            last_exception = None
-
-                            while retry_count < max_retries:
-                                try:
-                                    await _process_message(client, msg, download, media_dir, max_mb, logger_catchup, account_phone)
-                                    return  # Éxito
-                                except Exception as e:
-                                    retry_count += 1
-                                    last_exception = e
-                                    if retry_count < max_retries:
-                                        wait_time = 2 ** retry_count  # Backoff exponencial: 2s, 4s, 8s, 16s, 32s
-                                        logger.warning(f"Error en MSG#{msg.id} en {dialog_name} (intento {retry_count}/{max_retries}), reintentando en {wait_time}s: {str(e)}")
-                                        await asyncio.sleep(wait_time)
-                                    else:
-                                        logger.exception(f"❌ FALLO CRÍTICO: MSG#{msg.id} en chat {chat_id} ({dialog_name}) tras {max_retries} reintentos. NO SE GUARDÓ.")
-                                        logger.exception(f"Última excepción: {last_exception}")
+                        def _read_dialog(db):
+                            max_id = max_ids.get(chat_id)
+                            if max_id is None:
+                                max_id = get_max_message_id_in_chat(db, chat_id, account_phone)
+                            return max_id, get_chat_gaps(db, chat_id, account_phone, limit=100)  # Top 100 gaps más grandes
+
+                        try:
+                            max_msg_id_in_db, gaps = await _db_read(_read_dialog, rows="dict")
+                        except Exception as e:
+                            logger.warning(f"    ✗ No se pudo consultar BD para chat id={chat_id} ('{dialog.name}'): {e}")
+                            await asyncio.sleep(1)
+                            return 0, 0
+
+                        logger.info("  [%s] → Chat '%s' (id=%s)", index, dialog.name, chat_id)
+                        count_catchup = 0
+                        gaps_filled = 0
+                        # Pool balanceado para velocidad sin saturar pool ni flood wait de Telegram
+                        # Con 64 clientes: 64 × 50 = 3,200 workers (< pool 250 × 64 = 16,000)
+                        pool = _MessageWorkerPool(process_with_retries, workers=50)
+
+                        try:
+                            # PASO 1: Obtener mensajes NUEVOS (posteriores al último guardado)
+                            logger.info("      Buscando mensajes nuevos desde id>%s", max_msg_id_in_db)
+                            last_id = 0  # reverse=True: ids ascendentes, el último es el mayor
+                            async for msg in client.iter_messages(dialog.entity, min_id=max_msg_id_in_db, limit=None, reverse=True, wait_time=0.5):
+                                await pool.put(msg, chat_id, dialog.name)
+                                last_id = msg.id
+                                count_catchup += 1
+                                if count_catchup % 250 == 0:
+                                    logger.info("      Procesados %s mensajes nuevos...", count_catchup)
+
+                            # Esperar a los mensajes restantes
+                            await pool.join()
+                            if last_id:
+                                # Estado actualizado una vez por chat (guardado en segundo plano y agrupado)
+                                _update_last_id(state, chat_id, last_id)
+                                _save_state(state)
+
+                            # PASO 2: Rellenar GAPS intermedios
+                            if gaps:
+                                logger.info(f"      🔍 Encontrados {len(gaps)} gaps - Rellenando los más grandes...")
+                                missing_ids = set()
+                                for gap_row in gaps[:10]:  # Procesar top 10 gaps más grandes
+                                    gap_start = int(gap_row['gap_start']) if isinstance(gap_row, dict) else int(gap_row[0])
+                                    gap_end = int(gap_row['gap_end']) if isinstance(gap_row, dict) else int(gap_row[1])
+                                    gap_size = int(gap_row['gap_size']) if isinstance(gap_row, dict) else int(gap_row[2])
+
+                                    if gap_size > 0:  # Todos los gaps, incluso de 1 mensaje
+                                        seen_ids = set()
+                                        logger.info("      → Rellenando gap: mensajes %s a %s (%s faltantes)", gap_start, gap_end, gap_size)
+                                        async for msg in _iter_gap_messages(client, dialog.entity, gap_start, gap_end, gap_size):
+                                            await pool.put(msg, chat_id, dialog.name)
+                                            count_catchup += 1
+                                            gaps_filled += 1
+                                            seen_ids.add(msg.id)
+
+                                        await pool.join()
+
+                                        # Ids no devueltos por Telegram: se marcan como irrecuperables al final del chat
+                                        missing_ids.update(range(gap_start, gap_end + 1))
+                                        missing_ids.difference_update(seen_ids)
+
+                                if missing_ids:
+                                    def _write_placeholders() -> None:
+                                        # Todos los gaps del chat en una transacción
+                                        with db_conn(rows="tuple") as db_placeholder:
+                                            mark_messages_unrecoverable(db_placeholder, chat_id, missing_ids, account_phone, "telegram_missing")
+
+                                    try:
+                                        # Conexión prestada del pool, en el hilo escritor como el resto de escrituras
+                                        await asyncio.get_running_loop().run_in_executor(_db_writer, _write_placeholders)
+                                    except Exception as e:
+                                        logger.warning(f"      ⚠ No se pudieron marcar placeholders de gap (chat={chat_id}): {e}")
+
+                                if gaps_filled > 0:
+                                    logger.info("      ✓ Rellenados %s mensajes en gaps", gaps_filled)
+
+                            if count_catchup == 0:
+                                logger.info("      ⊘ Sin mensajes nuevos ni gaps")
+                            else:
+                                logger.info("      ✓ Total procesado: %s mensajes", count_catchup)
+                        except Exception as e:
+                            logger.warning("    ✗ Error en catch-up de '%s': %s", dialog.name, e)
+                            await _notify(
+                                "catchup_chat_error",
+                                f"⚠ Error en catch-up de '{dialog.name}' (chat_id={chat_id}). Continúa. ({type(e).__name__}: {e})",
+                                min_interval_seconds=int(os.environ.get("TG_NOTIFY_ERROR_COOLDOWN_SECONDS", "900")),
+                            )
+                        finally:
+                            await pool.close()
+                        return count_catchup, gaps_filled
 
                     while True:
                         global_iteration += 1
@@ -1349,12 +1813,7 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
 
                         # Si la BD no está lista, no tirar el catch-up: reintentar luego.
                         try:
-                            db_ping = get_db_connection()
-                            try:
-                                with db_ping.cursor() as cur:
-                                    cur.execute("SELECT 1")
-                            finally:
-                                close_db_connection(db_ping)
+                            await _db_read(_db_ping)
                         except Exception as e:
                             logger.warning(f"PostgreSQL no disponible para catch-up (reintento en 30s): {e}")
                             await _notify(
@@ -1365,115 +1824,40 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
                             await asyncio.sleep(30)
                             continue
 
-                        total_catchup = 0
-                        total_gaps_filled = 0
-                        total_dialogs = 0
-                        async for dialog in iter_all_dialogs(client):
-                            total_dialogs += 1
-                            chat_id = dialog.id
+                        if not dialogs or time.monotonic() - dialogs_fetched_at >= _CATCHUP_DIALOGS_TTL:
+                            dialogs = [dialog async for dialog in iter_all_dialogs(client)]
+                            dialogs_fetched_at = time.monotonic()
 
-                            try:
-                                db = get_db_connection()
-                                try:
-                                    max_msg_id_in_db = get_max_message_id_in_chat(db, chat_id, account_phone)
-                                    gaps = get_chat_gaps(db, chat_id, account_phone, limit=100)  # Top 100 gaps más grandes
-                                finally:
-                                    close_db_connection(db)
-                            except Exception as e:
-                                logger.warning(f"    ✗ No se pudo consultar BD para chat id={chat_id} ('{dialog.name}'): {e}")
-                                await asyncio.sleep(1)
-                                continue
-
-                            logger.info(f"  [{total_dialogs}] → Chat '{dialog.name}' (id={chat_id})")
-                            count_catchup = 0
-                            tasks = []
-                            batch_size = 200
+                        # Máximos de todos los chats de la pasada en un solo viaje a BD
+                        try:
+                            max_ids = await _db_read(get_max_message_ids, [d.id for d in dialogs], account_phone)
+                        except Exception as e:
+                            logger.warning(f"    ✗ No se pudieron obtener los máximos por chat (se consultan uno a uno): {e}")
+                            max_ids = {}
 
-                            try:
-                                # PASO 1: Obtener mensajes NUEVOS (posteriores al último guardado)
-                                logger.info(f"      Buscando mensajes nuevos desde id>{max_msg_id_in_db}")
-                                async for msg in client.iter_messages(dialog.entity, min_id=max_msg_id_in_db, limit=None, reverse=True, wait_time=0.5):
-                                    tasks.append(asyncio.create_task(process_with_limit(msg, chat_id, dialog.name)))
-                                    _update_last_id(state, msg.chat_id, msg.id)
-                                    count_catchup += 1
-
-                                    # Procesar batch cuando alcance el límite
-                                    if len(tasks) >= batch_size:
-                                        await asyncio.gather(*tasks)
-                                        tasks = []
-                                        if count_catchup % 250 == 0:
-                                            logger.info(f"      Procesados {count_catchup} mensajes nuevos...")
-
-                                # Procesar mensajes restantes
-                                if tasks:
-                                    await asyncio.gather(*tasks)
-
-                                # PASO 2: Rellenar GAPS intermedios
-                                if gaps:
-                                    logger.info(f"      🔍 Encontrados {len(gaps)} gaps - Rellenando los más grandes...")
-                                    gaps_filled = 0
-                                    for gap_row in gaps[:10]:  # Procesar top 10 gaps más grandes
-                                        gap_start = int(gap_row['gap_start']) if isinstance(gap_row, dict) else int(gap_row[0])
-                                        gap_end = int(gap_row['gap_end']) if isinstance(gap_row, dict) else int(gap_row[1])
-                                        gap_size = int(gap_row['gap_size']) if isinstance(gap_row, dict) else int(gap_row[2])
-
-                                        if gap_size > 0:  # Todos los gaps, incluso de 1 mensaje
-                                            seen_ids = set()
-                                            logger.info(f"      → Rellenando gap: mensajes {gap_start} a {gap_end} ({gap_size} faltantes)")
-                                            async for msg in client.iter_messages(
-                                                dialog.entity,
-                                                min_id=gap_start - 1,
-                                                max_id=gap_end + 1,
-                                                limit=gap_size,
-                                                reverse=True,
-                                                wait_time=0.5,
-                                            ):
-                                                tasks.append(asyncio.create_task(process_with_limit(msg, chat_id, dialog.name)))
-                                                count_catchup += 1
-                                                gaps_filled += 1
-                                                seen_ids.add(msg.id)
-
-                                                if len(tasks) >= batch_size:
-                                                    await asyncio.gather(*tasks)
-                                                    tasks = []
-
-                                            if tasks:
-                                                await asyncio.gather(*tasks)
-                                                tasks = []
-
-                                            # Marcar como irrecuperables los ids no devueltos por Telegram
-                                            missing_ids = set(range(gap_start, gap_end + 1)) - seen_ids
-                                            if missing_ids:
-                                                try:
-                                                    db_placeholder = get_db_connection()
-                                                    try:
-                                                        for missing_id in sorted(missing_ids):
-                                                            mark_message_unrecoverable(db_placeholder, chat_id, missing_id, account_phone, "telegram_missing")
-                                                        db_placeholder.commit()
-                                                    finally:
-                                                        close_db_connection(db_placeholder)
-                                                except Exception as e:
-                                                    logger.warning(f"      ⚠ No se pudieron marcar placeholders de gap (chat={chat_id}): {e}")
-
-                                    if gaps_filled > 0:
-                                        logger.info(f"      ✓ Rellenados {gaps_filled} mensajes en gaps")
-                                        total_gaps_filled += gaps_filled
-
-                                if count_catchup == 0:
-                                    logger.info("      ⊘ Sin mensajes nuevos ni gaps")
-                                else:
-                                    logger.info(f"      ✓ Total procesado: {count_catchup} mensajes")
-                                total_catchup += count_catchup
-                            except Exception as e:
-                                logger.warning(f"    ✗ Error en catch-up de '{dialog.name}': {e}")
-                                await _notify(
-                                    "catchup_chat_error",
-                                    f"⚠ Error en catch-up de '{dialog.name}' (chat_id={chat_id}). Continúa. ({type(e).__name__}: {e})",
-                                    min_interval_seconds=int(os.environ.get("TG_NOTIFY_ERROR_COOLDOWN_SECONDS", "900")),
-                                )
+                        # Varios diálogos a la vez: Telethon multiplexa sus peticiones sobre la misma
+                        # conexión MTProto, así que iter_messages de un chat no espera a que acabe el anterior
+                        dialog_slots = asyncio.Semaphore(_CATCHUP_PARALLEL_DIALOGS)
 
-                        _save_state(state)
-                        logger.info(f"✓ Pasada {global_iteration}: {total_dialogs} chats, {total_catchup} mensajes ({total_gaps_filled} gaps rellenados)")
+                        async def run_dialog(index, dialog):
+                            async with dialog_slots:
+                                return await catch_up_dialog(index, dialog, max_ids)
+
+                        results = await asyncio.gather(
+                            *(run_dialog(i, d) for i, d in enumerate(dialogs, 1)), return_exceptions=True
+                        )
+                        # Un diálogo que falla fuera de su propio manejo de errores no tira la pasada
+                        for dialog, result in zip(dialogs, results):
+                            if isinstance(result, BaseException):
+                                logger.warning(f"    ✗ Error inesperado en catch-up de '{dialog.name}': {result}")
+                        results = [r if not isinstance(r, BaseException) else (0, 0) for r in results]
+                        total_dialogs = len(dialogs)
+                        total_catchup = sum(count for count, _ in results)
+                        total_gaps_filled = sum(filled for _, filled in results)
+
+                        # Sin _save_state por pasada: catch_up_dialog ya guarda el estado de cada
+                        # chat que avanza, y una pasada en vacío no cambia nada
+                        logger.info("✓ Pasada %s: %s chats, %s mensajes (%s gaps rellenados)", global_iteration, total_dialogs, total_catchup, total_gaps_filled)
 
                         if total_gaps_filled > 0:
                             await _notify(
@@ -1493,7 +1877,13 @@ async def run_listener(client: TelegramClient, target: Optional[str], download:
                                     min_interval_seconds=int(os.environ.get("TG_NOTIFY_NO_GAPS_COOLDOWN_SECONDS", "21600")),
                                 )
                                 idle_notified = True
-                            await asyncio.sleep(3)
+                            # Sin sondeo cada 3s: se espera a un aviso (volcado fallido, gap pequeño,
+                            # mensaje no guardado) o, como red de seguridad, al timeout
+                            try:
+                                await asyncio.wait_for(_catchup_wakeup.wait(), timeout=_CATCHUP_IDLE_SECONDS)
+                            except asyncio.TimeoutError:
+                                pass
+                            _catchup_wakeup.clear()
                             continue
 
                         idle_notified = False
@@ -1558,10 +1948,21 @@ async def run_listener_with_events(target: Optional[str] = None):
             logger.error(f"❌ Error verificando conexión: {e}")
             return
         
-        # Timestamp de referencia: mensajes más antiguos que esto son CATCHUP
-        import time
-        connection_time = time.time()
+        # Mensajes más antiguos que catchup_threshold son CATCHUP
         catchup_threshold = 30  # segundos - mensajes más antiguos son catch-up histórico
+        # Frontera LIVE/CATCHUP como datetime, recalculada como mucho una vez por segundo:
+        # cada evento solo compara message.date, sin timestamp() ni time.time()
+        catchup_delta = timedelta(seconds=catchup_threshold)
+        catchup_cutoff = datetime.now(timezone.utc) - catchup_delta
+        cutoff_refreshed = time.monotonic()
+
+        def _catchup_cutoff() -> datetime:
+            nonlocal catchup_cutoff, cutoff_refreshed
+            now = time.monotonic()
+            if now - cutoff_refreshed >= 1:
+                catchup_cutoff = datetime.now(timezone.utc) - catchup_delta
+                cutoff_refreshed = now
+            return catchup_cutoff
         
         # Obtener chats a monitorear
         chats_to_monitor = None
@@ -1574,39 +1975,25 @@ async def run_listener_with_events(target: Optional[str] = None):
                 logger.error(f"Error resolviendo chat {target}: {e}")
                 return
         
-        # Registrar event handler para mensajes nuevos
-        @client.on(events.NewMessage())
+        # Registrar event handler para mensajes nuevos. El filtro de chat lo aplica Telethon
+        # (ids marcados, como message.chat_id): los eventos de otros chats no llegan al handler
+        chat_filter = [get_peer_id(c) for c in chats_to_monitor] if chats_to_monitor else None
+
+        @client.on(events.NewMessage(chats=chat_filter))
         async def handle_new_message(event):
             try:
                 message = event.message
                 chat_id = message.chat_id
                 
-                # Filtro: solo si estamos monitoreando este chat (si target especificado)
-                if target and chats_to_monitor:
-                    chat_matches = any(
-                        chat_id == (c.id if hasattr(c, 'id') else c)
-                        for c in chats_to_monitor
-                    )
-                    if not chat_matches:
-                        return
-                
-                # Diferenciar CATCHUP (históricos) de LIVE (tiempo real)
-                try:
-                    msg_timestamp = message.date.timestamp()
-                except (AttributeError, TypeError):
-                    msg_timestamp = message.date
-                
-                time_since_msg = time.time() - msg_timestamp
-                
-                # Determinar tipo de mensaje y logger a usar
-                if time_since_msg > catchup_threshold:
+                # Diferenciar CATCHUP (históricos) de LIVE (tiempo real) y elegir logger
+                if message.date is not None and message.date < _catchup_cutoff():
                     msg_type = "CATCHUP"
                     msg_logger = logger_catchup  # Log a tel-cli.catchup.log
                 else:
                     msg_type = "LIVE"
                     msg_logger = logger_live  # Log a tel-cli.live.log
                 
-                msg_logger.info(f"🟢 [{msg_type}] ✉️ NUEVO MENSAJE: Chat={chat_id}, ID={message.id}, User={message.sender_id}")
+                msg_logger.info("🟢 [%s] ✉️ NUEVO MENSAJE: Chat=%s, ID=%s, User=%s", msg_type, chat_id, message.id, message.sender_id)
                 
                 # Procesar el mensaje (usa el mismo logger para el detalle)
                 await _process_message(client, message, False, None, None, msg_logger)
@@ -1634,8 +2021,6 @@ async def run_multithreaded_listener(target: Optional[str] = None, download: boo
     
     # Construir cliente y verificar autorización SIN start() (start() intenta login interactivo).
     # En contenedor, si la sesión no es válida, eso provoca EOF y reinicios en bucle.
-    phone = os.environ.get("TG_PHONE")
-
     while True:
         client = build_client()
         try:
@@ -1648,29 +2033,36 @@ async def run_multithreaded_listener(target: Optional[str] = None, download: boo
                 "Ejecuta 'docker compose run --rm telegram-init' para autenticar y regenerar la sesión. "
                 "Reintentando en 30s..."
             )
-        finally:
+        except BaseException:
             await client.disconnect()
+            raise
 
+        await client.disconnect()
         await asyncio.sleep(30)
 
-    # Sesión OK: ya podemos ejecutar listener (y mantener conectado).
-    async with client:
-        await ensure_login(client, phone)
+    # Sesión OK y ya conectada: se reutiliza esa conexión. `async with client` (start()) y
+    # ensure_login solo repetirían la comprobación de autorización que acabamos de hacer.
+    try:
         await run_listener(client, target, download=download, media_dir=media_dir, catch_up=catch_up, max_mb=max_mb)
+    finally:
+        await client.disconnect()
 
 
 async def dispatch(args) -> None:
-    phone = os.environ.get("TG_PHONE")
+    phone = TG_PHONE
     
     # El comando listen usa event handlers en un solo loop
     if args.command == "listen":
-        await run_multithreaded_listener(
-            target=args.chat,
-            download=args.download,
-            media_dir=args.media_dir,
-            max_mb=args.max_mb,
-            catch_up=args.catch_up
-        )
+        try:
+            await run_multithreaded_listener(
+                target=args.chat,
+                download=args.download,
+                media_dir=args.media_dir,
+                max_mb=args.max_mb,
+                catch_up=args.catch_up
+            )
+        finally:
+            flush_message_buffer()
         return
     
     # Resto de comandos usan el cliente normalmente
@@ -1715,48 +2107,36 @@ async def dispatch(args) -> None:
         elif args.command == "history-since":
             entity = await resolve_chat(client, args.chat)
             state = _load_state()
-            key = str((await client.get_entity(entity)).id)
+            key = str(get_peer_id(entity))
             min_id = args.min_id if args.min_id is not None else state.get(key, {}).get("last_id", 0)
             logger.info(f"Mostrando mensajes desde id>{min_id}")
             async for msg in client.iter_messages(entity, min_id=min_id, limit=args.limit, reverse=True):
                 author = msg.sender_id
                 print(f"[{msg.id}] {author}: {msg.text}")
         elif args.command == "db-stats":
-            db = get_db_connection()
-            try:
-                from .db import get_stats
+            with db_conn() as db:
                 stats = get_stats(db)
-                print("\n=== Estadísticas de BD ===")
-                for key, value in stats.items():
-                    print(f"{key}: {value}")
-            finally:
-                close_db_connection(db)
+            print("\n=== Estadísticas de BD ===")
+            for key, value in stats.items():
+                print(f"{key}: {value}")
         elif args.command == "db-export":
-            db = get_db_connection()
-            try:
-                from .db import export_messages_json
+            with db_conn() as db:
                 count = export_messages_json(db, args.output or "messages_export.json")
-                print(f"✓ Exportados {count} mensajes a {args.output or 'messages_export.json'}")
-            finally:
-                close_db_connection(db)
+            print(f"✓ Exportados {count} mensajes a {args.output or 'messages_export.json'}")
         elif args.command == "db-chat":
-            db = get_db_connection()
-            try:
-                from .db import get_messages_by_chat
-                if args.chat_id < 0:
-                    # Es un chat ID real
-                    chat_id = args.chat_id
-                else:
-                    # Resolver el nombre/username a ID
-                    entity = await resolve_chat(client, str(args.chat_id))
-                    chat_id = (await client.get_entity(entity)).id
-                
+            if args.chat_id < 0:
+                # Es un chat ID real
+                chat_id = args.chat_id
+            else:
+                # Resolver el nombre/username a ID (antes de tomar conexión: no se retiene durante la red)
+                entity = await resolve_chat(client, str(args.chat_id))
+                chat_id = get_peer_id(entity)
+
+            with db_conn() as db:
                 messages = get_messages_by_chat(db, chat_id, limit=args.limit)
-                print(f"\n=== Últimos {len(messages)} mensajes del chat {chat_id} ===")
-                for msg in messages:
-                    print(f"[{msg['msg_id']}] {msg['sender_id']}: {msg['text'][:100] if msg['text'] else '(sin texto)'}")
-            finally:
-                close_db_connection(db)
+            print(f"\n=== Últimos {len(messages)} mensajes del chat {chat_id} ===")
+            for msg in messages:
+                print(f"[{msg['msg_id']}] {msg['sender_id']}: {msg['text'][:100] if msg['text'] else '(sin texto)'}")
         else:
             raise RuntimeError("Comando no reconocido")
 
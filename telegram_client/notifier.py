@@ -1,11 +1,12 @@
+import asyncio
 import os
 import time
-import json
 import threading
-import urllib.parse
-import urllib.request
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import Iterator, Optional
+
+import httpx
 
 
 def _parse_destinations(value: Optional[str]) -> list[str]:
@@ -19,19 +20,14 @@ def _parse_destinations(value: Optional[str]) -> list[str]:
     return parts
 
 
-def _chunk_text(text: str, chunk_size: int = 3800) -> list[str]:
-    if not text:
-        return [""]
+def _chunk_text(text: str, chunk_size: int = 3800) -> Iterator[str]:
+    # Trozos de caracteres (no de bytes UTF-8): el límite de la Bot API cuenta caracteres
+    # y cortar bytes partiría caracteres multibyte. El caso habitual no copia el texto.
     if len(text) <= chunk_size:
-        return [text]
-
-    chunks: list[str] = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + chunk_size)
-        chunks.append(text[start:end])
-        start = end
-    return chunks
+        yield text
+        return
+    for start in range(0, len(text), chunk_size):
+        yield text[start:start + chunk_size]
 
 
 def _build_notification_prefix() -> str:
@@ -56,6 +52,14 @@ def _build_notification_prefix() -> str:
     return "".join(pieces)
 
 
+# Envíos simultáneos a la Bot API por notificador (destinos × trozos)
+_MAX_CONCURRENT_SENDS = 8
+# Claves de rate-limit recordadas (LRU): el proceso vive semanas y las claves no se borran
+_MAX_RATE_LIMIT_KEYS = 4096
+# Notificaciones pendientes de envío como máximo; por encima, notify descarta
+_MAX_PENDING_NOTIFICATIONS = 512
+
+
 @dataclass(frozen=True)
 class TelegramNotifyConfig:
     token: str
@@ -69,7 +73,18 @@ class TelegramBotNotifier:
         self._config = config
         self._logger = logger
         self._lock = threading.Lock()
-        self._last_sent_by_key: dict[str, float] = {}
+        self._last_sent_by_key: "OrderedDict[str, float]" = OrderedDict()
+        # El entorno no cambia en ejecución: el prefijo se calcula una vez
+        prefix = _build_notification_prefix()
+        self._prefix_with_space = f"{prefix} " if prefix else ""
+        # Bucle propio en un hilo daemon: el AsyncClient (keep-alive, HTTP/2) vive siempre en él
+        # y notify solo encola ahí, sin esperar al envío desde el hilo o bucle que llama
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._send_slots: Optional[asyncio.Semaphore] = None
+        # Notificaciones encoladas en el bucle del notificador aún sin terminar, y descartadas
+        self._pending = 0
+        self._dropped = 0
 
     @property
     def enabled(self) -> bool:
@@ -89,65 +104,113 @@ class TelegramBotNotifier:
         return cls(cfg, logger=logger)
 
     def notify(self, *, key: str, text: str, min_interval_seconds: int = 600) -> bool:
-        """Send a notification if rate-limit allows it.
+        """Queue a notification if rate-limit allows it; sending happens in the background.
 
-        Returns True if a send was attempted (rate-limit passed), False if skipped.
+        Returns True if it was queued (rate-limit passed), False if skipped or the queue is full.
         """
         if not self.enabled:
             return False
 
-        config = self._config
-        assert config is not None
-
         now = time.time()
         with self._lock:
             last = self._last_sent_by_key.get(key)
             if last is not None and (now - last) < min_interval_seconds:
                 return False
-            self._last_sent_by_key[key] = now
+            if self._pending >= _MAX_PENDING_NOTIFICATIONS:
+                # Ráfaga de errores con la Bot API lenta o caída: se descarta en vez de acumular
+                self._dropped += 1
+                dropped = self._dropped
+            else:
+                dropped = 0
+                self._pending += 1
+                self._last_sent_by_key[key] = now
+                self._last_sent_by_key.move_to_end(key)
+                if len(self._last_sent_by_key) > _MAX_RATE_LIMIT_KEYS:
+                    self._last_sent_by_key.popitem(last=False)
+        if dropped:
+            if self._logger is not None:
+                self._logger.warning(f"Cola de notificaciones llena: descartada key={key} (total descartadas={dropped})")
+            return False
 
-        prefix = _build_notification_prefix()
-        text_to_send = f"{prefix} {text}".strip() if prefix else text
+        text_to_send = f"{self._prefix_with_space}{text}".strip() if self._prefix_with_space else text
+        future = asyncio.run_coroutine_threadsafe(self._deliver(text_to_send), self._get_loop())
+        future.add_done_callback(self._delivered)
+        return True
 
-        attempted = False
-        for chat_id in config.chat_ids:
-            for chunk in _chunk_text(text_to_send):
-                attempted = True
+    def _delivered(self, future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="notifier", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    async def _deliver(self, text_to_send: str) -> bool:
+        config = self._config
+        assert config is not None
+
+        if self._send_slots is None:
+            self._send_slots = asyncio.Semaphore(_MAX_CONCURRENT_SENDS)
+        # Los mismos trozos sirven a todos los destinos: se generan una sola vez
+        chunks = tuple(_chunk_text(text_to_send))
+
+        async def send_chat(chat_id: str) -> None:
+            # Cada destino en paralelo; sus trozos en orden para que lleguen legibles
+            for chunk in chunks:
                 try:
-                    self._send_message(chat_id=chat_id, text=chunk)
+                    async with self._send_slots:
+                        await self._send_message(chat_id=chat_id, text=chunk)
                 except Exception as exc:
                     if self._logger is not None:
                         self._logger.warning(f"No se pudo enviar notificación a chat_id={chat_id}: {exc}")
-        return attempted
 
-    def _send_message(self, *, chat_id: str, text: str) -> None:
+        await asyncio.gather(*(send_chat(chat_id) for chat_id in config.chat_ids))
+        return bool(config.chat_ids and chunks)
+
+    async def _send_message(self, *, chat_id: str, text: str) -> None:
         config = self._config
         assert config is not None
 
-        url = f"{config.api_base}/bot{config.token}/sendMessage"
+        if self._client is None:
+            # Se crea dentro del bucle del notificador: una conexión reutilizada para todos los envíos
+            self._client = httpx.AsyncClient(
+                base_url=config.api_base,
+                http2=True,
+                timeout=config.timeout_seconds,
+                limits=httpx.Limits(max_keepalive_connections=4),
+            )
         payload = {
             "chat_id": chat_id,
             "text": text,
             "disable_web_page_preview": True,
         }
-        data = urllib.parse.urlencode(payload).encode("utf-8")
-        req = urllib.request.Request(url, data=data, method="POST")
-        with urllib.request.urlopen(req, timeout=config.timeout_seconds) as resp:
-            body = resp.read().decode("utf-8", errors="replace")
-            # Bot API devuelve JSON; si ok=false, lo consideramos error.
-            try:
-                parsed = json.loads(body)
-            except Exception:
-                parsed = None
-            if isinstance(parsed, dict) and parsed.get("ok") is False:
-                raise RuntimeError(f"Telegram Bot API error: {parsed}")
+        resp = await self._client.post(f"/bot{config.token}/sendMessage", json=payload)
+        # La Bot API solo responde ok=false con un estado de error: con 200 no se parsea el cuerpo
+        if resp.status_code == 200:
+            return
+        # Bot API devuelve JSON; si ok=false, lo consideramos error.
+        try:
+            parsed = resp.json()
+        except Exception:
+            parsed = None
+        if isinstance(parsed, dict) and parsed.get("ok") is False:
+            raise RuntimeError(f"Telegram Bot API error: {parsed}")
+        resp.raise_for_status()
 
 
 _notifier_singleton: Optional[TelegramBotNotifier] = None
+_notifier_lock = threading.Lock()
 
 
 def get_notifier(logger=None) -> TelegramBotNotifier:
     global _notifier_singleton
+    # Ya creado: sin lock. La primera vez, el lock evita dos instancias (y dos bucles/clientes HTTP)
     if _notifier_singleton is None:
-        _notifier_singleton = TelegramBotNotifier.from_env(logger=logger)
+        with _notifier_lock:
+            if _notifier_singleton is None:
+                _notifier_singleton = TelegramBotNotifier.from_env(logger=logger)
     return _notifier_singleton